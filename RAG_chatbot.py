@@ -1,4 +1,7 @@
 import os
+import time
+import httpx
+import metrics
 from dotenv import load_dotenv
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
@@ -12,6 +15,11 @@ if not GROQ_API_KEY:
     print("⚠️ CẢNH BÁO: Không tìm thấy GROQ_API_KEY trong file .env")
 
 MODEL_NAME = "llama-3.3-70b-versatile"
+# Endpoint tương thích OpenAI (đổi sang mock_llm_server.py khi load test offline)
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "https://api.groq.com/openai/v1")
+# Pool kết nối keep-alive dùng chung cho mọi request tới LLM
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "120"))
 
 # --- 2. CẤU HÌNH MODEL ---
 generation_config = {
@@ -45,6 +53,54 @@ NHIỆM VỤ CỦA BẠN (BẮT BUỘC TUÂN THỦ):
 Câu trả lời (Tiếng Việt):
 """
 
+summary_prompt_template = """
+Bạn đang duy trì bản tóm tắt ngắn gọn của một cuộc hội thoại giữa người dùng và trợ lý tra cứu tài liệu.
+
+Bản tóm tắt hiện tại:
+{summary}
+
+Các lượt hội thoại mới cần gộp vào:
+{turns}
+
+Hãy viết lại bản tóm tắt (TIẾNG VIỆT, tối đa {max_words} từ), giữ lại các câu hỏi chính, dữ kiện, con số và kết luận quan trọng.
+
+Bản tóm tắt mới:
+"""
+
+document_summary_prompt_template = """
+Dưới đây là một phần nội dung của tài liệu (hoặc các bản tóm tắt của những phần liên tiếp trong tài liệu):
+
+---------------------
+{text}
+---------------------
+
+Hãy tóm tắt nội dung trên (TIẾNG VIỆT, tối đa {max_words} từ): nêu các ý chính, dữ kiện, con số và kết luận quan trọng theo đúng thứ tự trong tài liệu. Không thêm thông tin ngoài nội dung được cung cấp.
+
+Bản tóm tắt:
+"""
+
+# Số token tối đa cho mỗi lần tóm tắt lịch sử chat
+SUMMARY_MAX_TOKENS = 400
+
+try:
+    import tiktoken
+    # Llama 3 dùng tokenizer BPE kiểu tiktoken, cl100k_base cho số token xấp xỉ sát
+    _token_encoder = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _token_encoder = None
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _token_encoder is not None:
+        return len(_token_encoder.encode(text, disallowed_special=()))
+    # Không có tokenizer: ước lượng ~3 ký tự / token cho tiếng Việt
+    return len(text) // 3 + 1
+
+class LLMErrorMessage(str):
+    """Thông báo lỗi trả về cho người dùng thay cho câu trả lời (không phải nội dung do model sinh ra)."""
+
+
 def set_custom_prompt():
   return PromptTemplate(template=custom_prompt_template, input_variables=['history_global','context', 'question'])
 
@@ -55,30 +111,172 @@ class OpenRouterRAGBot:
             self.chain = None
             return
 
+        limits = httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_CONNECTIONS,
+            keepalive_expiry=30,
+        )
+        self.http_client = httpx.Client(limits=limits, timeout=LLM_TIMEOUT_SECONDS)
+        # Client async chỉ được dùng trên event loop của AsyncChatPipeline
+        self.http_async_client = httpx.AsyncClient(limits=limits, timeout=LLM_TIMEOUT_SECONDS)
+
         self.model = ChatOpenAI(
             model=MODEL_NAME,
             api_key=GROQ_API_KEY,
-            base_url="https://api.groq.com/openai/v1",
+            base_url=LLM_BASE_URL,
             temperature=generation_config["temperature"],
             max_tokens=generation_config["max_tokens"],
+            http_client=self.http_client,
+            http_async_client=self.http_async_client,
         )
         
         self.prompt = set_custom_prompt()
         self.chain = self.prompt | self.model | StrOutputParser()
 
+        # Chain nhỏ dùng để tóm tắt lịch sử chat cũ
+        self.summary_chain = (
+            PromptTemplate(template=summary_prompt_template, input_variables=['summary', 'turns', 'max_words'])
+            | self.model.bind(max_tokens=SUMMARY_MAX_TOKENS)
+            | StrOutputParser()
+        )
+
+        # Chain tóm tắt tài liệu lúc ingest (bước map / reduce của doc_summary)
+        self.document_summary_chain = (
+            PromptTemplate(template=document_summary_prompt_template, input_variables=['text', 'max_words'])
+            | self.model.bind(max_tokens=SUMMARY_MAX_TOKENS * 2)
+            | StrOutputParser()
+        )
+
+    def _record_usage(self, kind, inputs, output):
+        """Đếm số lời gọi và token (ước lượng bằng count_tokens) cho /metrics."""
+        metrics.llm_requests.inc(kind=kind)
+        metrics.llm_prompt_tokens.inc(count_tokens(self.prompt.format(**inputs)))
+        metrics.llm_completion_tokens.inc(count_tokens(output))
+
     def response(self, user_question: str, chat_history: str, context_data: str):
         if not self.chain:
-            return "Lỗi hệ thống: Chưa cấu hình GROQ API Key."
+            return LLMErrorMessage("Lỗi hệ thống: Chưa cấu hình GROQ API Key.")
 
+        inputs = {
+            "history_global": chat_history,
+            "context": context_data,
+            "question": user_question
+        }
         try:
-            return self.chain.invoke({
-                "history_global": chat_history,
-                "context": context_data,
-                "question": user_question
-            })
+            with metrics.span("llm"):
+                answer = self.chain.invoke(inputs)
+            self._record_usage("chat", inputs, answer)
+            return answer
         except Exception as e:
             print(f"❌ Lỗi khi gọi API Groq: {e}") 
-            return f"Lỗi kết nối AI: {str(e)}"
+            metrics.llm_requests.inc(kind="error")
+            return LLMErrorMessage(f"Lỗi kết nối AI: {str(e)}")
+
+    def stream_response(self, user_question: str, chat_history: str, context_data: str):
+        """Giống response() nhưng trả về từng đoạn token ngay khi model sinh ra."""
+        if not self.chain:
+            yield LLMErrorMessage("Lỗi hệ thống: Chưa cấu hình GROQ API Key.")
+            return
+
+        inputs = {
+            "history_global": chat_history,
+            "context": context_data,
+            "question": user_question
+        }
+        parts = []
+        start = time.perf_counter()
+        try:
+            with metrics.span("llm"):
+                for chunk in self.chain.stream(inputs):
+                    if chunk:
+                        if not parts:
+                            metrics.llm_first_token_seconds.observe(time.perf_counter() - start)
+                        parts.append(chunk)
+                        yield chunk
+            self._record_usage("chat_stream", inputs, "".join(parts))
+        except Exception as e:
+            print(f"❌ Lỗi khi gọi API Groq: {e}") 
+            metrics.llm_requests.inc(kind="error")
+            yield LLMErrorMessage(f"Lỗi kết nối AI: {str(e)}")
+
+    async def aresponse(self, user_question: str, chat_history: str, context_data: str):
+        """Bản async của response(): không chiếm thread trong lúc chờ LLM."""
+        if not self.chain:
+            return LLMErrorMessage("Lỗi hệ thống: Chưa cấu hình GROQ API Key.")
+
+        inputs = {
+            "history_global": chat_history,
+            "context": context_data,
+            "question": user_question
+        }
+        try:
+            with metrics.span("llm"):
+                answer = await self.chain.ainvoke(inputs)
+            self._record_usage("chat", inputs, answer)
+            return answer
+        except Exception as e:
+            print(f"❌ Lỗi khi gọi API Groq: {e}") 
+            metrics.llm_requests.inc(kind="error")
+            return LLMErrorMessage(f"Lỗi kết nối AI: {str(e)}")
+
+    async def astream_response(self, user_question: str, chat_history: str, context_data: str):
+        """Bản async của stream_response()."""
+        if not self.chain:
+            yield LLMErrorMessage("Lỗi hệ thống: Chưa cấu hình GROQ API Key.")
+            return
+
+        inputs = {
+            "history_global": chat_history,
+            "context": context_data,
+            "question": user_question
+        }
+        parts = []
+        start = time.perf_counter()
+        try:
+            with metrics.span("llm"):
+                async for chunk in self.chain.astream(inputs):
+                    if chunk:
+                        if not parts:
+                            metrics.llm_first_token_seconds.observe(time.perf_counter() - start)
+                        parts.append(chunk)
+                        yield chunk
+            self._record_usage("chat_stream", inputs, "".join(parts))
+        except Exception as e:
+            print(f"❌ Lỗi khi gọi API Groq: {e}") 
+            metrics.llm_requests.inc(kind="error")
+            yield LLMErrorMessage(f"Lỗi kết nối AI: {str(e)}")
+
+    def summarize_history(self, previous_summary: str, turns_text: str, max_words: int = 200):
+        """Gộp các lượt chat cũ vào bản tóm tắt. Trả về None nếu không gọi được model."""
+        if not self.chain:
+            return None
+
+        try:
+            with metrics.span("history_summary"):
+                summary = self.summary_chain.invoke({
+                    "summary": previous_summary or "(chưa có)",
+                    "turns": turns_text,
+                    "max_words": max_words
+                }).strip()
+            metrics.llm_requests.inc(kind="summary")
+            return summary
+        except Exception as e:
+            print(f"❌ Lỗi khi tóm tắt lịch sử chat: {e}")
+            return None
+
+    def summarize_document_part(self, text: str, max_words: int = 200):
+        """Tóm tắt một phần tài liệu (hoặc gộp các bản tóm tắt). Trả về None nếu không gọi được model."""
+        if not self.chain:
+            return None
+
+        try:
+            with metrics.span("document_summary"):
+                summary = self.document_summary_chain.invoke({"text": text, "max_words": max_words}).strip()
+            metrics.llm_requests.inc(kind="document_summary")
+            return summary
+        except Exception as e:
+            print(f"❌ Lỗi khi tóm tắt tài liệu: {e}")
+            return None
 
 # --- 5. KHỞI TẠO BOT ---
 rag_bot = OpenRouterRAGBot()
\ No newline at end of file
@@ -0,0 +1,135 @@
+import os
+import re
+import time
+import uuid
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Cache câu trả lời theo ngữ nghĩa: câu hỏi gần giống (cosine) trên cùng bộ tài liệu -> trả lại câu trả lời cũ
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE", "1") == "1"
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", str(24 * 3600)))
+# Ngưỡng cosine giữa hai câu hỏi để coi là cùng một câu hỏi (diễn đạt khác).
+# Embedding gần như không phân biệt được số ("Điều 12" / "Điều 13") -> các số trong câu hỏi phải khớp chính xác
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+
+_number_pattern = re.compile(r"\d+(?:[.,]\d+)*")
+
+
+def normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def question_numbers(question):
+    """Các số trong câu hỏi theo thứ tự xuất hiện: 'Điều 12 khoản 3' -> ('12', '3')."""
+    return tuple(_number_pattern.findall(question))
+
+
+class AnswerCache:
+    """
+    Cache LRU + TTL cho câu trả lời. Khóa gồm tập content_id của các tài liệu và phiên bản index của từng
+    tài liệu; trong cùng khóa, câu hỏi được so khớp theo cosine của embedding (đã chuẩn hóa)
+    và phải chứa đúng các số như câu hỏi đã cache.
+    Tài liệu được index lại / bị xóa -> tăng phiên bản và bỏ mọi câu trả lời dựa trên tài liệu đó.
+    """
+    def __init__(self, max_entries=ANSWER_CACHE_MAX_ENTRIES, ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+                 threshold=ANSWER_CACHE_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self._entries = OrderedDict()  # entry_id -> entry
+        self._by_key = {}  # khóa bộ tài liệu -> {entry_id}
+        self._doc_versions = {}  # content_id -> phiên bản index
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key(self, content_ids):
+        return tuple(sorted((cid, self._doc_versions.get(cid, 0)) for cid in set(content_ids)))
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        ids = self._by_key.get(entry["key"])
+        if ids is not None:
+            ids.discard(entry_id)
+            if not ids:
+                del self._by_key[entry["key"]]
+
+    def lookup(self, query_vector, content_ids, question):
+        """Trả về bản sao kết quả đã cache (kèm 'cached_question', 'similarity') hoặc None."""
+        vector = normalize(query_vector)
+        numbers = question_numbers(question)
+        now = time.time()
+        with self._lock:
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self._by_key.get(self._key(content_ids), ())):
+                entry = self._entries[entry_id]
+                if entry["expires_at"] <= now:
+                    self._remove(entry_id)
+                    continue
+                if entry["numbers"] != numbers:
+                    continue
+                score = float(np.dot(vector, entry["vector"]))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+
+            if best_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(best_id)
+            entry = self._entries[best_id]
+            return dict(entry["result"], cached_question=entry["question"], similarity=round(best_score, 4))
+
+    def put(self, query_vector, content_ids, question, result):
+        entry = {
+            "key": None,
+            "vector": normalize(query_vector),
+            "question": question,
+            "numbers": question_numbers(question),
+            # source_names: {content_id: tên hiển thị} lúc lưu, để đổi sang tên file của session tra cache
+            "result": {k: result[k] for k in ("response", "context", "sources", "source_names") if k in result},
+            "expires_at": time.time() + self.ttl_seconds,
+        }
+        entry_id = uuid.uuid4().hex
+        with self._lock:
+            entry["key"] = self._key(content_ids)
+            self._entries[entry_id] = entry
+            self._by_key.setdefault(entry["key"], set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_document(self, content_id):
+        """Gọi khi tài liệu được index lại hoặc bị xóa."""
+        with self._lock:
+            self._doc_versions[content_id] = self._doc_versions.get(content_id, 0) + 1
+            stale = [entry_id for entry_id, entry in self._entries.items()
+                     if any(cid == content_id for cid, _ in entry["key"])]
+            for entry_id in stale:
+                self._remove(entry_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_key.clear()
+            self._doc_versions.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+answer_cache = AnswerCache()
@@ -1,28 +1,68 @@
 import json
 import os
 import shutil
-import tempfile
-from flask import Flask, render_template, request, jsonify
+import threading
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 # [SỬA LẠI] Import từ pdf_processor thay vì document_processor
 from pdf_processor import DocumentDatabaseManager 
-from bot_logic import chatBotMode
+from bot_logic import chatBotMode, retriever
 from text_processor import TextProcessor
 import database as db 
+import conversation_memory
+from vector_cache import VectorStoreCache
+from ingest_queue import IngestionQueue
+from reranker import reranker, RERANK_ENABLED
+from answer_cache import answer_cache
+from doc_summary import SUMMARY_DIR
+from doc_gc import DocumentGarbageCollector, DOCUMENT_GC
+from async_pipeline import AsyncChatPipeline, ASYNC_CHAT
+from embedding import custom_embeddings, document_embeddings, warmup as warmup_embeddings, EMBEDDING_WARMUP
+import metrics
 
 # Đổi tên thư mục lưu trữ để tránh xung đột
 vector_db_path = "vectorstores"
-hash_store_path = "vectorstores/hashes.json"
-pdf_data_path = '' # Temp dir
+hash_store_path = "vectorstores/hashes.json" # Chỉ dùng để chuyển dữ liệu cũ sang registry trong SQLite
+pdf_data_path = 'uploads' # File upload được lưu tạm ở đây trong lúc xử lý
 
 app = Flask(__name__)
+# Đo thời gian từng request / giai đoạn, xuất ra /metrics (định dạng Prometheus)
+metrics.init_app(app)
 
 text_processor = TextProcessor()
 # [SỬA] Dùng DocumentDatabaseManager từ pdf_processor
 manager = DocumentDatabaseManager(pdf_data_path, vector_db_path, hash_store_path)
 
-# Cache để lưu các DB đã load
-loaded_vector_dbs_cache = {} 
+# Cache LRU để lưu các DB đã load (load lười khi session cần, có giới hạn bộ nhớ)
+loaded_vector_dbs_cache = VectorStoreCache(loader=manager.load_existing_db)
 bot = chatBotMode(vector_dbs=loaded_vector_dbs_cache)
+chat_pipeline = AsyncChatPipeline(bot) if ASYNC_CHAT else None
+
+def warmup_models():
+    try:
+        warmup_embeddings()
+    except Exception as e:
+        print(f"⚠️ Warmup embedding thất bại: {e}")
+
+if EMBEDDING_WARMUP:
+    # Load model trên thread nền: app nhận request ngay, không chặn lúc import / khởi động worker
+    threading.Thread(target=warmup_models, name="embedding-warmup", daemon=True).start()
+
+if RERANK_ENABLED:
+    # Đo chi phí cross-encoder ngay khi worker khởi động (gunicorn / flask run không chạy khối __main__);
+    # trước khi đo xong, rerank được bỏ qua thay vì chấm toàn bộ ứng viên không giới hạn
+    reranker.warmup_async()
+
+# GC theo số tham chiếu: tài liệu không còn session nào dùng bị bỏ khỏi cache, hết thời gian chờ thì xóa khỏi đĩa
+document_gc = DocumentGarbageCollector(manager, loaded_vector_dbs_cache)
+if DOCUMENT_GC:
+    document_gc.start()
+
+metrics.registry.register_cache("vector_store", loaded_vector_dbs_cache)
+metrics.registry.register_cache("query_embedding", custom_embeddings)
+metrics.registry.register_cache("context_text", retriever)
+metrics.registry.register_cache("answer", answer_cache)
+if hasattr(document_embeddings, "cache"):
+    metrics.registry.register_cache("chunk_embedding", document_embeddings.cache)
 
 @app.route('/')
 def index():
@@ -66,6 +106,43 @@ def remove_file_endpoint():
         return jsonify({'status': 'success'})
     return jsonify({'status': 'error', 'message': 'Missing info'}), 400
 
+def ingest_file(job, set_stage):
+    """Chạy trên worker nền: parse, chunk, embed, lưu FAISS rồi mới gắn file vào session."""
+    filename = job['filename']
+    file_path = job['file_path']
+    content_id = job['content_id']
+
+    # Tra registry theo content_id (đã tính khi nhận upload): cùng nội dung, khác tên -> không index lại.
+    # Kiểm tra tài liệu còn tồn tại và gắn vào session trong một câu lệnh: GC không xóa chen vào giữa được
+    if db.link_existing_document(job['session_id'], filename, file_path, content_id):
+        metrics.ingest_files.inc(status="duplicate")
+        print(f"File {filename} already processed. Linked to session.")
+        loaded_vector_dbs_cache.get(content_id)
+    else:
+        print(f"Processing new file: {filename}...")
+        # Upload lại file cùng tên với nội dung khác -> cập nhật tăng dần từ phiên bản đang dùng trong session
+        base_content_id = db.get_session_file(job['session_id'], filename)
+        timer = metrics.StageTimer()
+
+        def on_stage(stage):
+            timer.enter(stage)
+            set_stage(stage)
+
+        try:
+            db_instance = manager.update_db(file_path, progress_callback=on_stage, content_id=content_id,
+                                            original_name=filename, base_content_id=base_content_id)
+        finally:
+            timer.finish()
+        if not db_instance:
+            metrics.ingest_files.inc(status="error")
+            raise RuntimeError(f"Lỗi xử lý {filename}")
+        metrics.ingest_files.inc(status="ingested")
+        loaded_vector_dbs_cache.put(content_id, db_instance)
+        # Gắn file vào session khi index đã sẵn sàng (đổi con trỏ sang phiên bản mới trong một transaction)
+        db.add_file_to_session(job['session_id'], filename, file_path, content_id=content_id)
+
+ingestion_queue = IngestionQueue(ingest_file, upload_dir=pdf_data_path)
+
 @app.route('/upload', methods=['POST'])
 def upload_files():
     if 'pdf_docs' not in request.files: return jsonify({'error': 'No file part'}), 400
@@ -74,87 +151,126 @@ def upload_files():
 
     if not session_id: return jsonify({'error': 'Session ID missing'}), 400
 
-    successful_files = []
+    jobs = []
     errors = []
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # Cập nhật đường dẫn temp cho manager (Lưu ý: thuộc tính này phải có trong DocumentDatabaseManager)
-        manager.data_path = temp_dir 
-        
-        for file in files:
-            try:
-                file_path = os.path.join(temp_dir, file.filename)
-                file.save(file_path)
-                
-                # Xử lý file
-                if not manager.is_file_exists(file_path):
-                    print(f"Processing new file: {file.filename}...")
-                    db_instance = manager.update_db(file_path)
-                    if db_instance:
-                        loaded_vector_dbs_cache[file.filename] = db_instance
-                    else:
-                        errors.append(f"Lỗi xử lý {file.filename}")
-                else:
-                    print(f"File {file.filename} already processed. Linking to session.")
-                    if file.filename not in loaded_vector_dbs_cache:
-                        db_instance = manager.load_existing_db(file.filename)
-                        if db_instance:
-                            loaded_vector_dbs_cache[file.filename] = db_instance
-
-                # Gắn file vào session
-                if file.filename in loaded_vector_dbs_cache or manager.is_file_exists(file_path):
-                     db.add_file_to_session(session_id, file.filename, file_path)
-                     successful_files.append(file.filename)
-
-            except Exception as e:
-                print(f"Error uploading {file.filename}: {e}")
-                errors.append(f"Lỗi {file.filename}: {str(e)}")
+    for file in files:
+        try:
+            job_id, file_path, content_id = ingestion_queue.store_upload(file)
+            ingestion_queue.submit(job_id, session_id, file.filename, file_path, content_id=content_id)
+            jobs.append({'job_id': job_id, 'filename': file.filename, 'stage': 'queued'})
+        except Exception as e:
+            print(f"Error uploading {file.filename}: {e}")
+            errors.append(f"Lỗi {file.filename}: {str(e)}")
     
     current_session_files = db.get_files_by_session(session_id)
     return jsonify({
+        'jobs': jobs,
         'processed_files': current_session_files,
         'errors': errors
     })
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    data = request.json
-    user_question = data.get('question')
-    chat_history = data.get('history', "")
-    session_id = data.get('session_id')
+@app.route('/upload_status', methods=['GET'])
+def upload_status():
+    """Trạng thái các job ingest: theo job_ids (phân tách bằng dấu phẩy) hoặc theo session_id."""
+    session_id = request.args.get('session_id')
+    job_ids = request.args.get('job_ids')
+    job_ids = [j for j in job_ids.split(',') if j] if job_ids else None
+
+    # Đọc từ SQLite: job có thể đang chạy ở worker khác
+    jobs = db.get_ingest_jobs(job_ids=job_ids, session_id=session_id)
+    return jsonify({
+        'jobs': jobs,
+        'processed_files': db.get_files_by_session(session_id) if session_id else []
+    })
 
-    session_files = db.get_files_by_session(session_id)
-    if not session_files:
-        return jsonify({'response': 'Bạn chưa tải tài liệu nào lên cuộc trò chuyện này.', 'context': ''})
+@app.route('/document_versions', methods=['GET'])
+def document_versions():
+    """Các phiên bản của một file trong session, mới nhất trước."""
+    content_id = db.get_session_file(request.args.get('session_id'), request.args.get('filename'))
+    if content_id is None:
+        return jsonify({'versions': []})
+    return jsonify({'versions': db.get_document_versions(content_id)})
 
-    valid_pdfs_for_chat = []
-    for fname in session_files:
-        if fname not in loaded_vector_dbs_cache:
-            db_instance = manager.load_existing_db(fname)
-            if db_instance:
-                loaded_vector_dbs_cache[fname] = db_instance
-        
-        if fname in loaded_vector_dbs_cache:
-            valid_pdfs_for_chat.append(fname)
+def missing_files_notice(missing_files):
+    return (f"Không tìm thấy dữ liệu của {', '.join(missing_files)}, "
+            f"vui lòng tải lại các file này lên cuộc trò chuyện.")
 
+def get_chat_files(session_id):
+    """
+    Trả về ({tên file: content_id} dùng được để chat, {content_id: store} đã load, thông báo lỗi nếu có,
+    thông báo các file không dùng được). Store được truyền thẳng cho bot, không tra lại cache lần hai.
+    """
+    session_documents = db.get_session_documents(session_id)
+    if not session_documents:
+        return {}, {}, 'Bạn chưa tải tài liệu nào lên cuộc trò chuyện này.', None
+
+    valid_pdfs_for_chat = {}
+    stores = {}
+    missing_files = []
+    with metrics.span("load_db"):
+        for fname, content_id, file_path in session_documents:
+            if content_id is None:
+                # Dòng cũ (trước khi có registry) chưa gắn được theo tên file -> thử theo hash / tên store
+                content_id = manager.resolve_session_file(session_id, fname, file_path)
+                if content_id is None:
+                    missing_files.append(fname)
+                    continue
+            # Cùng nội dung upload dưới nhiều tên chỉ tìm kiếm một lần
+            if content_id in stores:
+                continue
+            # Load lười: chỉ đọc store từ đĩa khi session cần lần đầu
+            store = loaded_vector_dbs_cache.get(content_id)
+            if store is not None:
+                valid_pdfs_for_chat[fname] = content_id
+                stores[content_id] = store
+            else:
+                missing_files.append(fname)
+
+    notice = missing_files_notice(missing_files) if missing_files else None
     if not valid_pdfs_for_chat:
-        return jsonify({'response': 'Lỗi: Không tìm thấy dữ liệu vector của file.', 'context': ''})
+        return {}, {}, f"Lỗi: {notice}" if notice else 'Lỗi: Không tìm thấy dữ liệu vector của file.', None
+    return valid_pdfs_for_chat, stores, None, notice
 
-    # Gọi Bot
-    result = bot.process_question(
-        user_question=user_question,
-        selected_pdfs=valid_pdfs_for_chat, 
-        chat_history_str=chat_history
-    )
-    
+def format_final_response(result, notice=None):
     final_response = result['response']
-    
     # Định dạng nguồn đẹp hơn
     if result['sources']:
         final_response = f"{final_response}\n\n**Nguồn tham khảo:** {', '.join(result['sources'])}"
+    if notice:
+        final_response = f"{final_response}\n\n⚠️ {notice}"
+    return final_response
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    data = request.json
+    user_question = data.get('question')
+    session_id = data.get('session_id')
+
+    valid_pdfs_for_chat, stores, error, notice = get_chat_files(session_id)
+    if error:
+        return jsonify({'response': error, 'context': ''})
+
+    if chat_pipeline is not None:
+        # LLM gọi async trên event loop dùng chung, retrieval chạy trên thread pool giới hạn
+        result = chat_pipeline.run_answer(user_question, valid_pdfs_for_chat, session_id, stores)
+    else:
+        # Lịch sử chat do server dựng từ DB (giới hạn token, lượt cũ được tóm tắt)
+        chat_history = conversation_memory.build_history(session_id)
+
+        # Gọi Bot
+        result = bot.process_question(
+            user_question=user_question,
+            selected_pdfs=valid_pdfs_for_chat, 
+            chat_history_str=chat_history,
+            stores=stores
+        )
+    
+    final_response = format_final_response(result, notice)
 
     if session_id:
-        db.save_message(session_id, user_query=user_question, bot_response=final_response)
+        with metrics.span("save_message"):
+            db.save_message(session_id, user_query=user_question, bot_response=final_response)
     
     # Trả về JSON
     return jsonify({
@@ -162,6 +278,78 @@ def chat():
         'context': result['context']
     })
 
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.route('/chat_stream', methods=['POST'])
+def chat_stream():
+    """Giống /chat nhưng trả token dần qua Server-Sent Events, nguồn + context gửi ở event 'end'."""
+    data = request.json
+    user_question = data.get('question')
+    session_id = data.get('session_id')
+
+    valid_pdfs_for_chat, stores, error, notice = get_chat_files(session_id)
+    trace = metrics.current_trace()
+
+    def generate():
+        if error:
+            yield sse_event('end', {'response': error, 'sources': [], 'context': ''})
+            return
+
+        if chat_pipeline is not None:
+            events = chat_pipeline.stream_answer(user_question, valid_pdfs_for_chat, session_id, stores)
+        else:
+            events = bot.stream_question(
+                user_question=user_question,
+                selected_pdfs=valid_pdfs_for_chat,
+                chat_history_str=conversation_memory.build_history(session_id),
+                stores=stores
+            )
+
+        result = None
+        for kind, payload in events:
+            if kind == 'token':
+                yield sse_event('token', {'text': payload})
+            else:
+                result = payload
+
+        final_response = format_final_response(result, notice)
+        if session_id:
+            with metrics.span("save_message"):
+                db.save_message(session_id, user_query=user_question, bot_response=final_response)
+
+        yield sse_event('end', {
+            'response': final_response,
+            'sources': result['sources'],
+            'context': result['context']
+        })
+        # Header đã gửi từ trước khi stream -> đo toàn bộ thời gian stream tại đây
+        if trace is not None:
+            metrics.stage_seconds.observe(trace.elapsed(), stage="chat_stream_total")
+            metrics.log_if_slow(trace)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        'vector_store': loaded_vector_dbs_cache.stats(),
+        'answer_cache': answer_cache.stats()
+    })
+
+@app.route('/gc_stats', methods=['GET'])
+def gc_stats():
+    return jsonify(document_gc.stats())
+
+@app.route('/gc', methods=['POST'])
+def run_gc():
+    """Chạy một lượt GC ngay (không đợi chu kỳ nền)."""
+    return jsonify(document_gc.collect())
+
 @app.route('/clean', methods=['POST'])
 def clean_all():
     try:
@@ -169,21 +357,21 @@ def clean_all():
             shutil.rmtree("vectorstores")
         if os.path.exists("original_text"):
             shutil.rmtree("original_text")
+        if os.path.exists(SUMMARY_DIR):
+            shutil.rmtree(SUMMARY_DIR)
         loaded_vector_dbs_cache.clear()
+        answer_cache.clear()
+        db.clear_documents()
+        if manager.unified_index is not None:
+            manager.unified_index.load()
         return jsonify({'status': 'success'})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 if __name__ == "__main__":
-    # Tải lại DB khi khởi động
-    if os.path.exists(hash_store_path):
-         with open(hash_store_path, 'r') as f:
-             hashes = json.load(f)
-             for h, path in hashes.items():
-                 filename = os.path.basename(path)
-                 print(f"Reloading {filename}...")
-                 db_instance = manager.load_existing_db(filename)
-                 if db_instance:
-                     loaded_vector_dbs_cache[filename] = db_instance
-    
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    # Chế độ index hợp nhất: chuyển các store cũ vào index chung (chỉ một lần)
+    if manager.unified_index is not None:
+        manager.migrate_to_unified_index()
+
+    # threaded=True: mỗi request một thread nhẹ, chỉ chờ kết quả từ pipeline async
+    app.run(debug=True, port=5000, threaded=True)
\ No newline at end of file
@@ -0,0 +1,141 @@
+import os
+import asyncio
+import queue
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from RAG_chatbot import rag_bot, LLMErrorMessage
+import conversation_memory
+import metrics
+
+# Dùng pipeline async cho /chat và /chat_stream
+ASYNC_CHAT = os.getenv("ASYNC_CHAT", "1") == "1"
+# Số thread tối đa cho phần việc nặng CPU (embedding câu hỏi, tìm FAISS/BM25, dựng context)
+RETRIEVAL_THREADS = int(os.getenv("RETRIEVAL_THREADS", str(os.cpu_count() or 4)))
+
+
+class AsyncChatPipeline:
+    """
+    Một event loop chạy nền dùng chung cho mọi request: các lời gọi LLM (ainvoke / astream) chạy
+    đồng thời trên cùng pool kết nối keep-alive, còn retrieval được đẩy sang thread pool có giới hạn.
+    Thread của Flask chỉ chờ kết quả, không giữ kết nối tới LLM.
+    """
+    def __init__(self, bot, retrieval_threads=RETRIEVAL_THREADS):
+        self.bot = bot
+        self.executor = ThreadPoolExecutor(max_workers=retrieval_threads, thread_name_prefix="retrieval")
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="chat-event-loop", daemon=True)
+        self._thread.start()
+
+    async def _prepare(self, user_question, selected_pdfs, session_id, stores):
+        # Dựng lịch sử chat và tìm kiếm context song song trên thread pool
+        # (mỗi lời gọi chạy trong bản sao context riêng để span được ghi vào trace của request)
+        history_future = self.loop.run_in_executor(
+            self.executor, contextvars.copy_context().run, conversation_memory.build_history, session_id)
+        prepared_future = self.loop.run_in_executor(
+            self.executor, contextvars.copy_context().run, self.bot.prepare_context, user_question, selected_pdfs, stores)
+        return await asyncio.gather(history_future, prepared_future)
+
+    def _lookup_cache(self, user_question, selected_pdfs, session_id):
+        # Câu trả lời cache chỉ đúng cho lượt đầu tiên của session (chưa có lịch sử chat)
+        if conversation_memory.has_history(session_id):
+            return None
+        return self.bot.cached_answer(user_question, selected_pdfs)
+
+    async def _cached(self, user_question, selected_pdfs, session_id):
+        return await self.loop.run_in_executor(
+            self.executor, contextvars.copy_context().run, self._lookup_cache, user_question, selected_pdfs, session_id)
+
+    async def _remember(self, user_question, selected_pdfs, chat_history, result):
+        if chat_history:
+            return
+        await self.loop.run_in_executor(
+            self.executor, self.bot.remember_answer, user_question, selected_pdfs, result)
+
+    async def answer(self, user_question, selected_pdfs, session_id, stores=None):
+        cached = await self._cached(user_question, selected_pdfs, session_id)
+        if cached is not None:
+            return cached
+
+        chat_history, prepared = await self._prepare(user_question, selected_pdfs, session_id, stores)
+        if "response" in prepared:
+            return prepared
+
+        response_text = await rag_bot.aresponse(
+            user_question=user_question,
+            chat_history=chat_history,
+            context_data=prepared["context"]
+        )
+        result = {
+            "response": response_text.strip(),
+            "context": prepared["context"],
+            "sources": prepared["sources"]
+        }
+        if not isinstance(response_text, LLMErrorMessage):
+            await self._remember(user_question, selected_pdfs, chat_history, result)
+        return result
+
+    async def _stream_into(self, out_queue, user_question, selected_pdfs, session_id, stores):
+        try:
+            cached = await self._cached(user_question, selected_pdfs, session_id)
+            if cached is not None:
+                out_queue.put(("token", cached["response"]))
+                out_queue.put(("end", cached))
+                return
+
+            chat_history, prepared = await self._prepare(user_question, selected_pdfs, session_id, stores)
+            if "response" in prepared:
+                out_queue.put(("token", prepared["response"]))
+                out_queue.put(("end", prepared))
+                return
+
+            parts = []
+            failed = False
+            async for token in rag_bot.astream_response(
+                user_question=user_question,
+                chat_history=chat_history,
+                context_data=prepared["context"]
+            ):
+                failed = failed or isinstance(token, LLMErrorMessage)
+                parts.append(token)
+                out_queue.put(("token", token))
+
+            result = {
+                "response": "".join(parts).strip(),
+                "context": prepared["context"],
+                "sources": prepared["sources"]
+            }
+            out_queue.put(("end", result))
+            if not failed:
+                await self._remember(user_question, selected_pdfs, chat_history, result)
+        except Exception as e:
+            out_queue.put(("error", e))
+
+    async def _traced(self, trace, coro):
+        # Task trên event loop không thừa hưởng context của thread Flask -> gắn lại trace của request
+        metrics.bind_trace(trace)
+        return await coro
+
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(self._traced(metrics.current_trace(), coro), self.loop)
+
+    def run_answer(self, user_question, selected_pdfs, session_id, stores=None):
+        """Gọi từ thread của Flask: chờ câu trả lời đầy đủ (giống chatBotMode.process_question)."""
+        return self._submit(self.answer(user_question, selected_pdfs, session_id, stores)).result()
+
+    def stream_answer(self, user_question, selected_pdfs, session_id, stores=None):
+        """Generator đồng bộ cho Flask: yield ("token", text) rồi ("end", result) giống chatBotMode.stream_question."""
+        out_queue = queue.Queue()
+        future = self._submit(self._stream_into(out_queue, user_question, selected_pdfs, session_id, stores))
+        try:
+            while True:
+                kind, payload = out_queue.get()
+                if kind == "error":
+                    raise payload
+                yield kind, payload
+                if kind == "end":
+                    return
+        finally:
+            # Client ngắt kết nối (generator bị đóng) -> hủy coroutine để không tiếp tục gọi LLM
+            if not future.done():
+                future.cancel()
@@ -0,0 +1,6 @@
+"""
+Bộ benchmark cho ingest, retrieval và /chat.
+
+Chạy từ thư mục gốc của repo:
+    python -m benchmarks.run --stub-embedder --out benchmarks/results/run.json
+"""
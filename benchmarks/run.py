@@ -0,0 +1,360 @@
+"""
+Benchmark đầu-cuối: tốc độ ingest (update_db), độ trễ retrieval theo số file trong session
+và độ trễ /chat với LLM giả lập. Kết quả ghi ra JSON để so sánh giữa các lần chạy.
+
+    python -m benchmarks.run --stub-embedder
+    python -m benchmarks.run --skip-chat --session-sizes 1,10 --compare benchmarks/results/old.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.synthetic_docs import generate_document, SAMPLE_QUERIES  # noqa: E402
+from benchmarks.stubs import install_stub_embedder, start_mock_llm  # noqa: E402
+
+DEFAULT_RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+# Các biến môi trường ảnh hưởng tới kết quả, được ghi kèm vào JSON
+RECORDED_ENV = [
+    "EMBEDDING_BACKEND", "EMBEDDING_BATCH_SIZE", "EMBEDDING_THREADS", "EMBEDDING_CACHE", "UNIFIED_INDEX",
+    "HYBRID_SEARCH", "HYBRID_CANDIDATES", "RERANK", "CONTEXT_TOKEN_BUDGET", "ANN_MIN_CHUNKS", "ANN_INDEX_TYPE",
+    "PARALLEL_MIN_PAGES", "INGEST_PROCESSES", "ASYNC_CHAT", "ANSWER_CACHE", "DOCUMENT_SUMMARIES", "MMAP_STORE",
+    "DOCUMENT_GC",
+]
+
+
+def percentiles(samples_ms):
+    if not samples_ms:
+        return {"count": 0}
+    ordered = sorted(samples_ms)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered), 3),
+        "p50_ms": round(pick(0.50), 3),
+        "p90_ms": round(pick(0.90), 3),
+        "p99_ms": round(pick(0.99), 3),
+        "max_ms": round(ordered[-1], 3),
+    }
+
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    """Tắt print của code được đo (tránh tính cả thời gian ghi ra terminal)."""
+    if not enabled:
+        yield
+        return
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def timed_ms(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return (time.perf_counter() - start) * 1000, result
+
+
+def count_chunks(manager, content_id, db):
+    if db is None:
+        return 0
+    if manager.unified_index is not None:
+        return len(manager.unified_index.doc_positions.get(content_id, []))
+    return db.index.ntotal
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+# --- INGEST ---
+def bench_ingestion(manager, docs_dir, formats, pages, files_per_format, seed, verbose=False):
+    files = []
+    for fmt in formats:
+        for i in range(files_per_format):
+            path = generate_document(docs_dir, f"ingest_{fmt}_{pages}p_{i}", fmt, pages, seed=seed + i)
+            # App tính hash trong lúc nhận upload -> không tính vào thời gian ingest
+            content_id = manager.calculate_file_hash(path)
+            with quiet(not verbose):
+                elapsed_ms, db = timed_ms(manager.update_db, path, content_id=content_id)
+            file_name = os.path.basename(path)
+            files.append({
+                "file": file_name,
+                "format": fmt,
+                "pages": pages,  # số trang sinh ra (DOCX / TXT không có trang thật, dùng làm đơn vị quy đổi)
+                "bytes": os.path.getsize(path),
+                "chunks": count_chunks(manager, content_id, db),
+                "seconds": round(elapsed_ms / 1000, 4),
+            })
+            print(f"  ingest {file_name}: {files[-1]['chunks']} chunks, {files[-1]['seconds']}s")
+
+    by_format = {}
+    for fmt in formats:
+        rows = [row for row in files if row["format"] == fmt]
+        seconds = sum(row["seconds"] for row in rows)
+        by_format[fmt] = {
+            "files": len(rows),
+            "pages": sum(row["pages"] for row in rows),
+            "chunks": sum(row["chunks"] for row in rows),
+            "seconds": round(seconds, 4),
+            "pages_per_s": round(sum(row["pages"] for row in rows) / seconds, 3) if seconds else None,
+            "chunks_per_s": round(sum(row["chunks"] for row in rows) / seconds, 3) if seconds else None,
+        }
+    return {"files": files, "by_format": by_format}
+
+
+def build_corpus(manager, docs_dir, num_files, pages, seed, verbose=False):
+    """Ingest num_files file TXT (parse nhanh nhất) làm corpus cho benchmark retrieval / chat. Trả về [(tên file, content_id)]."""
+    corpus = []
+    for i in range(num_files):
+        path = generate_document(docs_dir, f"corpus_{i:03d}", "txt", pages, seed=seed + 1000 + i)
+        content_id = manager.calculate_file_hash(path)
+        with quiet(not verbose):
+            manager.update_db(path, content_id=content_id)
+        corpus.append((os.path.basename(path), content_id))
+    return corpus
+
+
+# --- RETRIEVAL ---
+def bench_retrieval(manager, corpus, session_sizes, queries, repeats, verbose=False):
+    from bot_logic import chatBotMode
+    from vector_cache import VectorStoreCache
+
+    # Cache không giới hạn: đo tìm kiếm, không đo việc load lại store từ đĩa
+    cache = VectorStoreCache(loader=manager.load_existing_db, max_entries=0, max_bytes=0)
+    bot = chatBotMode(vector_dbs=cache)
+
+    results = []
+    for size in session_sizes:
+        files = dict(corpus[:size])
+        target_dbs = {name: cache.get(content_id) for name, content_id in files.items()}
+        target_dbs = {name: db for name, db in target_dbs.items() if db is not None}
+
+        search_ms, prepare_ms = [], []
+        with quiet(not verbose):
+            for query in queries:  # warmup: cache embedding câu hỏi, original_text
+                bot.prepare_context(query, files)
+            for _ in range(repeats):
+                for query in queries:
+                    search_ms.append(timed_ms(bot.hybrid_search, target_dbs, query, k=6, threshold=1.8)[0])
+                    prepare_ms.append(timed_ms(bot.prepare_context, query, files)[0])
+
+        row = {
+            "files": size,
+            "loaded_stores": len(target_dbs),
+            "search": percentiles(search_ms),
+            "prepare_context": percentiles(prepare_ms),
+        }
+        results.append(row)
+        print(f"  retrieval {size} files: search p50={row['search'].get('p50_ms')}ms, "
+              f"prepare_context p50={row['prepare_context'].get('p50_ms')}ms")
+    return results
+
+
+# --- /chat ---
+def bench_chat(app_module, corpus, session_sizes, queries, num_requests, concurrency, verbose=False):
+    import database as db
+
+    results = []
+    for size in session_sizes:
+        session_id = f"bench-{size}-{int(time.time())}"
+        for name, content_id in corpus[:size]:
+            db.add_file_to_session(session_id, name, None, content_id=content_id)
+
+        def send(i):
+            client = app_module.app.test_client()
+            elapsed_ms, response = timed_ms(client.post, '/chat', json={
+                "question": queries[i % len(queries)],
+                "session_id": session_id,
+            })
+            return elapsed_ms, response.status_code
+
+        with quiet(not verbose):
+            send(0)  # warmup: load store, kết nối tới LLM
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                outcomes = list(pool.map(send, range(num_requests)))
+            wall_seconds = time.perf_counter() - start
+
+        latencies = [ms for ms, status in outcomes if status == 200]
+        row = {
+            "files": size,
+            "requests": num_requests,
+            "concurrency": concurrency,
+            "errors": sum(1 for _, status in outcomes if status != 200),
+            "requests_per_s": round(num_requests / wall_seconds, 3) if wall_seconds else None,
+            "latency": percentiles(latencies),
+        }
+        results.append(row)
+        print(f"  /chat {size} files: p50={row['latency'].get('p50_ms')}ms, {row['requests_per_s']} req/s")
+    return results
+
+
+# --- SO SÁNH ---
+def flatten_metrics(result):
+    """Các chỉ số chính dạng {tên: giá trị} để so sánh hai lần chạy."""
+    metrics = {}
+    for fmt, row in result.get("ingestion", {}).get("by_format", {}).items():
+        metrics[f"ingest.{fmt}.pages_per_s"] = row.get("pages_per_s")
+        metrics[f"ingest.{fmt}.chunks_per_s"] = row.get("chunks_per_s")
+    for row in result.get("retrieval", []):
+        for part in ("search", "prepare_context"):
+            for stat in ("p50_ms", "p99_ms"):
+                metrics[f"retrieval.{row['files']}files.{part}.{stat}"] = row[part].get(stat)
+    for row in result.get("chat", []):
+        for stat in ("p50_ms", "p99_ms"):
+            metrics[f"chat.{row['files']}files.{stat}"] = row["latency"].get(stat)
+        metrics[f"chat.{row['files']}files.requests_per_s"] = row.get("requests_per_s")
+    return metrics
+
+
+def compare(previous, current):
+    old_metrics, new_metrics = flatten_metrics(previous), flatten_metrics(current)
+    print(f"\n{'metric':55} {'old':>12} {'new':>12} {'change':>9}")
+    for name, new_value in new_metrics.items():
+        old_value = old_metrics.get(name)
+        if old_value is None or new_value is None:
+            continue
+        change = f"{(new_value - old_value) / old_value * 100:+.1f}%" if old_value else "n/a"
+        print(f"{name:55} {old_value:>12} {new_value:>12} {change:>9}")
+
+
+def parse_sizes(value):
+    return sorted({int(v) for v in value.split(',') if v.strip()})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest / retrieval / chat.")
+    parser.add_argument("--out", help="File JSON kết quả (mặc định: benchmarks/results/bench-<thời gian>.json)")
+    parser.add_argument("--compare", help="File JSON của lần chạy trước để in mức thay đổi")
+    parser.add_argument("--workdir", help="Thư mục làm việc (vectorstores, original_text, DB). Mặc định: thư mục tạm")
+    parser.add_argument("--keep-workdir", action="store_true", help="Không xóa thư mục tạm sau khi chạy")
+    parser.add_argument("--stub-embedder", action="store_true", help="Dùng embedder băm thay cho SentenceTransformer")
+    parser.add_argument("--embedding-cache", action="store_true", help="Bật cache embedding trên đĩa khi ingest")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="Giữ nguyên log của code được đo")
+    # Ingest
+    parser.add_argument("--formats", default="pdf,docx,txt")
+    parser.add_argument("--pages", type=int, default=20, help="Số trang mỗi file ingest")
+    parser.add_argument("--files-per-format", type=int, default=2)
+    # Retrieval / chat
+    parser.add_argument("--session-sizes", default="1,10,50,100", help="Số file trong session, phân tách bằng dấu phẩy")
+    parser.add_argument("--corpus-pages", type=int, default=5, help="Số trang mỗi file của corpus retrieval")
+    parser.add_argument("--repeats", type=int, default=3, help="Số lần lặp bộ câu hỏi cho mỗi kích thước session")
+    parser.add_argument("--skip-ingest", action="store_true")
+    parser.add_argument("--skip-retrieval", action="store_true")
+    parser.add_argument("--skip-chat", action="store_true")
+    parser.add_argument("--chat-requests", type=int, default=20)
+    parser.add_argument("--chat-concurrency", type=int, default=4)
+    parser.add_argument("--llm-latency-ms", type=float, default=300, help="Độ trễ token đầu tiên của LLM giả lập")
+    parser.add_argument("--llm-token-delay-ms", type=float, default=10)
+    args = parser.parse_args()
+
+    out_path = os.path.abspath(args.out) if args.out else os.path.join(
+        DEFAULT_RESULTS_DIR, f"bench-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    previous = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+
+    # Code của app dùng đường dẫn tương đối -> chạy trong thư mục làm việc riêng để không đụng dữ liệu thật
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="rag-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    os.environ.setdefault("EMBEDDING_CACHE", "1" if args.embedding_cache else "0")
+    # Câu hỏi mẫu lặp lại giữa các lượt -> tắt cache câu trả lời để đo đúng retrieval + LLM;
+    # tài liệu benchmark không gắn session nên GC nền cũng được tắt
+    os.environ.setdefault("ANSWER_CACHE", "0")
+    os.environ.setdefault("DOCUMENT_GC", "0")
+
+    # Phải thay embedder / trỏ LLM trước khi import các module của app
+    if args.stub_embedder:
+        install_stub_embedder()
+    mock_server = None if args.skip_chat else start_mock_llm(args.llm_latency_ms, args.llm_token_delay_ms)
+
+    session_sizes = parse_sizes(args.session_sizes)
+    formats = [f.strip() for f in args.formats.split(',') if f.strip()]
+    queries = SAMPLE_QUERIES
+
+    result = {
+        "meta": {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "stub_embedder": args.stub_embedder,
+            "stub_llm": {"latency_ms": args.llm_latency_ms, "token_delay_ms": args.llm_token_delay_ms},
+            "args": vars(args),
+            "env": {name: os.environ[name] for name in RECORDED_ENV if name in os.environ},
+        }
+    }
+
+    try:
+        with quiet(not args.verbose):
+            if args.skip_chat:
+                from pdf_processor import DocumentDatabaseManager
+                manager = DocumentDatabaseManager("uploads", "vectorstores", "vectorstores/hashes.json")
+                app_module = None
+            else:
+                import app as app_module
+                manager = app_module.manager
+
+        if not args.skip_ingest:
+            print("Ingest...")
+            result["ingestion"] = bench_ingestion(manager, os.path.join(workdir, "docs"), formats, args.pages,
+                                                  args.files_per_format, args.seed, verbose=args.verbose)
+
+        corpus = []
+        if session_sizes and not (args.skip_retrieval and args.skip_chat):
+            print(f"Dựng corpus {max(session_sizes)} file...")
+            corpus = build_corpus(manager, os.path.join(workdir, "corpus"), max(session_sizes),
+                                  args.corpus_pages, args.seed, verbose=args.verbose)
+
+        if not args.skip_retrieval:
+            print("Retrieval...")
+            result["retrieval"] = bench_retrieval(manager, corpus, session_sizes, queries, args.repeats,
+                                                  verbose=args.verbose)
+
+        if app_module is not None:
+            print("/chat...")
+            result["chat"] = bench_chat(app_module, corpus, session_sizes, queries, args.chat_requests,
+                                        args.chat_concurrency, verbose=args.verbose)
+    finally:
+        if mock_server is not None:
+            mock_server.shutdown()
+        os.chdir(REPO_ROOT)
+        if not args.workdir and not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    result["meta"]["finished_at"] = datetime.now().isoformat(timespec="seconds")
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    with open(out_path, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"Đã ghi kết quả: {out_path}")
+
+    if previous is not None:
+        compare(previous, result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import os
+import re
+import sys
+import types
+import hashlib
+import threading
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+# Cùng số chiều với hiieu/halong_embedding để FAISS / cache có kích thước như thật
+STUB_EMBEDDING_DIM = 768
+
+_token_pattern = re.compile(r"\w+", re.UNICODE)
+
+
+class HashEmbeddings(Embeddings):
+    """
+    Embedder giả lập: mỗi token được băm vào một chiều (kèm dấu +/-), vector được chuẩn hóa.
+    Không cần model nên đo được phần còn lại của pipeline (parse, chunk, FAISS, context) tách khỏi embedding,
+    và vẫn giữ được tính "gần nghĩa" thô (văn bản chung từ vựng cho vector gần nhau).
+    """
+    def __init__(self, dim=STUB_EMBEDDING_DIM):
+        self.dim = dim
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in _token_pattern.findall(text.lower()):
+            digest = hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest()
+            value = int.from_bytes(digest, 'little')
+            vector[value % self.dim] += 1.0 if (value >> 63) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def embed_documents(self, texts):
+        return np.vstack([self._embed(text) for text in texts]) if texts else np.zeros((0, self.dim), dtype=np.float32)
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+def install_stub_embedder():
+    """
+    Đăng ký module 'embedding' giả trước khi import pdf_processor / bot_logic / app,
+    để không phải tải SentenceTransformer. Phải gọi trước mọi import dùng embedding.
+    """
+    if "embedding" in sys.modules:
+        raise RuntimeError("embedding đã được import, không thể thay bằng embedder giả lập")
+    stub = types.ModuleType("embedding")
+    stub.model_name = "stub-hash"
+    stub.EMBEDDING_BACKEND = "stub"
+    stub.custom_embeddings = HashEmbeddings()
+    stub.document_embeddings = stub.custom_embeddings
+    stub.EMBEDDING_WARMUP = False
+    stub.warmup = lambda: None
+    sys.modules["embedding"] = stub
+    return stub
+
+
+def start_mock_llm(latency_ms=300, token_delay_ms=10):
+    """
+    Chạy mock_llm_server trong thread nền (cổng ngẫu nhiên) và trỏ LLM_BASE_URL tới nó.
+    Phải gọi trước khi import RAG_chatbot.
+    """
+    from mock_llm_server import create_server
+
+    server = create_server(port=0, latency_ms=latency_ms, token_delay_ms=token_delay_ms)
+    threading.Thread(target=server.serve_forever, name="mock-llm", daemon=True).start()
+    host, port = server.server_address[:2]
+    os.environ["LLM_BASE_URL"] = f"http://{host}:{port}/v1"
+    os.environ["GROQ_API_KEY"] = "mock"
+    return server
@@ -0,0 +1,188 @@
+import os
+import random
+import zipfile
+import unicodedata
+from xml.sax.saxutils import escape
+
+# Từ vựng để sinh văn bản tiếng Việt giả lập (kiểu văn bản hành chính / hợp đồng)
+SUBJECTS = [
+    "Bên A", "Bên B", "Công ty", "Người lao động", "Khách hàng", "Ban giám đốc",
+    "Phòng kế toán", "Hội đồng quản trị", "Nhà cung cấp", "Cơ quan quản lý",
+]
+VERBS = [
+    "có trách nhiệm", "được quyền", "cam kết", "phải thông báo", "đề nghị",
+    "chịu trách nhiệm", "tiến hành kiểm tra", "thanh toán", "bàn giao", "báo cáo",
+]
+OBJECTS = [
+    "toàn bộ hồ sơ liên quan", "khoản phí dịch vụ hàng tháng", "kết quả kiểm toán nội bộ",
+    "các điều khoản bảo mật thông tin", "tiến độ thực hiện dự án", "chi phí phát sinh",
+    "hàng hóa đúng chất lượng", "kế hoạch đào tạo nhân sự", "biên bản nghiệm thu", "quy trình xử lý khiếu nại",
+]
+MODIFIERS = [
+    "trong thời hạn 30 ngày", "theo quy định của pháp luật", "trước ngày 15 hằng tháng",
+    "bằng văn bản", "kể từ ngày ký hợp đồng", "theo phụ lục đính kèm",
+    "với sự đồng ý của hai bên", "tại trụ sở chính", "mà không cần báo trước", "theo đúng tiến độ đã thỏa thuận",
+]
+
+# Câu hỏi mẫu cho benchmark retrieval / chat, khớp với từ vựng ở trên
+SAMPLE_QUERIES = [
+    "Bên A có trách nhiệm gì về chi phí phát sinh?",
+    "Thời hạn thanh toán khoản phí dịch vụ hàng tháng là khi nào?",
+    "Điều 12 quy định gì?",
+    "Ai phải thông báo bằng văn bản khi bàn giao biên bản nghiệm thu?",
+    "Quy trình xử lý khiếu nại của khách hàng như thế nào?",
+    "Các điều khoản bảo mật thông tin gồm những gì?",
+    "tóm tắt",
+    "nguoi lao dong duoc quyen gi",
+]
+
+WORDS_PER_PAGE = 350
+
+
+def fold_ascii(text):
+    """Bỏ dấu tiếng Việt (kể cả đ -> d) để ghi được bằng font chuẩn của PDF."""
+    text = text.replace("đ", "d").replace("Đ", "D")
+    nfkd_form = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in nfkd_form if not unicodedata.combining(c))
+
+
+def generate_pages(num_pages, words_per_page=WORDS_PER_PAGE, seed=0):
+    """Sinh num_pages trang văn bản, mỗi trang gồm vài 'Điều' với các câu ghép ngẫu nhiên (có seed)."""
+    rng = random.Random(seed)
+    pages = []
+    article = 1
+    for _ in range(num_pages):
+        paragraphs = []
+        words = 0
+        while words < words_per_page:
+            sentences = []
+            for _ in range(rng.randint(3, 6)):
+                sentence = f"{rng.choice(SUBJECTS)} {rng.choice(VERBS)} {rng.choice(OBJECTS)} {rng.choice(MODIFIERS)}."
+                sentences.append(sentence)
+            paragraph = f"Điều {article}. " + " ".join(sentences)
+            article += 1
+            paragraphs.append(paragraph)
+            words += len(paragraph.split())
+        pages.append("\n\n".join(paragraphs))
+    return pages
+
+
+def write_txt(path, pages):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("\n\n".join(pages))
+    return path
+
+
+def write_docx(path, pages):
+    """DOCX tối giản (chỉ word/document.xml), đủ cho Docx2txtLoader."""
+    content_types = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/word/document.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+        '</Types>'
+    )
+    rels = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="word/document.xml"/>'
+        '</Relationships>'
+    )
+    body = []
+    for page_number, page in enumerate(pages):
+        if page_number > 0:
+            body.append('<w:p><w:r><w:br w:type="page"/></w:r></w:p>')
+        for paragraph in page.split("\n\n"):
+            body.append(f'<w:p><w:r><w:t xml:space="preserve">{escape(paragraph)}</w:t></w:r></w:p>')
+    document = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+        f'<w:body>{"".join(body)}</w:body></w:document>'
+    )
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr("[Content_Types].xml", content_types)
+        z.writestr("_rels/.rels", rels)
+        z.writestr("word/document.xml", document)
+    return path
+
+
+def _wrap(text, width=95):
+    lines = []
+    for paragraph in text.split("\n\n"):
+        line = ""
+        for word in paragraph.split():
+            if line and len(line) + 1 + len(word) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = f"{line} {word}" if line else word
+        lines.append(line)
+        lines.append("")
+    return lines
+
+
+def write_pdf(path, pages):
+    """
+    PDF tối giản, mỗi trang một content stream dùng font Helvetica.
+    Font chuẩn của PDF không có glyph tiếng Việt nên văn bản được bỏ dấu trước khi ghi.
+    """
+    def pdf_string(line):
+        return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    objects = []  # nội dung của object thứ i + 1
+
+    def add_object(content):
+        objects.append(content)
+        return len(objects)
+
+    catalog_id = add_object(None)
+    pages_id = add_object(None)
+    font_id = add_object(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+
+    page_ids = []
+    for page in pages:
+        commands = ["BT", "/F1 9 Tf", "11 TL", "40 800 Td"]
+        for line in _wrap(fold_ascii(page))[:70]:
+            commands.append(f"({pdf_string(line)}) Tj T*")
+        commands.append("ET")
+        stream = "\n".join(commands).encode('latin-1', errors='replace')
+        content_id = add_object(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        page_ids.append(add_object(
+            f"<< /Type /Page /Parent {pages_id} 0 R /MediaBox [0 0 595 842] "
+            f"/Resources << /Font << /F1 {font_id} 0 R >> >> /Contents {content_id} 0 R >>".encode()
+        ))
+
+    objects[catalog_id - 1] = f"<< /Type /Catalog /Pages {pages_id} 0 R >>".encode()
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects[pages_id - 1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode()
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, content in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + content + b"\nendobj\n"
+    xref_offset = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root {catalog_id} 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode()
+
+    with open(path, 'wb') as f:
+        f.write(out)
+    return path
+
+
+WRITERS = {"pdf": write_pdf, "docx": write_docx, "txt": write_txt}
+
+
+def generate_document(out_dir, name, fmt, num_pages, seed=0, words_per_page=WORDS_PER_PAGE):
+    """Tạo một file tổng hợp, trả về đường dẫn. fmt: pdf | docx | txt."""
+    if fmt not in WRITERS:
+        raise ValueError(f"Unsupported format: {fmt}")
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f"{name}.{fmt}")
+    return WRITERS[fmt](path, generate_pages(num_pages, words_per_page=words_per_page, seed=seed))
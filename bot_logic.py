@@ -1,24 +1,100 @@
-from RAG_chatbot import rag_bot 
+from RAG_chatbot import rag_bot, LLMErrorMessage
 # Import từ pdf_processor (đúng theo tên file bạn đang dùng)
 from pdf_processor import ContextRetriever 
 from text_processor import TextProcessor
+from embedding import custom_embeddings
+from unified_index import UnifiedDocumentView
+from context_builder import ContextBuilder
+from reranker import reranker, RERANK_ENABLED, RERANK_CANDIDATES, RERANK_TOP_N
+from answer_cache import answer_cache, ANSWER_CACHE_ENABLED
+from doc_summary import is_summary_request, is_short_summary_query, load_summary
 from operator import itemgetter
+import os
+import re
+import metrics
 
 retriever = ContextRetriever("original_text")
 text_processor = TextProcessor()
+context_builder = ContextBuilder(retriever)
+
+# Tìm kiếm lai: kết hợp dense (FAISS) + BM25 không dấu bằng Reciprocal Rank Fusion
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+RRF_K = 60
+
+# Nhãn tên file trong context (xem ContextBuilder / summary_context), dùng khi đổi tên nguồn của câu trả lời cache
+_context_label_pattern = re.compile(r"\[(Thông tin trích từ file|Tóm tắt tài liệu): ([^\]\n]*)\]")
+
+
+def reciprocal_rank_fusion(ranked_lists, rrf_k=RRF_K):
+    """
+    Gộp nhiều danh sách (doc, score, db_name) đã xếp hạng thành một danh sách,
+    điểm mới = tổng 1 / (rrf_k + thứ hạng), càng cao càng liên quan.
+    """
+    fused = {}
+    for ranked in ranked_lists:
+        for rank, (doc, _, db_name) in enumerate(ranked, start=1):
+            key = (db_name, doc.metadata.get('page'), doc.metadata.get('char_start'), doc.page_content)
+            if key not in fused:
+                fused[key] = [doc, 0.0, db_name]
+            fused[key][1] += 1.0 / (rrf_k + rank)
+    return sorted((tuple(item) for item in fused.values()), key=itemgetter(1), reverse=True)
 
 class chatBotMode:
     def __init__(self, vector_dbs: dict = None):
         self.vector_dbs = vector_dbs if vector_dbs is not None else {}
 
-    def process_question(self, user_question: str, selected_pdfs: list = None, chat_history_str: str = ""):
-        
+    def multi_index_search(self, target_dbs: dict, query: str, k: int = 6, threshold: float = None):
+        """
+        Encode câu hỏi MỘT lần rồi tìm trên tất cả các FAISS store bằng cùng một vector.
+        Trả về top-k toàn cục dạng (doc, score, db_name), score càng thấp càng giống.
+        """
+        if not target_dbs:
+            return []
+
+        with metrics.span("embed_query"):
+            query_vector = custom_embeddings.embed_query(query)
+
+        results = []
+        # Các tài liệu nằm trong index hợp nhất được gom lại để search một lần với allow-list
+        unified_groups = {}
+        with metrics.span("vector_search"):
+            for db_name, db in target_dbs.items():
+                if isinstance(db, UnifiedDocumentView):
+                    group = unified_groups.setdefault(id(db.unified_index), (db.unified_index, {}))
+                    group[1][db.doc_id] = db_name
+                    continue
+                docs_scores = db.similarity_search_with_score_by_vector(query_vector, k=k)
+                for doc, score in docs_scores:
+                    if threshold is None or score < threshold:
+                        results.append((doc, score, db_name))
+
+            for unified_index, doc_names in unified_groups.values():
+                for doc, score, doc_id in unified_index.search_by_vector(query_vector, list(doc_names), k=k):
+                    if threshold is None or score < threshold:
+                        results.append((doc, score, doc_names[doc_id]))
+
+        return sorted(results, key=itemgetter(1))[:k]
+
+    def prepare_context(self, user_question: str, selected_pdfs: list = None, stores: dict = None):
+        """
+        Bước 1-3 + xử lý nguồn: lọc DB, tối ưu câu hỏi, tìm kiếm và dựng context.
+        selected_pdfs: danh sách khóa của vector_dbs, hoặc dict {tên hiển thị: khóa (content_id)}.
+        stores: {khóa: store} đã lấy sẵn trong request (không tra lại cache vector_dbs).
+        Trả về {"context", "sources"}; nếu không thể trả lời thì có thêm "response".
+        """
         # --- BƯỚC 1: LỌC VECTOR DB ---
         if not selected_pdfs:
-            target_dbs = self.vector_dbs
+            target_dbs = dict(self.vector_dbs.items())
         else:
-            target_dbs = {name: db for name, db in self.vector_dbs.items() 
-                          if name in selected_pdfs}
+            if not isinstance(selected_pdfs, dict):
+                selected_pdfs = {name: name for name in selected_pdfs}
+            # vector_dbs có thể là cache load lười -> lấy theo khóa thay vì duyệt toàn bộ
+            target_dbs = {}
+            for name, key in selected_pdfs.items():
+                db = stores.get(key) if stores is not None else self.vector_dbs.get(key)
+                if db is not None:
+                    target_dbs[name] = db
 
         if not target_dbs:
             # [FIX] Thêm "context": "" để tránh KeyError
@@ -27,68 +103,50 @@ class chatBotMode:
         # --- BƯỚC 2: TỐI ƯU CÂU HỎI (QUAN TRỌNG CHO CÂU HỎI NGẮN) ---
         search_query = user_question
         
+        # Yêu cầu tóm tắt rõ ràng + có bản tóm tắt dựng sẵn lúc ingest -> trả lời từ đó, không cần tìm kiếm
+        if is_summary_request(user_question):
+            summarized = self.summary_context(target_dbs, selected_pdfs)
+            if summarized is not None:
+                return summarized
+
         # Nếu câu hỏi quá ngắn (dưới 20 ký tự) và chứa từ khóa tóm tắt
-        # Ta thay thế bằng câu query đầy đủ để tìm kiếm hiệu quả hơn
-        if len(user_question.strip()) < 20:
-            keywords = ["tóm tắt", "summary", "chính", "nội dung", "ý chính", "overview"]
-            if any(k in user_question.lower() for k in keywords):
-                search_query = "Tổng hợp nội dung chính, các ý quan trọng nhất và kết luận của tài liệu."
-                print(f"🔄 Đã tối ưu câu hỏi ngắn: '{user_question}' -> '{search_query}'")
+        if is_short_summary_query(user_question):
+            # Ta thay thế bằng câu query đầy đủ để tìm kiếm hiệu quả hơn
+            search_query = "Tổng hợp nội dung chính, các ý quan trọng nhất và kết luận của tài liệu."
+            print(f"🔄 Đã tối ưu câu hỏi ngắn: '{user_question}' -> '{search_query}'")
         
         print(f"🔎 Tìm kiếm với từ khóa: '{search_query}'")
 
         # --- BƯỚC 3: TÌM KIẾM (RETRIEVAL) ---
-        results = []
         # Tăng ngưỡng tìm kiếm lên một chút để chấp nhận nhiều thông tin hơn cho việc tổng hợp
         SIMILARITY_THRESHOLD = 1.8  
 
-        for db_name, db in target_dbs.items():
-            # Tăng k lên 6 để lấy nhiều đoạn văn hơn từ nhiều file (phục vụ tổng hợp)
-            docs_scores = db.similarity_search_with_score(search_query, k=6)
-            for doc, score in docs_scores:
-                if score < SIMILARITY_THRESHOLD: 
-                    results.extend([(doc, score, db_name)])
+        # Tăng k lên 6 để lấy nhiều đoạn văn hơn từ nhiều file (phục vụ tổng hợp)
+        # Dense + BM25 (không dấu) để bắt được số điều khoản, mã sản phẩm, tên riêng...
+        top_n = 6
+        if RERANK_ENABLED:
+            # Lấy dư ứng viên rồi để cross-encoder chọn ít đoạn hơn nhưng chính xác hơn
+            results = self.hybrid_search(target_dbs, search_query, k=RERANK_CANDIDATES, threshold=SIMILARITY_THRESHOLD)
+            with metrics.span("rerank"):
+                results = reranker.rerank(search_query, results, top_n=RERANK_TOP_N)
+            top_n = RERANK_TOP_N
+        else:
+            results = self.hybrid_search(target_dbs, search_query, k=top_n, threshold=SIMILARITY_THRESHOLD)
 
         if not results:
-             # Fallback: Nếu không tìm thấy gì nhưng người dùng muốn tóm tắt, 
-             # thử lấy trang đầu tiên của file đầu tiên làm context (thường là giới thiệu)
-             if "tóm tắt" in search_query.lower() or "nội dung" in search_query.lower():
-                 first_db_name = next(iter(target_dbs))
-                 first_db = target_dbs[first_db_name]
-                 # Tìm kiếm rộng hơn
-                 fallback_docs = first_db.similarity_search_with_score("giới thiệu", k=3)
-                 results.extend([(doc, score, first_db_name) for doc, score in fallback_docs])
-             
-             if not results:
-                return {"response": "Tôi không tìm thấy thông tin nào đủ liên quan trong file bạn upload để trả lời.", "sources": [], "context": ""}
+            return {"response": "Tôi không tìm thấy thông tin nào đủ liên quan trong file bạn upload để trả lời.", "sources": [], "context": ""}
 
         # Lấy top 6 đoạn tốt nhất (đã tăng từ 3 lên 6) để AI có đủ dữ liệu tổng hợp
-        # Sắp xếp theo điểm số (score càng thấp càng giống)
-        top_docs = sorted(results, key=itemgetter(1))[:6]
-
-        metadatas = []
-        expanded_contexts = []
+        # Kết quả tìm kiếm đã được xếp hạng (phần tử đầu liên quan nhất)
+        top_docs = results[:top_n]
 
         for doc, score, db_name in top_docs:
-            file_name = retriever.get_file_name(doc.metadata)
             doc.metadata['source_db'] = db_name
-            metadatas.append(doc.metadata) 
-
-            file_name_remove_accents = text_processor.remove_accents(file_name)
-            expanded_context = retriever.expand_context(file_name_remove_accents, doc.page_content)
-            
-            # Thêm tên file vào context để AI biết thông tin này đến từ đâu -> Giúp tổng hợp tốt hơn
-            context_with_source = f"[Thông tin trích từ file: {db_name}]:\n{expanded_context}"
-            expanded_contexts.append(context_with_source)
 
-        context_str = "\n\n".join(expanded_contexts)
-
-        # --- BƯỚC 4: GỌI AI ---
-        response_text = rag_bot.response(
-            user_question=user_question, # Gửi câu hỏi gốc của người dùng
-            chat_history=chat_history_str,
-            context_data=context_str
-        ).strip()
+        # Gộp các cửa sổ chồng lấn, bỏ đoạn trùng lặp và giới hạn số token của context
+        with metrics.span("context_build"):
+            context_str, used_docs = context_builder.build(top_docs)
+        metadatas = [doc.metadata for doc in used_docs]
 
         # --- BƯỚC 5: XỬ LÝ NGUỒN ---
         sources_list = []
@@ -101,9 +159,182 @@ class chatBotMode:
                 sources_list.append(f"{file_name}")
         
         unique_sources = list(set(sources_list))
-        
+
         return {
-            "response": response_text,
             "context": context_str,
             "sources": unique_sources
-        }
\ No newline at end of file
+        }
+
+    def summary_context(self, target_dbs: dict, selected_pdfs):
+        """
+        Context từ các bản tóm tắt dựng sẵn lúc ingest. Một tài liệu -> trả luôn bản tóm tắt (có "response"),
+        nhiều tài liệu -> context gồm các bản tóm tắt để LLM tổng hợp bằng một lời gọi nhỏ.
+        Trả về None nếu có tài liệu chưa có bản tóm tắt (dùng tìm kiếm như bình thường).
+        """
+        summaries = {}
+        for name in target_dbs:
+            tree = load_summary(selected_pdfs[name] if selected_pdfs else name)
+            if tree is None:
+                return None
+            summaries[name] = tree["document"]
+
+        sources = list(summaries)
+        if len(summaries) == 1:
+            summary = summaries[sources[0]]
+            return {"response": summary, "context": summary, "sources": sources}
+        context_str = "\n\n".join(f"[Tóm tắt tài liệu: {name}]\n{summary}" for name, summary in summaries.items())
+        return {"context": context_str, "sources": sources}
+
+    def lexical_search(self, target_dbs: dict, query: str, k: int = HYBRID_CANDIDATES):
+        """Tìm BM25 (không phân biệt dấu) trên các store. Trả về (doc, điểm BM25, db_name), điểm cao trước."""
+        results = []
+        unified_groups = {}
+        with metrics.span("lexical_search"):
+            for db_name, db in target_dbs.items():
+                if isinstance(db, UnifiedDocumentView):
+                    group = unified_groups.setdefault(id(db.unified_index), (db.unified_index, {}))
+                    group[1][db.doc_id] = db_name
+                    continue
+                lexical_index = getattr(db, 'lexical_index', None)
+                if lexical_index is None:
+                    continue
+                for chunk_id, score in lexical_index.search(query, k=k):
+                    results.append((db.docstore.search(chunk_id), score, db_name))
+
+            for unified_index, doc_names in unified_groups.values():
+                for doc, score, doc_id in unified_index.lexical_search(query, list(doc_names), k=k):
+                    results.append((doc, score, doc_names[doc_id]))
+
+        return sorted(results, key=itemgetter(1), reverse=True)[:k]
+
+    def hybrid_search(self, target_dbs: dict, query: str, k: int = 6, threshold: float = None):
+        """Dense + BM25 hợp nhất bằng RRF. Kết quả đã xếp hạng, phần tử đầu liên quan nhất."""
+        if not HYBRID_SEARCH:
+            return self.multi_index_search(target_dbs, query, k=k, threshold=threshold)
+
+        dense = self.multi_index_search(target_dbs, query, k=max(k, HYBRID_CANDIDATES), threshold=threshold)
+        lexical = self.lexical_search(target_dbs, query, k=max(k, HYBRID_CANDIDATES))
+        return reciprocal_rank_fusion([dense, lexical])[:k]
+
+    @staticmethod
+    def _content_ids(selected_pdfs):
+        # Khóa cache là tập content_id (dict) hoặc tên store (list); không chọn file -> không cache
+        if not selected_pdfs:
+            return None
+        return list(selected_pdfs.values()) if isinstance(selected_pdfs, dict) else list(selected_pdfs)
+
+    @staticmethod
+    def _source_names(selected_pdfs):
+        # {content_id: tên hiển thị trong session}; danh sách -> khóa chính là tên
+        if isinstance(selected_pdfs, dict):
+            return {key: name for name, key in selected_pdfs.items()}
+        return {key: key for key in selected_pdfs}
+
+    def _rename_sources(self, cached, selected_pdfs):
+        """
+        Câu trả lời cache có thể đến từ session khác: đổi tên file (nguồn, nhãn trong context) sang tên
+        mà session hiện tại đặt cho cùng tài liệu, không lộ tên file của người dùng khác.
+        """
+        current = self._source_names(selected_pdfs)
+        renames = {old: current[cid] for cid, old in cached.pop("source_names", {}).items() if cid in current}
+        sources = []
+        for source in cached.get("sources", []):
+            for old, new in renames.items():
+                if source == old or source.startswith(f"{old} (Trang "):
+                    source = new + source[len(old):]
+                    break
+            sources.append(source)
+        cached["sources"] = sources
+        cached["context"] = _context_label_pattern.sub(
+            lambda m: f"[{m.group(1)}: {renames.get(m.group(2), m.group(2))}]", cached.get("context", ""))
+        return cached
+
+    def cached_answer(self, user_question: str, selected_pdfs=None):
+        """
+        Tra cache câu trả lời theo embedding câu hỏi + bộ tài liệu. Chỉ dùng khi chưa có lịch sử chat
+        (câu trả lời phụ thuộc vào lịch sử). Trả về kết quả như process_question (thêm 'cached') hoặc None.
+        """
+        content_ids = self._content_ids(selected_pdfs)
+        if not ANSWER_CACHE_ENABLED or not content_ids:
+            return None
+        with metrics.span("answer_cache"):
+            query_vector = custom_embeddings.embed_query(user_question)
+            cached = answer_cache.lookup(query_vector, content_ids, user_question)
+        if cached is not None:
+            print(f"⚡ Dùng câu trả lời đã cache cho: '{user_question}' (giống '{cached['cached_question']}')")
+            self._rename_sources(cached, selected_pdfs)
+            cached["cached"] = True
+        return cached
+
+    def remember_answer(self, user_question: str, selected_pdfs, result: dict):
+        """Lưu câu trả lời do LLM sinh ra (không gọi khi LLM lỗi, xem LLMErrorMessage)."""
+        content_ids = self._content_ids(selected_pdfs)
+        # Không lưu câu trả lời rỗng / các thông báo không dựa trên context (chưa chọn file, không tìm thấy...)
+        if not ANSWER_CACHE_ENABLED or not content_ids or not result.get("context") or not result.get("response"):
+            return
+        result = dict(result, source_names=self._source_names(selected_pdfs))
+        answer_cache.put(custom_embeddings.embed_query(user_question), content_ids, user_question, result)
+
+    def process_question(self, user_question: str, selected_pdfs: list = None, chat_history_str: str = "", stores: dict = None):
+        if not chat_history_str:
+            cached = self.cached_answer(user_question, selected_pdfs)
+            if cached is not None:
+                return cached
+
+        prepared = self.prepare_context(user_question, selected_pdfs, stores)
+        if "response" in prepared:
+            return prepared
+
+        # --- BƯỚC 4: GỌI AI ---
+        response_text = rag_bot.response(
+            user_question=user_question, # Gửi câu hỏi gốc của người dùng
+            chat_history=chat_history_str,
+            context_data=prepared["context"]
+        )
+
+        result = {
+            "response": response_text.strip(),
+            "context": prepared["context"],
+            "sources": prepared["sources"]
+        }
+        if not chat_history_str and not isinstance(response_text, LLMErrorMessage):
+            self.remember_answer(user_question, selected_pdfs, result)
+        return result
+
+    def stream_question(self, user_question: str, selected_pdfs: list = None, chat_history_str: str = "", stores: dict = None):
+        """
+        Phiên bản streaming của process_question.
+        Yield ("token", text) cho từng đoạn câu trả lời, cuối cùng yield ("end", result) giống process_question.
+        """
+        if not chat_history_str:
+            cached = self.cached_answer(user_question, selected_pdfs)
+            if cached is not None:
+                yield ("token", cached["response"])
+                yield ("end", cached)
+                return
+
+        prepared = self.prepare_context(user_question, selected_pdfs, stores)
+        if "response" in prepared:
+            yield ("token", prepared["response"])
+            yield ("end", prepared)
+            return
+
+        parts = []
+        failed = False
+        for token in rag_bot.stream_response(
+            user_question=user_question,
+            chat_history=chat_history_str,
+            context_data=prepared["context"]
+        ):
+            failed = failed or isinstance(token, LLMErrorMessage)
+            parts.append(token)
+            yield ("token", token)
+
+        result = {
+            "response": "".join(parts).strip(),
+            "context": prepared["context"],
+            "sources": prepared["sources"]
+        }
+        if not chat_history_str and not failed:
+            self.remember_answer(user_question, selected_pdfs, result)
+        yield ("end", result)
@@ -0,0 +1,113 @@
+import os
+import re
+from RAG_chatbot import count_tokens
+from text_processor import TextProcessor
+
+# Giới hạn token cho phần Context trong prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Số ký tự mở rộng về mỗi phía của chunk (tương đương expand_context: 150 từ * 5)
+CONTEXT_WINDOW_CHARS = 750
+# Hai cửa sổ cách nhau không quá số ký tự này được coi là liền kề và gộp lại
+MERGE_GAP_CHARS = 50
+# Độ trùng lặp (Jaccard trên 5-gram từ) để coi hai đoạn là gần giống nhau
+NEAR_DUPLICATE_THRESHOLD = 0.8
+
+text_processor = TextProcessor()
+_word_pattern = re.compile(r"\w+", re.UNICODE)
+
+
+def shingles(text, size=5):
+    words = _word_pattern.findall(text_processor.fold_for_search(text))
+    if len(words) <= size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def is_near_duplicate(candidate, selected, threshold=NEAR_DUPLICATE_THRESHOLD):
+    for other in selected:
+        if not candidate or not other:
+            continue
+        overlap = len(candidate & other) / len(candidate | other)
+        if overlap >= threshold:
+            return True
+    return False
+
+
+class ContextBuilder:
+    """
+    Dựng Context cho prompt từ các chunk đã xếp hạng: gộp các cửa sổ chồng lấn / liền kề trong
+    cùng một file, bỏ đoạn gần trùng lặp và lấp đầy ngân sách token theo thứ tự xếp hạng.
+    """
+    def __init__(self, retriever, token_budget=CONTEXT_TOKEN_BUDGET, window_chars=CONTEXT_WINDOW_CHARS):
+        self.retriever = retriever
+        self.token_budget = token_budget
+        self.window_chars = window_chars
+
+    def _collect_windows(self, top_docs):
+        """Trả về danh sách passage: {rank, db_name, text, docs, start, end}."""
+        passages = []
+        windows_by_file = {}
+        for rank, (doc, _, db_name) in enumerate(top_docs):
+            file_name = text_processor.remove_accents(self.retriever.get_file_name(doc.metadata))
+            all_text, idx = self.retriever.locate_chunk(
+                file_name, doc.page_content,
+                char_start=doc.metadata.get('char_start'), char_end=doc.metadata.get('char_end')
+            )
+            if idx == -1:
+                # Không tìm thấy trong original_text -> dùng nguyên chunk
+                passages.append({"rank": rank, "db_name": db_name, "text": doc.page_content, "docs": [doc]})
+                continue
+            start = max(0, idx - self.window_chars)
+            end = min(len(all_text), idx + len(doc.page_content) + self.window_chars)
+            windows_by_file.setdefault((db_name, file_name), (all_text, []))[1].append((start, end, rank, doc))
+
+        for (db_name, _), (all_text, windows) in windows_by_file.items():
+            windows.sort(key=lambda w: w[0])
+            merged = []
+            for start, end, rank, doc in windows:
+                if merged and start <= merged[-1]["end"] + MERGE_GAP_CHARS:
+                    last = merged[-1]
+                    last["end"] = max(last["end"], end)
+                    last["rank"] = min(last["rank"], rank)
+                    last["docs"].append(doc)
+                else:
+                    merged.append({"start": start, "end": end, "rank": rank, "docs": [doc]})
+            for window in merged:
+                passages.append({
+                    "rank": window["rank"],
+                    "db_name": db_name,
+                    "text": "..." + all_text[window["start"]:window["end"]] + "...",
+                    "docs": window["docs"],
+                })
+
+        passages.sort(key=lambda p: p["rank"])
+        return passages
+
+    def build(self, top_docs):
+        """Trả về (context_str, danh sách doc thực sự có mặt trong context)."""
+        selected_texts = []
+        selected_shingles = []
+        used_docs = []
+        used_tokens = 0
+
+        for passage in self._collect_windows(top_docs):
+            passage_shingles = shingles(passage["text"])
+            if is_near_duplicate(passage_shingles, selected_shingles):
+                continue
+
+            # Thêm tên file vào context để AI biết thông tin này đến từ đâu -> Giúp tổng hợp tốt hơn
+            text = f"[Thông tin trích từ file: {passage['db_name']}]:\n{passage['text']}"
+            tokens = count_tokens(text)
+            if used_tokens + tokens > self.token_budget:
+                if selected_texts:
+                    continue
+                # Đoạn tốt nhất đã vượt ngân sách -> cắt bớt theo tỉ lệ để vẫn có context
+                text = text[:int(len(text) * self.token_budget / tokens)]
+                tokens = count_tokens(text)
+
+            selected_texts.append(text)
+            selected_shingles.append(passage_shingles)
+            used_docs.extend(passage["docs"])
+            used_tokens += tokens
+
+        return "\n\n".join(selected_texts), used_docs
@@ -0,0 +1,101 @@
+import os
+import time
+import threading
+import database as db
+import metrics
+from RAG_chatbot import rag_bot, count_tokens
+
+# Ngân sách token cho phần "Lịch sử chat" trong prompt
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+# Phần ngân sách dành cho bản tóm tắt các lượt cũ (phần còn lại giữ nguyên văn các lượt gần nhất)
+HISTORY_SUMMARY_RATIO = 0.3
+# Tóm tắt lỗi (LLM không trả lời) -> chờ bấy nhiêu giây mới thử lại cho session đó, không gọi lại ở mọi request
+HISTORY_SUMMARY_RETRY_SECONDS = float(os.getenv("HISTORY_SUMMARY_RETRY_SECONDS", "300"))
+
+_summary_failures = {}  # session_id -> thời điểm tóm tắt lỗi gần nhất
+_summary_failures_lock = threading.Lock()
+
+SOURCES_MARKER = "\n\n**Nguồn tham khảo:**"
+
+
+def format_turn(turn):
+    # Bỏ phần "Nguồn tham khảo" đã gắn vào câu trả lời, không cần cho ngữ cảnh hội thoại
+    bot_response = (turn["bot_response"] or "").split(SOURCES_MARKER)[0]
+    return f"User: {turn['user_query']}\nBot: {bot_response}"
+
+
+def has_history(session_id):
+    """Session đã có lượt chat (hoặc bản tóm tắt) nào chưa."""
+    if not session_id:
+        return False
+    summary, summarized_until = db.get_session_summary(session_id)
+    return bool(summary) or bool(db.get_history_turns(session_id, after_id=summarized_until))
+
+
+def build_history(session_id, token_budget=HISTORY_TOKEN_BUDGET):
+    """
+    Dựng lịch sử chat cho prompt từ bảng history trong giới hạn token:
+    các lượt gần nhất giữ nguyên văn, các lượt cũ hơn được gộp vào bản tóm tắt lưu theo session.
+    """
+    if not session_id:
+        return ""
+    with metrics.span("history"):
+        return _build_history(session_id, token_budget)
+
+
+def _summary_backoff(session_id):
+    """Session vừa tóm tắt lỗi và chưa hết thời gian chờ thử lại."""
+    with _summary_failures_lock:
+        failed_at = _summary_failures.get(session_id)
+        if failed_at is None:
+            return False
+        if time.time() - failed_at < HISTORY_SUMMARY_RETRY_SECONDS:
+            return True
+        del _summary_failures[session_id]
+        return False
+
+
+def _record_summary_failure(session_id):
+    with _summary_failures_lock:
+        _summary_failures[session_id] = time.time()
+
+
+def _build_history(session_id, token_budget):
+
+    summary, summarized_until = db.get_session_summary(session_id)
+    turns = db.get_history_turns(session_id, after_id=summarized_until)
+    formatted = [format_turn(turn) for turn in turns]
+    costs = [count_tokens(text) for text in formatted]
+
+    summary_budget = int(token_budget * HISTORY_SUMMARY_RATIO)
+    recent_budget = token_budget - min(count_tokens(summary), summary_budget)
+
+    if sum(costs) > recent_budget:
+        # Khi vượt ngân sách chỉ giữ các lượt vừa nửa ngân sách -> không phải tóm tắt lại sau mỗi lượt mới
+        keep_from = len(turns)
+        used = 0
+        while keep_from > 0 and used + costs[keep_from - 1] <= recent_budget // 2:
+            keep_from -= 1
+            used += costs[keep_from]
+
+        older = turns[:keep_from]
+        if older:
+            new_summary = None
+            if not _summary_backoff(session_id):
+                new_summary = rag_bot.summarize_history(
+                    summary, "\n\n".join(formatted[:keep_from]),
+                    max_words=max(50, summary_budget // 2)
+                )
+                if not new_summary:
+                    _record_summary_failure(session_id)
+            if new_summary:
+                summary = new_summary
+                db.save_session_summary(session_id, summary, older[-1]["id"])
+            # Không tóm tắt được (hoặc đang chờ thử lại) thì bỏ các lượt cũ khỏi prompt để giữ kích thước giới hạn
+            formatted = formatted[keep_from:]
+
+    parts = []
+    if summary:
+        parts.append(f"Tóm tắt các lượt trò chuyện trước:\n{summary}")
+    parts.extend(formatted)
+    return "\n\n".join(parts)
@@ -1,124 +1,407 @@
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 
 DB_NAME = "chat_history.db"
 
+# Mỗi thread giữ một connection riêng (sqlite3 connection không dùng chung giữa các thread được)
+_local = threading.local()
+
+# --- MIGRATIONS ---
+# Mỗi phần tử là một bước nâng cấp schema, áp dụng theo thứ tự dựa trên PRAGMA user_version.
+MIGRATIONS = [
+    # 1. Các bảng gốc
+    '''
+    CREATE TABLE IF NOT EXISTS history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        user_query TEXT,
+        bot_response TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id TEXT PRIMARY KEY,
+        title TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS session_files (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        file_path TEXT,
+        uploaded_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    ''',
+    # 2. Index theo session_id + ràng buộc (session_id, filename) duy nhất
+    '''
+    DELETE FROM session_files WHERE id NOT IN (
+        SELECT MIN(id) FROM session_files GROUP BY session_id, filename
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_session_files_session_filename ON session_files (session_id, filename);
+    CREATE INDEX IF NOT EXISTS idx_history_session ON history (session_id, timestamp, id);
+    CREATE INDEX IF NOT EXISTS idx_sessions_created_at ON sessions (created_at);
+    ''',
+    # 3. Tóm tắt cuốn chiếu của các lượt chat cũ (bộ nhớ hội thoại phía server)
+    '''
+    CREATE TABLE IF NOT EXISTS session_summaries (
+        session_id TEXT PRIMARY KEY,
+        summary TEXT NOT NULL,
+        summarized_until INTEGER NOT NULL,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    ''',
+    # 4. Registry tài liệu theo nội dung (sha256), tên file trong session trỏ tới content_id dùng chung
+    '''
+    CREATE TABLE IF NOT EXISTS documents (
+        content_id TEXT PRIMARY KEY,
+        store_name TEXT NOT NULL,
+        original_name TEXT NOT NULL,
+        size_bytes INTEGER,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    ALTER TABLE session_files ADD COLUMN content_id TEXT;
+    CREATE INDEX IF NOT EXISTS idx_session_files_content ON session_files (content_id);
+    ''',
+    # 5. Phiên bản tài liệu: bản cập nhật trỏ về bản trước (parent_content_id)
+    '''
+    ALTER TABLE documents ADD COLUMN parent_content_id TEXT;
+    ALTER TABLE documents ADD COLUMN version INTEGER NOT NULL DEFAULT 1;
+    ''',
+    # 6. Thời điểm tài liệu không còn session nào tham chiếu (dùng cho GC sau thời gian chờ)
+    '''
+    ALTER TABLE documents ADD COLUMN unreferenced_since DATETIME;
+    ''',
+    # 7. Trạng thái job ingest (/upload -> /upload_status), dùng chung giữa các worker
+    '''
+    CREATE TABLE IF NOT EXISTS ingest_jobs (
+        job_id TEXT PRIMARY KEY,
+        session_id TEXT,
+        filename TEXT NOT NULL,
+        stage TEXT NOT NULL,
+        error TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        finished_at DATETIME
+    );
+    CREATE INDEX IF NOT EXISTS idx_ingest_jobs_session ON ingest_jobs (session_id, created_at);
+    ''',
+]
+
+
+def get_connection():
+    """Connection dùng lại theo thread, bật WAL để đọc không bị chặn khi đang ghi."""
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(DB_NAME)
+    if conn is None:
+        conn = sqlite3.connect(DB_NAME, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        connections[DB_NAME] = conn
+    return conn
+
+
+@contextmanager
+def transaction():
+    """Commit khi thành công, rollback khi có lỗi."""
+    conn = get_connection()
+    with conn:
+        yield conn
+
+
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    
-    # 1. Bảng lịch sử chat
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT NOT NULL,
-            user_query TEXT,
-            bot_response TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # 2. Bảng danh sách sessions
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS sessions (
-            session_id TEXT PRIMARY KEY,
-            title TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # 3. [MỚI] Bảng liên kết Session - File
-    # Bảng này giúp nhớ: Session A có những file nào.
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS session_files (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            session_id TEXT NOT NULL,
-            filename TEXT NOT NULL,
-            file_path TEXT,
-            uploaded_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for target_version, script in enumerate(MIGRATIONS, start=1):
+        if version >= target_version:
+            continue
+        # Cả bước migrate + cập nhật version chạy trong một transaction
+        conn.executescript(f"BEGIN; {script} PRAGMA user_version = {target_version}; COMMIT;")
+        print(f"Database migrated to version {target_version}.")
 
 # --- CÁC HÀM CHO SESSION FILES ---
-def add_file_to_session(session_id, filename, file_path):
-    """Gắn một file vào session cụ thể"""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    # Kiểm tra xem file đã có trong session này chưa để tránh trùng
-    c.execute("SELECT id FROM session_files WHERE session_id = ? AND filename = ?", (session_id, filename))
-    if c.fetchone() is None:
-        c.execute("INSERT INTO session_files (session_id, filename, file_path) VALUES (?, ?, ?)", 
-                  (session_id, filename, file_path))
-    conn.commit()
-    conn.close()
+def add_file_to_session(session_id, filename, file_path, content_id=None):
+    """Gắn một file vào session cụ thể (upload lại cùng tên -> trỏ sang nội dung mới)"""
+    with transaction() as conn:
+        # Ràng buộc UNIQUE (session_id, filename)
+        conn.execute(
+            "INSERT INTO session_files (session_id, filename, file_path, content_id) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (session_id, filename) DO UPDATE SET file_path = excluded.file_path, "
+            "content_id = COALESCE(excluded.content_id, session_files.content_id)",
+            (session_id, filename, file_path, content_id)
+        )
+        # Tài liệu được tham chiếu lại -> đếm lại thời gian chờ GC từ đầu
+        conn.execute("UPDATE documents SET unreferenced_since = NULL WHERE content_id = ?", (content_id,))
+
+def link_existing_document(session_id, filename, file_path, content_id):
+    """
+    Gắn file vào session chỉ khi tài liệu còn trong registry. Kiểm tra và ghi trong cùng một câu lệnh
+    nên GC (remove_unreferenced_document) không xóa chen vào giữa được. Trả về True nếu đã gắn.
+    """
+    with transaction() as conn:
+        cursor = conn.execute(
+            "INSERT INTO session_files (session_id, filename, file_path, content_id) "
+            "SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM documents WHERE content_id = ?) "
+            "ON CONFLICT (session_id, filename) DO UPDATE SET file_path = excluded.file_path, "
+            "content_id = excluded.content_id",
+            (session_id, filename, file_path, content_id, content_id)
+        )
+        if cursor.rowcount == 0:
+            return False
+        conn.execute("UPDATE documents SET unreferenced_since = NULL WHERE content_id = ?", (content_id,))
+    return True
 
 def get_files_by_session(session_id):
     """Lấy danh sách file của một session"""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT filename FROM session_files WHERE session_id = ?", (session_id,))
-    rows = c.fetchall()
-    conn.close()
+    rows = get_connection().execute(
+        "SELECT filename FROM session_files WHERE session_id = ? ORDER BY id", (session_id,)
+    ).fetchall()
     return [row['filename'] for row in rows]
 
+def get_session_documents(session_id):
+    """Các file của session kèm content_id: [(filename, content_id, file_path)] theo thứ tự upload."""
+    rows = get_connection().execute(
+        "SELECT filename, content_id, file_path FROM session_files WHERE session_id = ? ORDER BY id", (session_id,)
+    ).fetchall()
+    return [(row['filename'], row['content_id'], row['file_path']) for row in rows]
+
+def get_unlinked_session_files():
+    """Dòng session_files cũ chưa gắn được content_id: [{session_id, filename, file_path}]."""
+    rows = get_connection().execute(
+        "SELECT session_id, filename, file_path FROM session_files WHERE content_id IS NULL ORDER BY id"
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+def set_session_file_content(session_id, filename, content_id):
+    """Gắn content_id cho một dòng session_files cũ (chỉ khi dòng đó chưa có content_id)."""
+    with transaction() as conn:
+        conn.execute("UPDATE session_files SET content_id = ? WHERE session_id = ? AND filename = ? "
+                     "AND content_id IS NULL", (content_id, session_id, filename))
+        conn.execute("UPDATE documents SET unreferenced_since = NULL WHERE content_id = ?", (content_id,))
+
+def get_session_file(session_id, filename):
+    """content_id mà tên file trong session đang trỏ tới (None nếu chưa có)."""
+    row = get_connection().execute(
+        "SELECT content_id FROM session_files WHERE session_id = ? AND filename = ?", (session_id, filename)
+    ).fetchone()
+    return row['content_id'] if row else None
+
 def remove_file_from_session(session_id, filename):
     """Gỡ file khỏi session (nhưng không xóa file gốc trên đĩa nếu session khác đang dùng)"""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("DELETE FROM session_files WHERE session_id = ? AND filename = ?", (session_id, filename))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("DELETE FROM session_files WHERE session_id = ? AND filename = ?", (session_id, filename))
 
 def delete_session(session_id):
     """Xóa toàn bộ dữ liệu của session"""
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("DELETE FROM history WHERE session_id = ?", (session_id,))
-    c.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
-    c.execute("DELETE FROM session_files WHERE session_id = ?", (session_id,)) # Xóa liên kết file
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        conn.execute("DELETE FROM history WHERE session_id = ?", (session_id,))
+        conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        conn.execute("DELETE FROM session_files WHERE session_id = ?", (session_id,)) # Xóa liên kết file
+        conn.execute("DELETE FROM session_summaries WHERE session_id = ?", (session_id,))
 
 # --- CÁC HÀM CŨ (GIỮ NGUYÊN) ---
 def save_message(session_id, user_query, bot_response):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT session_id FROM sessions WHERE session_id = ?", (session_id,))
-    if c.fetchone() is None:
-        short_title = (user_query[:47] + '...') if len(user_query) > 47 else user_query
-        c.execute("INSERT INTO sessions (session_id, title) VALUES (?, ?)", (session_id, short_title))
-    c.execute("INSERT INTO history (session_id, user_query, bot_response) VALUES (?, ?, ?)",
-              (session_id, user_query, bot_response))
-    conn.commit()
-    conn.close()
+    short_title = (user_query[:47] + '...') if len(user_query) > 47 else user_query
+    with transaction() as conn:
+        conn.execute("INSERT OR IGNORE INTO sessions (session_id, title) VALUES (?, ?)", (session_id, short_title))
+        conn.execute("INSERT INTO history (session_id, user_query, bot_response) VALUES (?, ?, ?)",
+                     (session_id, user_query, bot_response))
 
 def get_history(session_id):
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT user_query, bot_response FROM history WHERE session_id = ? ORDER BY timestamp ASC", (session_id,))
-    rows = c.fetchall()
-    conn.close()
+    rows = get_connection().execute(
+        "SELECT user_query, bot_response FROM history WHERE session_id = ? ORDER BY timestamp ASC, id ASC",
+        (session_id,)
+    ).fetchall()
     history = []
     for row in rows:
         history.append({"role": "user", "content": row["user_query"]})
         history.append({"role": "bot", "content": row["bot_response"]})
     return history
 
+def get_history_turns(session_id, after_id=0):
+    """Các lượt chat (id, user_query, bot_response) có id > after_id, cũ nhất trước."""
+    rows = get_connection().execute(
+        "SELECT id, user_query, bot_response FROM history WHERE session_id = ? AND id > ? ORDER BY timestamp ASC, id ASC",
+        (session_id, after_id)
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+# --- TÓM TẮT HỘI THOẠI ---
+def get_session_summary(session_id):
+    """Trả về (summary, id lượt chat cuối cùng đã được tóm tắt)."""
+    row = get_connection().execute(
+        "SELECT summary, summarized_until FROM session_summaries WHERE session_id = ?", (session_id,)
+    ).fetchone()
+    if row is None:
+        return "", 0
+    return row["summary"], row["summarized_until"]
+
+def save_session_summary(session_id, summary, summarized_until):
+    with transaction() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO session_summaries (session_id, summary, summarized_until, updated_at) "
+            "VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+            (session_id, summary, summarized_until)
+        )
+
 def get_all_sessions():
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT session_id, title FROM sessions ORDER BY created_at DESC")
-    rows = c.fetchall()
-    conn.close()
+    rows = get_connection().execute("SELECT session_id, title FROM sessions ORDER BY created_at DESC").fetchall()
     return [{"session_id": row["session_id"], "title": row["title"]} for row in rows]
 
 def clear_history(session_id):
     delete_session(session_id)
 
-init_db()
\ No newline at end of file
+# --- REGISTRY TÀI LIỆU (theo content_id = sha256 nội dung file) ---
+DOCUMENT_COLUMNS = "content_id, store_name, original_name, size_bytes, parent_content_id, version"
+
+def get_document(content_id):
+    row = get_connection().execute(
+        f"SELECT {DOCUMENT_COLUMNS} FROM documents WHERE content_id = ?", (content_id,)
+    ).fetchone()
+    return dict(row) if row else None
+
+def add_document(content_id, store_name, original_name, size_bytes=None, parent_content_id=None, version=1):
+    with transaction() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO documents (content_id, store_name, original_name, size_bytes, parent_content_id, version) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (content_id, store_name, original_name, size_bytes, parent_content_id, version)
+        )
+
+def get_document_versions(content_id):
+    """Chuỗi phiên bản của tài liệu, từ bản hiện tại lùi về bản đầu tiên (dừng ở bản đã bị xóa)."""
+    rows = get_connection().execute(
+        f"""
+        WITH RECURSIVE chain(cid, depth) AS (
+            SELECT ?, 0
+            UNION ALL
+            SELECT d.parent_content_id, chain.depth + 1 FROM documents d JOIN chain ON d.content_id = chain.cid
+            WHERE d.parent_content_id IS NOT NULL AND chain.depth < 1000
+        )
+        SELECT {DOCUMENT_COLUMNS} FROM documents JOIN chain ON documents.content_id = chain.cid ORDER BY chain.depth
+        """, (content_id,)
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+def get_document_by_store_name(store_name):
+    row = get_connection().execute(
+        f"SELECT {DOCUMENT_COLUMNS} FROM documents WHERE store_name = ? ORDER BY created_at DESC LIMIT 1",
+        (store_name,)
+    ).fetchone()
+    return dict(row) if row else None
+
+def remove_document(content_id):
+    with transaction() as conn:
+        conn.execute("DELETE FROM documents WHERE content_id = ?", (content_id,))
+
+def get_all_documents():
+    rows = get_connection().execute(
+        f"SELECT {DOCUMENT_COLUMNS} FROM documents ORDER BY created_at"
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+def clear_documents():
+    with transaction() as conn:
+        conn.execute("DELETE FROM documents")
+
+# --- ĐẾM THAM CHIẾU / GC ---
+def count_document_references(content_id):
+    """Số dòng session_files đang trỏ tới tài liệu."""
+    return get_connection().execute(
+        "SELECT COUNT(*) FROM session_files WHERE content_id = ?", (content_id,)
+    ).fetchone()[0]
+
+def get_document_reference_counts():
+    """Số tham chiếu của mọi tài liệu trong registry: {content_id: số dòng session_files}."""
+    rows = get_connection().execute(
+        "SELECT d.content_id, COUNT(sf.id) AS refs FROM documents d "
+        "LEFT JOIN session_files sf ON sf.content_id = d.content_id GROUP BY d.content_id"
+    ).fetchall()
+    return {row['content_id']: row['refs'] for row in rows}
+
+def mark_unreferenced_documents():
+    """
+    Cập nhật dấu unreferenced_since: bỏ dấu của tài liệu được tham chiếu lại, đánh dấu tài liệu vừa mất tham chiếu.
+    Trả về danh sách content_id vừa được đánh dấu.
+    """
+    referenced = "SELECT content_id FROM session_files WHERE content_id IS NOT NULL"
+    with transaction() as conn:
+        conn.execute(f"UPDATE documents SET unreferenced_since = NULL "
+                     f"WHERE unreferenced_since IS NOT NULL AND content_id IN ({referenced})")
+        rows = conn.execute(f"SELECT content_id FROM documents "
+                            f"WHERE unreferenced_since IS NULL AND content_id NOT IN ({referenced})").fetchall()
+        conn.executemany("UPDATE documents SET unreferenced_since = CURRENT_TIMESTAMP WHERE content_id = ?",
+                         [(row['content_id'],) for row in rows])
+    return [row['content_id'] for row in rows]
+
+def remove_unreferenced_document(content_id):
+    """Xóa tài liệu khỏi registry nếu không còn dòng session_files nào trỏ tới (một câu lệnh). True nếu đã xóa."""
+    with transaction() as conn:
+        cursor = conn.execute(
+            "DELETE FROM documents WHERE content_id = ? "
+            "AND NOT EXISTS (SELECT 1 FROM session_files WHERE content_id = ?)",
+            (content_id, content_id)
+        )
+    return cursor.rowcount > 0
+
+def get_collectable_documents(grace_seconds):
+    """Tài liệu đã không được tham chiếu lâu hơn grace_seconds."""
+    rows = get_connection().execute(
+        f"SELECT {DOCUMENT_COLUMNS} FROM documents WHERE unreferenced_since IS NOT NULL "
+        "AND unreferenced_since <= datetime('now', ?) ORDER BY unreferenced_since",
+        (f"-{int(grace_seconds)} seconds",)
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+# --- JOB INGEST ---
+INGEST_JOB_COLUMNS = "job_id, filename, stage, error"
+
+def add_ingest_job(job_id, session_id, filename, stage):
+    with transaction() as conn:
+        conn.execute("INSERT INTO ingest_jobs (job_id, session_id, filename, stage) VALUES (?, ?, ?, ?)",
+                     (job_id, session_id, filename, stage))
+
+def set_ingest_job_stage(job_id, stage, error=None, finished=False):
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE ingest_jobs SET stage = ?, error = ?, "
+            "finished_at = CASE WHEN ? THEN CURRENT_TIMESTAMP ELSE finished_at END WHERE job_id = ?",
+            (stage, error, finished, job_id)
+        )
+
+def get_ingest_jobs(job_ids=None, session_id=None):
+    """Trạng thái các job theo job_ids (giữ thứ tự yêu cầu) và / hoặc session_id: [{job_id, filename, stage, error}]."""
+    query = f"SELECT {INGEST_JOB_COLUMNS} FROM ingest_jobs"
+    conditions, params = [], []
+    if job_ids is not None:
+        if not job_ids:
+            return []
+        conditions.append(f"job_id IN ({', '.join('?' * len(job_ids))})")
+        params.extend(job_ids)
+    if session_id is not None:
+        conditions.append("session_id = ?")
+        params.append(session_id)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    rows = get_connection().execute(query + " ORDER BY created_at, rowid", params).fetchall()
+    jobs = [dict(row) for row in rows]
+    if job_ids is not None:
+        order = {job_id: i for i, job_id in enumerate(job_ids)}
+        jobs.sort(key=lambda job: order[job['job_id']])
+    return jobs
+
+def prune_ingest_jobs(retention_seconds):
+    """Xóa các job đã xong lâu hơn retention_seconds."""
+    with transaction() as conn:
+        conn.execute("DELETE FROM ingest_jobs WHERE finished_at IS NOT NULL AND finished_at <= datetime('now', ?)",
+                     (f"-{int(retention_seconds)} seconds",))
+
+def link_session_files_by_name(original_name, content_id):
+    """Gán content_id cho các dòng session_files cũ (trước khi có registry) cùng tên file."""
+    with transaction() as conn:
+        conn.execute("UPDATE session_files SET content_id = ? WHERE filename = ? AND content_id IS NULL",
+                     (content_id, original_name))
+
+init_db()
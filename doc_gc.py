@@ -0,0 +1,231 @@
+import os
+import time
+import shutil
+import threading
+from contextlib import contextmanager
+import database
+import metrics
+from unified_index import UNIFIED_INDEX_DIR
+from doc_summary import SUMMARY_DIR, summary_path
+
+# Dọn tài liệu không còn session nào dùng (chạy nền định kỳ)
+DOCUMENT_GC = os.getenv("DOCUMENT_GC", "1") == "1"
+DOCUMENT_GC_INTERVAL_SECONDS = float(os.getenv("DOCUMENT_GC_INTERVAL_SECONDS", "3600"))
+# Thời gian chờ trước khi xóa trên đĩa (người dùng có thể upload lại / mở lại session trong khoảng này)
+DOCUMENT_GC_GRACE_SECONDS = float(os.getenv("DOCUMENT_GC_GRACE_SECONDS", str(24 * 3600)))
+
+ORIGINAL_TEXT_DIR = "original_text"
+# File khóa (trong thư mục vectorstores): mỗi worker gunicorn có thread GC riêng, chỉ một process dọn tại một thời điểm
+GC_LOCK_FILE = ".gc.lock"
+
+try:
+    import fcntl
+except ImportError:  # Windows: không có flock, chạy một process (flask run)
+    fcntl = None
+
+
+def path_size(path):
+    """Dung lượng file hoặc cả thư mục (byte), 0 nếu không tồn tại."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class DocumentGarbageCollector:
+    """
+    GC đếm tham chiếu: số tham chiếu của tài liệu = số dòng session_files trỏ tới content_id.
+    Tài liệu mất hết tham chiếu được bỏ khỏi cache bộ nhớ ngay, sau thời gian chờ thì xóa store,
+    original_text và bản tóm tắt. File trên đĩa không thuộc tài liệu nào (ingest dở dang) cũng được dọn.
+    Mọi worker đều bỏ tài liệu không còn tham chiếu khỏi cache của mình, còn việc xóa trên đĩa
+    chỉ do process đang giữ khóa file thực hiện.
+    """
+    def __init__(self, manager, vector_cache, grace_seconds=DOCUMENT_GC_GRACE_SECONDS,
+                 interval_seconds=DOCUMENT_GC_INTERVAL_SECONDS):
+        self.manager = manager
+        self.vector_cache = vector_cache
+        self.grace_seconds = grace_seconds
+        self.interval_seconds = interval_seconds
+        self._run_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.documents_collected = 0
+        self.orphans_removed = 0
+        self.bytes_reclaimed = 0
+        self.last_run = None
+
+    def document_artifacts(self, document):
+        store_name = document['store_name']
+        return [
+            os.path.join(self.manager.vector_db_path, store_name),
+            os.path.join(ORIGINAL_TEXT_DIR, f"{store_name}.txt"),
+            summary_path(document['content_id']),
+        ]
+
+    def _orphan_artifacts(self):
+        """File / thư mục không thuộc tài liệu nào trong registry và đã cũ hơn thời gian chờ."""
+        documents = database.get_all_documents()
+        store_names = {document['store_name'] for document in documents}
+        content_ids = {document['content_id'] for document in documents}
+        candidates = []
+        if os.path.isdir(self.manager.vector_db_path):
+            for name in os.listdir(self.manager.vector_db_path):
+                path = os.path.join(self.manager.vector_db_path, name)
+                # Chỉ xét thư mục store (bỏ qua index hợp nhất và các file như hashes.json.migrated)
+                if os.path.isdir(path) and name != UNIFIED_INDEX_DIR and name not in store_names:
+                    candidates.append(path)
+        if os.path.isdir(ORIGINAL_TEXT_DIR):
+            candidates.extend(os.path.join(ORIGINAL_TEXT_DIR, name) for name in os.listdir(ORIGINAL_TEXT_DIR)
+                              if name.endswith(".txt") and name[:-4] not in store_names)
+        if os.path.isdir(SUMMARY_DIR):
+            candidates.extend(os.path.join(SUMMARY_DIR, name) for name in os.listdir(SUMMARY_DIR)
+                              if name.endswith(".json") and name[:-5] not in content_ids)
+
+        # Store được ghi xuống đĩa trước khi vào registry -> chỉ xóa khi đủ cũ (không phải ingest đang chạy)
+        cutoff = time.time() - self.grace_seconds
+        old = []
+        for path in candidates:
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    old.append(path)
+            except OSError:
+                pass  # vừa bị xóa bởi worker khác
+        return old
+
+    @contextmanager
+    def _process_lock(self):
+        """Khóa file không chờ giữa các process. Yield False nếu process khác đang chạy GC."""
+        if fcntl is None:
+            yield True
+            return
+        os.makedirs(self.manager.vector_db_path, exist_ok=True)
+        with open(os.path.join(self.manager.vector_db_path, GC_LOCK_FILE), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def evict_unreferenced(self):
+        """Bỏ khỏi cache của process này các store không còn session nào tham chiếu (hoặc đã bị xóa)."""
+        references = database.get_document_reference_counts()
+        evicted = 0
+        for content_id, _ in self.vector_cache.items():
+            if references.get(content_id, 0) == 0 and self.vector_cache.pop(content_id) is not None:
+                evicted += 1
+        return evicted
+
+    def collect(self):
+        """Chạy một lượt GC, trả về báo cáo của lượt đó."""
+        with self._run_lock:
+            evicted = self.evict_unreferenced()
+            with self._process_lock() as acquired:
+                if not acquired:
+                    return {"skipped": "GC đang chạy ở process khác", "evicted_from_cache": evicted}
+                return self._collect(evicted)
+
+    def _collect(self, evicted):
+        # Chạy khi đang giữ khóa file: đánh dấu, xóa tài liệu hết thời gian chờ, dọn file mồ côi
+        start = time.perf_counter()
+        # Dòng session_files cũ chưa có content_id vẫn là tham chiếu -> gắn trước khi đếm
+        unresolved = self.manager.resolve_legacy_session_files()
+        if unresolved:
+            print(f"GC: {len(unresolved)} session files have no matching document: "
+                  f"{', '.join(row['filename'] for row in unresolved)}")
+        newly_unreferenced = database.mark_unreferenced_documents()
+
+        collected, reclaimed = [], 0
+        for document in database.get_collectable_documents(self.grace_seconds):
+            content_id = document['content_id']
+            size = sum(path_size(path) for path in self.document_artifacts(document))
+            try:
+                if not self.manager.delete_unreferenced(content_id):
+                    continue
+            except Exception as e:
+                print(f"Error collecting document {document['original_name']}: {e}")
+                continue
+            self.vector_cache.pop(content_id)
+            collected.append(content_id)
+            reclaimed += size
+
+        orphans = 0
+        for path in self._orphan_artifacts():
+            size = path_size(path)
+            try:
+                remove_path(path)
+            except OSError as e:
+                print(f"Error removing {path}: {e}")
+                continue
+            orphans += 1
+            reclaimed += size
+
+        self.runs += 1
+        self.documents_collected += len(collected)
+        self.orphans_removed += orphans
+        self.bytes_reclaimed += reclaimed
+        metrics.gc_documents.inc(len(collected))
+        metrics.gc_reclaimed_bytes.inc(reclaimed)
+        self.last_run = {
+            "finished_at": time.time(),
+            "duration_seconds": round(time.perf_counter() - start, 3),
+            "unresolved_session_files": len(unresolved),
+            "newly_unreferenced": len(newly_unreferenced),
+            "evicted_from_cache": evicted,
+            "documents_collected": len(collected),
+            "orphans_removed": orphans,
+            "bytes_reclaimed": reclaimed,
+        }
+        if collected or orphans:
+            print(f"GC: removed {len(collected)} documents, {orphans} orphaned files, "
+                  f"reclaimed {reclaimed / (1024 * 1024):.1f} MB.")
+        return self.last_run
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.collect()
+            except Exception as e:
+                print(f"GC error: {e}")
+            self._stop.wait(self.interval_seconds)
+
+    def start(self):
+        """Chạy GC trên thread nền: một lượt ngay khi khởi động, sau đó mỗi interval_seconds."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="document-gc", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        references = database.get_document_reference_counts()
+        return {
+            "documents": len(references),
+            "unreferenced": sum(1 for count in references.values() if count == 0),
+            "disk_bytes": sum(path_size(path) for path in
+                              (self.manager.vector_db_path, ORIGINAL_TEXT_DIR, SUMMARY_DIR)),
+            "grace_seconds": self.grace_seconds,
+            "runs": self.runs,
+            "documents_collected": self.documents_collected,
+            "orphans_removed": self.orphans_removed,
+            "bytes_reclaimed": self.bytes_reclaimed,
+            "last_run": self.last_run,
+        }
@@ -0,0 +1,139 @@
+import os
+import re
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+# Tóm tắt tài liệu dựng sẵn lúc ingest (tốn thêm lời gọi LLM nên mặc định tắt)
+DOCUMENT_SUMMARIES = os.getenv("DOCUMENT_SUMMARIES", "0") == "1"
+SUMMARY_DIR = "summaries"
+# Số ký tự văn bản gốc cho mỗi phần (bước map)
+SUMMARY_SECTION_CHARS = int(os.getenv("SUMMARY_SECTION_CHARS", "12000"))
+SUMMARY_SECTION_WORDS = 150
+SUMMARY_DOCUMENT_WORDS = 300
+# Số ký tự tóm tắt tối đa gộp trong một lời gọi ở bước reduce, vượt quá thì reduce thêm một tầng
+SUMMARY_REDUCE_CHARS = 12000
+# Số lời gọi LLM song song khi tóm tắt các phần
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "4"))
+
+SUMMARY_KEYWORDS = ["tóm tắt", "summary", "chính", "nội dung", "ý chính", "overview"]
+# Câu hỏi chỉ gồm đúng một trong các cụm này (bỏ dấu câu) mới được trả lời bằng bản tóm tắt dựng sẵn
+SUMMARY_REQUESTS = {
+    "tóm tắt", "tóm tắt tài liệu", "tóm tắt nội dung", "tóm tắt nội dung chính", "tóm tắt các tài liệu",
+    "nội dung chính", "ý chính", "các ý chính", "tổng quan", "summary", "summarize", "overview",
+}
+
+
+def is_summary_request(question):
+    """Yêu cầu tóm tắt rõ ràng ("tóm tắt", "nội dung chính"...), không kèm gì khác -> tóm tắt toàn bộ tài liệu."""
+    return " ".join(re.findall(r"\w+", question.lower())) in SUMMARY_REQUESTS
+
+
+def is_short_summary_query(question):
+    """Câu hỏi ngắn có từ khóa tóm tắt ("chính", "nội dung"...) -> chỉ đổi câu truy vấn tìm kiếm cho đầy đủ hơn."""
+    question = question.strip().lower()
+    return len(question) < 20 and any(k in question for k in SUMMARY_KEYWORDS)
+
+
+def split_sections(page_texts, section_chars=SUMMARY_SECTION_CHARS):
+    """Gom các trang liên tiếp thành phần khoảng section_chars ký tự. Trả về [(trang đầu, trang cuối, text)]."""
+    sections = []
+    start, parts, size = 0, [], 0
+    for page, text in enumerate(page_texts):
+        text = text.strip()
+        # Trang quá dài được cắt thành nhiều phần
+        while len(text) > section_chars:
+            if parts:
+                sections.append((start, page - 1, "\n".join(parts)))
+                parts, size = [], 0
+            sections.append((page, page, text[:section_chars]))
+            text = text[section_chars:]
+        if not text:
+            continue
+        if parts and size + len(text) > section_chars:
+            sections.append((start, page - 1, "\n".join(parts)))
+            parts, size = [], 0
+        if not parts:
+            start = page
+        parts.append(text)
+        size += len(text)
+    if parts:
+        sections.append((start, len(page_texts) - 1, "\n".join(parts)))
+    return sections
+
+
+def summary_path(content_id):
+    return os.path.join(SUMMARY_DIR, f"{content_id}.json")
+
+
+def load_summary(content_id):
+    """Cây tóm tắt đã lưu {"document", "sections": [{"pages", "summary"}]} hoặc None."""
+    path = summary_path(content_id)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (IOError, json.JSONDecodeError) as e:
+        print(f"Error reading {path}: {e}")
+        return None
+
+
+def save_summary(content_id, tree):
+    os.makedirs(SUMMARY_DIR, exist_ok=True)
+    path = summary_path(content_id)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(tree, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def remove_summary(content_id):
+    path = summary_path(content_id)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class DocumentSummarizer:
+    """
+    Tóm tắt map-reduce: mỗi phần (nhóm trang) được tóm tắt riêng, các bản tóm tắt phần được gộp dần
+    (nhiều tầng nếu quá dài) thành bản tóm tắt cả tài liệu.
+    summarize_fn(text, max_words) trả về bản tóm tắt hoặc None nếu lỗi.
+    """
+    def __init__(self, summarize_fn, concurrency=SUMMARY_CONCURRENCY):
+        self.summarize_fn = summarize_fn
+        self.concurrency = concurrency
+
+    def _summarize_all(self, texts, max_words):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            summaries = list(executor.map(lambda text: self.summarize_fn(text, max_words), texts))
+        if any(not summary for summary in summaries):
+            raise RuntimeError("LLM không trả về bản tóm tắt")
+        return summaries
+
+    def _reduce(self, summaries):
+        while True:
+            groups, current = [], []
+            for summary in summaries:
+                if current and sum(len(s) for s in current) + len(summary) > SUMMARY_REDUCE_CHARS:
+                    groups.append(current)
+                    current = []
+                current.append(summary)
+            groups.append(current)
+            if len(groups) == 1:
+                return self._summarize_all(["\n\n".join(groups[0])], SUMMARY_DOCUMENT_WORDS)[0]
+            summaries = self._summarize_all(["\n\n".join(group) for group in groups], SUMMARY_DOCUMENT_WORDS)
+
+    def build(self, page_texts):
+        sections = split_sections(page_texts)
+        if not sections:
+            return None
+        section_summaries = self._summarize_all([text for _, _, text in sections], SUMMARY_SECTION_WORDS)
+        labelled = [f"(Trang {first + 1}-{last + 1}) {summary}"
+                    for (first, last, _), summary in zip(sections, section_summaries)]
+        # Tài liệu ngắn chỉ có một phần -> dùng luôn bản tóm tắt phần, không cần bước reduce
+        document = section_summaries[0] if len(sections) == 1 else self._reduce(labelled)
+        return {
+            "document": document,
+            "sections": [{"pages": [first, last], "summary": summary}
+                         for (first, last, _), summary in zip(sections, section_summaries)],
+        }
@@ -1,26 +1,221 @@
-from sentence_transformers import SentenceTransformer
+import os
+import re
+import time
+import threading
+import importlib.util
+from importlib import metadata
+from collections import OrderedDict
 import numpy as np
 from langchain.embeddings.base import Embeddings
+from embedding_cache import EmbeddingCache, CachedEmbeddings, EMBEDDING_CACHE_ENABLED
 
-model_name = 'hiieu/halong_embedding'  
-model = SentenceTransformer(model_name)
+model_name = 'hiieu/halong_embedding'
+
+# --- CẤU HÌNH BACKEND EMBEDDING (CPU) ---
+# torch: fp32 PyTorch (mặc định) | int8: PyTorch dynamic quantization | onnx: ONNX Runtime
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+# Số thread PyTorch dùng cho embedding (0 = để PyTorch tự chọn)
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))
+
+# Số câu hỏi được giữ lại trong cache embedding (0 = tắt cache)
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "512"))
+# Địa chỉ unix socket của embedding worker dùng chung (xem embedding_worker.py); rỗng = load model trong process
+# Worker phải chạy cùng EMBEDDING_BACKEND vì khóa cache embedding trên đĩa gồm cả backend
+EMBEDDING_WORKER = os.getenv("EMBEDDING_WORKER", "")
+# App gọi warmup() trên thread nền lúc khởi động (0 = chỉ load khi có request đầu tiên)
+EMBEDDING_WARMUP = os.getenv("EMBEDDING_WARMUP", "1") == "1"
+
+
+EMBEDDING_BACKENDS = ("torch", "int8", "onnx")
+# Backend onnx: SentenceTransformer(backend="onnx") có từ sentence-transformers 3.2, cần thêm optimum + onnxruntime
+ONNX_MIN_SENTENCE_TRANSFORMERS = (3, 2)
+ONNX_REQUIREMENT = "pip install 'sentence-transformers>=3.2' 'optimum[onnxruntime]'"
+
+
+def check_backend(backend):
+    """
+    Kiểm tra backend ngay khi được chọn (không import torch / model): backend lạ hoặc thiếu thư viện
+    cho onnx -> báo lỗi rõ ràng thay vì lỗi sâu trong thư viện ở lần encode đầu tiên.
+    """
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unsupported embedding backend: {backend}")
+    if backend != "onnx":
+        return
+    missing = [name for name in ("optimum", "onnxruntime") if importlib.util.find_spec(name) is None]
+    try:
+        version = metadata.version("sentence-transformers")
+    except metadata.PackageNotFoundError:
+        version = None
+    if version is None:
+        missing.append("sentence-transformers")
+    elif tuple(int(part) for part in re.findall(r"\d+", version)[:2]) < ONNX_MIN_SENTENCE_TRANSFORMERS:
+        missing.append(f"sentence-transformers>=3.2 (đang có {version})")
+    if missing:
+        raise RuntimeError(f"EMBEDDING_BACKEND=onnx thiếu thư viện: {', '.join(missing)}. Cài bằng: {ONNX_REQUIREMENT}")
+
+
+def load_model(backend=EMBEDDING_BACKEND):
+    # torch / sentence_transformers chỉ được import khi thật sự cần model
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if EMBEDDING_THREADS > 0:
+        torch.set_num_threads(EMBEDDING_THREADS)
+
+    if backend == "onnx":
+        # Model được export sang ONNX ở lần đầu (thư viện đã được check_backend kiểm tra)
+        return SentenceTransformer(model_name, device='cpu', backend="onnx")
+
+    st_model = SentenceTransformer(model_name, device='cpu')
+    if backend == "int8":
+        # Lượng tử hóa động các lớp Linear sang int8: nhanh hơn trên CPU, vector gần như không đổi
+        torch.quantization.quantize_dynamic(st_model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif backend != "torch":
+        raise ValueError(f"Unsupported embedding backend: {backend}")
+    return st_model
+
+
+class ModelProvider:
+    """
+    Load SentenceTransformer lười: import module không tốn thời gian load torch / model,
+    model chỉ được load ở lần encode đầu tiên hoặc khi gọi warmup().
+    """
+    def __init__(self, backend=EMBEDDING_BACKEND):
+        check_backend(backend)
+        self.backend = backend
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_loaded(self):
+        return self._model is not None
+
+    def get(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    start = time.perf_counter()
+                    self._model = load_model(self.backend)
+                    print(f"Đã load model embedding {model_name} ({self.backend}) trong {time.perf_counter() - start:.1f}s")
+        return self._model
+
+    def encode(self, texts, batch_size=EMBEDDING_BATCH_SIZE):
+        return self.get().encode(list(texts), batch_size=batch_size, convert_to_numpy=True)
+
+    def warmup(self):
+        """Load model và chạy một lần encode để request đầu tiên không phải chờ."""
+        self.encode(["khởi động"], batch_size=1)
 
-texts = [
-    "Deep Learning là một nhánh của học máy, sử dụng các mạng nơ-ron sâu để mô hình hóa và giải quyết các vấn đề phức tạp. "
-    "Nó có nhiều ứng dụng trong thực tế như nhận diện hình ảnh, xử lý ngôn ngữ tự nhiên, và chẩn đoán y tế.",
-    
-    "Món ăn hôm nay rất ngon",
-    "Mạng Neural học sâu học rất sâu nên được gọi là Deep Learning"
-]
 
 class CustomEmbeddings(Embeddings):
-    def __init__(self, model):
+    def __init__(self, model, query_cache_size=QUERY_CACHE_SIZE, batch_size=EMBEDDING_BATCH_SIZE):
+        # model: ModelProvider (local) hoặc RemoteModelProvider (embedding worker), cùng giao diện encode()
         self.model = model
-    
+        self.batch_size = batch_size
+        # Cache LRU cho embedding câu hỏi: câu hỏi lặp lại / regenerate không phải encode lại
+        self.query_cache_size = query_cache_size
+        self._query_cache = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
     def embed_documents(self, texts):
-        return self.model.encode(texts)
-    
+        # encode() tự sắp xếp theo độ dài trước khi chia batch -> ít padding hơn
+        return self.model.encode(list(texts), batch_size=self.batch_size)
+
     def embed_query(self, text):
-        return self.model.encode([text])[0]
+        if self.query_cache_size <= 0:
+            return self.model.encode([text], batch_size=1)[0]
+
+        with self._query_cache_lock:
+            if text in self._query_cache:
+                self._query_cache.move_to_end(text)
+                self.hits += 1
+                return self._query_cache[text]
+            self.misses += 1
+
+        vector = self.model.encode([text], batch_size=1)[0]
+
+        with self._query_cache_lock:
+            self._query_cache[text] = vector
+            self._query_cache.move_to_end(text)
+            while len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)
+        return vector
+
+if EMBEDDING_WORKER:
+    from embedding_worker import RemoteModelProvider
+    model_provider = RemoteModelProvider(EMBEDDING_WORKER, EMBEDDING_BACKEND)
+else:
+    model_provider = ModelProvider()
+
+custom_embeddings = CustomEmbeddings(model_provider)
+
+
+def warmup():
+    """Hook khởi động: load model (hoặc kết nối tới embedding worker) trước khi nhận request."""
+    model_provider.warmup()
+
+# Embedding dùng khi ingest: chunk đã embed trước đó (cùng nội dung + model) được lấy từ cache trên đĩa
+if EMBEDDING_CACHE_ENABLED:
+    # Khóa cache gồm cả backend vì vector int8/onnx lệch nhẹ so với fp32
+    document_embeddings = CachedEmbeddings(custom_embeddings, EmbeddingCache(), f"{model_name}:{EMBEDDING_BACKEND}")
+else:
+    document_embeddings = custom_embeddings
+
+
+def check_backend_accuracy(backend, sample_texts, k=5):
+    """
+    So sánh vector của backend với bản fp32 gốc: cosine giữa hai vector của cùng một đoạn văn
+    và mức trùng khớp top-k láng giềng (mỗi đoạn làm câu hỏi, tìm trong các đoạn còn lại).
+    """
+    reference = load_model("torch").encode(sample_texts, batch_size=EMBEDDING_BATCH_SIZE, convert_to_numpy=True)
+    candidate = load_model(backend).encode(sample_texts, batch_size=EMBEDDING_BATCH_SIZE, convert_to_numpy=True)
+
+    def normalize(vectors):
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    reference, candidate = normalize(reference), normalize(candidate)
+    cosine = np.sum(reference * candidate, axis=1)
+
+    k = min(k, len(sample_texts) - 1)
+    recall = 1.0
+    if k > 0:
+        neighbors = []
+        for vectors in (reference, candidate):
+            sims = vectors @ vectors.T
+            np.fill_diagonal(sims, -np.inf)
+            neighbors.append(np.argsort(-sims, axis=1)[:, :k])
+        recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(*neighbors)])
+
+    return {
+        "backend": backend,
+        "num_texts": len(sample_texts),
+        "mean_cosine": float(np.mean(cosine)),
+        "min_cosine": float(np.min(cosine)),
+        f"neighbor_recall@{k}": float(recall),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description="Kiểm tra độ chính xác của backend embedding so với fp32.")
+    parser.add_argument("--check-backend", default="int8", choices=["torch", "int8", "onnx"])
+    parser.add_argument("--texts-file", help="File văn bản, mỗi dòng một đoạn (mặc định: các câu mẫu)")
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    sample_texts = [
+        "Deep Learning là một nhánh của học máy, sử dụng các mạng nơ-ron sâu để mô hình hóa và giải quyết các vấn đề phức tạp. "
+        "Nó có nhiều ứng dụng trong thực tế như nhận diện hình ảnh, xử lý ngôn ngữ tự nhiên, và chẩn đoán y tế.",
+        "Món ăn hôm nay rất ngon",
+        "Mạng Neural học sâu học rất sâu nên được gọi là Deep Learning",
+    ]
+    if args.texts_file:
+        with open(args.texts_file, 'r', encoding='utf-8') as f:
+            sample_texts = [line.strip() for line in f if line.strip()]
 
-custom_embeddings = CustomEmbeddings(model)
+    print(json.dumps(check_backend_accuracy(args.check_backend, sample_texts, k=args.k), indent=2))
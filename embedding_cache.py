@@ -0,0 +1,115 @@
+import os
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from langchain.embeddings.base import Embeddings
+import metrics
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.db")
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE", "1") == "1"
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Cache embedding của chunk lưu trên đĩa (SQLite), khóa = (sha256 nội dung chunk, tên model).
+    Tài liệu sửa đổi nhẹ khi upload lại chỉ phải embed các chunk thay đổi.
+    """
+    def __init__(self, path=EMBEDDING_CACHE_PATH):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS chunk_embeddings (
+                    text_hash TEXT NOT NULL,
+                    model_name TEXT NOT NULL,
+                    dim INTEGER NOT NULL,
+                    vector BLOB NOT NULL,
+                    PRIMARY KEY (text_hash, model_name)
+                )
+            ''')
+            self._conn.commit()
+        return self._conn
+
+    def get_many(self, hashes, model_name):
+        """Trả về dict hash -> vector (float32) cho những hash đã có trong cache."""
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            conn = self._connect()
+            # SQLite giới hạn số tham số trong một câu lệnh -> chia lô
+            for i in range(0, len(unique), 500):
+                batch = unique[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"SELECT text_hash, vector FROM chunk_embeddings WHERE model_name = ? AND text_hash IN ({placeholders})",
+                    [model_name, *batch]
+                ).fetchall()
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, items, model_name):
+        """items: iterable (hash, vector)."""
+        rows = []
+        for h, vector in items:
+            vector = np.asarray(vector, dtype=np.float32)
+            rows.append((h, model_name, int(vector.shape[0]), vector.tobytes()))
+        if not rows:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR REPLACE INTO chunk_embeddings (text_hash, model_name, dim, vector) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            conn.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class CachedEmbeddings(Embeddings):
+    """Bọc một Embeddings: embed_documents chỉ encode các chunk chưa có trong cache."""
+    def __init__(self, base, cache, model_name):
+        self.base = base
+        self.cache = cache
+        self.model_name = model_name
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        if not texts:
+            return []
+        hashes = [text_hash(t) for t in texts]
+        cached = self.cache.get_many(hashes, self.model_name)
+
+        missing = {}
+        for h, t in zip(hashes, texts):
+            if h not in cached and h not in missing:
+                missing[h] = t
+        self.cache.hits += len(texts) - len(missing)
+        self.cache.misses += len(missing)
+
+        if missing:
+            print(f"Embedding {len(missing)}/{len(texts)} chunks (còn lại lấy từ cache).")
+            metrics.chunks_embedded.inc(len(missing))
+            vectors = self.base.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), vectors))
+            self.cache.put_many(new_items, self.model_name)
+            for h, vector in new_items:
+                cached[h] = np.asarray(vector, dtype=np.float32)
+
+        return np.vstack([cached[h] for h in hashes])
+
+    def embed_query(self, text):
+        return self.base.embed_query(text)
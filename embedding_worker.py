@@ -0,0 +1,159 @@
+"""
+Embedding worker dùng chung: một process giữ model embedding, các worker của app (gunicorn...)
+gọi tới qua unix socket nên model chỉ load một lần cho mỗi máy.
+
+Chạy (cùng một EMBEDDING_WORKER_AUTHKEY bí mật cho cả hai phía):
+    export EMBEDDING_WORKER_AUTHKEY=$(python -c "import secrets; print(secrets.token_hex(32))")
+    python embedding_worker.py --address /tmp/rag_embedding.sock
+    EMBEDDING_WORKER=/tmp/rag_embedding.sock gunicorn -w 4 app:app
+"""
+import os
+import threading
+from multiprocessing.connection import Listener, Client
+
+# Khóa xác thực kết nối (bắt buộc, không có giá trị mặc định): multiprocessing.connection unpickle
+# mọi thông điệp nhận được, ai biết khóa là chạy được code trong process kia
+EMBEDDING_WORKER_AUTHKEY = os.getenv("EMBEDDING_WORKER_AUTHKEY", "").encode()
+
+
+def require_authkey(authkey):
+    if not authkey:
+        raise RuntimeError("Chưa cấu hình EMBEDDING_WORKER_AUTHKEY (bắt buộc khi dùng embedding worker)")
+    return authkey
+
+
+class RemoteModelProvider:
+    """
+    Cùng giao diện encode() / warmup() với embedding.ModelProvider nhưng gửi việc sang embedding worker.
+    Mỗi thread giữ một kết nối riêng, tự kết nối lại một lần nếu worker khởi động lại.
+    backend: EMBEDDING_BACKEND của app, worker phải chạy cùng backend (khóa cache embedding gồm backend).
+    """
+    def __init__(self, address, backend, authkey=EMBEDDING_WORKER_AUTHKEY):
+        self.address = address
+        self.backend = backend
+        self.authkey = require_authkey(authkey)
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            try:
+                conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+                conn.send(("ping",))
+                _, info = conn.recv()
+            except (OSError, EOFError) as e:
+                raise ConnectionError(f"Không kết nối được embedding worker tại {self.address}: {e}") from e
+            # Kiểm tra mỗi kết nối mới (worker có thể được khởi động lại với backend khác)
+            if info.get("backend") != self.backend:
+                conn.close()
+                raise RuntimeError(f"Embedding worker tại {self.address} chạy backend {info.get('backend')}, "
+                                   f"app cấu hình EMBEDDING_BACKEND={self.backend}")
+            self._local.conn = conn
+        return conn
+
+    def _drop_connection(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def _call(self, *message):
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.send(message)
+                status, payload = conn.recv()
+                break
+            except (OSError, EOFError):
+                self._drop_connection()
+                if attempt:
+                    raise ConnectionError(f"Mất kết nối tới embedding worker tại {self.address}")
+        if status == "error":
+            raise RuntimeError(f"Embedding worker lỗi: {payload}")
+        return payload
+
+    def encode(self, texts, batch_size=64):
+        return self._call("encode", list(texts), batch_size)
+
+    def warmup(self):
+        info = self._call("ping")
+        print(f"Đã kết nối embedding worker {self.address}: {info}")
+
+
+class EmbeddingWorkerServer:
+    """
+    Nhận yêu cầu encode từ nhiều client (mỗi kết nối một thread). Model chỉ encode một lô tại một thời điểm,
+    lô lớn lúc ingest được chia nhỏ theo batch_size để câu hỏi của người dùng chen vào giữa được.
+    """
+    def __init__(self, address, provider, authkey=EMBEDDING_WORKER_AUTHKEY):
+        self.address = address
+        self.provider = provider
+        self.authkey = require_authkey(authkey)
+        self._encode_lock = threading.Lock()
+
+    def encode(self, texts, batch_size):
+        import numpy as np
+
+        parts = []
+        for i in range(0, len(texts), batch_size):
+            with self._encode_lock:
+                parts.append(self.provider.encode(texts[i:i + batch_size], batch_size=batch_size))
+        return np.vstack(parts) if parts else np.zeros((0, 0), dtype=np.float32)
+
+    def handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    if message[0] == "encode":
+                        reply = ("ok", self.encode(message[1], message[2]))
+                    elif message[0] == "ping":
+                        reply = ("ok", {"backend": self.provider.backend, "pid": os.getpid()})
+                    else:
+                        reply = ("error", f"Unknown request: {message[0]}")
+                except Exception as e:
+                    reply = ("error", str(e))
+                try:
+                    conn.send(reply)
+                except (OSError, EOFError):
+                    return
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)  # socket cũ còn sót lại sau lần chạy trước
+        # Socket được tạo với quyền 0600 ngay từ đầu (umask), không có khoảng hở trước khi chmod
+        old_umask = os.umask(0o177)
+        try:
+            listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        finally:
+            os.umask(old_umask)
+        with listener:
+            print(f"Embedding worker đang chạy tại {self.address} (pid {os.getpid()})")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    # Sai authkey hoặc client ngắt giữa chừng -> bỏ qua kết nối đó
+                    print(f"Lỗi nhận kết nối embedding: {e}")
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+
+if __name__ == "__main__":
+    import argparse
+    from embedding import ModelProvider, EMBEDDING_BACKEND
+
+    parser = argparse.ArgumentParser(description="Embedding worker dùng chung qua unix socket.")
+    parser.add_argument("--address", default="/tmp/rag_embedding.sock")
+    parser.add_argument("--backend", default=EMBEDDING_BACKEND, choices=["torch", "int8", "onnx"])
+    args = parser.parse_args()
+
+    provider = ModelProvider(args.backend)
+    provider.warmup()
+    EmbeddingWorkerServer(args.address, provider).serve_forever()
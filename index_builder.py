@@ -0,0 +1,176 @@
+import os
+import json
+import math
+import numpy as np
+import faiss
+
+# Từ số chunk này trở lên, store được chuyển từ index phẳng (exact) sang index ANN
+ANN_MIN_CHUNKS = int(os.getenv("ANN_MIN_CHUNKS", "20000"))
+# Loại index ANN: hnsw | ivf | ivfpq
+ANN_INDEX_TYPE = os.getenv("ANN_INDEX_TYPE", "hnsw")
+
+HNSW_M = int(os.getenv("HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "80"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "16"))
+
+INDEX_PARAMS_FILE = "index_params.json"
+# Độ lệch của câu hỏi giả lập so với chunk gốc (tính theo khoảng cách trung bình tới láng giềng gần nhất)
+RECALL_QUERY_NOISE = 0.5
+
+
+def choose_index_spec(num_vectors, dim, index_type=ANN_INDEX_TYPE, min_chunks=ANN_MIN_CHUNKS):
+    """Chọn loại index theo số chunk: phẳng dưới ngưỡng, HNSW / IVF / IVF-PQ khi vượt ngưỡng."""
+    if num_vectors < min_chunks:
+        return {"type": "flat"}
+
+    if index_type == "hnsw":
+        return {"type": "hnsw", "M": HNSW_M, "efConstruction": HNSW_EF_CONSTRUCTION, "efSearch": HNSW_EF_SEARCH}
+
+    # faiss cần khoảng >= 39 vector cho mỗi centroid khi train
+    nlist = max(16, min(int(4 * math.sqrt(num_vectors)), num_vectors // 39))
+    spec = {"type": index_type, "nlist": nlist, "nprobe": min(IVF_NPROBE, nlist)}
+    if index_type == "ivfpq":
+        # Mỗi sub-quantizer 8 chiều, số sub-quantizer phải chia hết dim
+        m = max(1, dim // 8)
+        while dim % m:
+            m -= 1
+        spec["m"] = m
+    elif index_type != "ivf":
+        raise ValueError(f"Unsupported ANN index type: {index_type}")
+    return spec
+
+
+def build_faiss_index(vectors, spec):
+    """Dựng (train nếu cần) index faiss L2 theo spec và thêm toàn bộ vector."""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    dim = vectors.shape[1]
+
+    if spec["type"] == "flat":
+        index = faiss.IndexFlatL2(dim)
+    elif spec["type"] == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, spec["M"])
+        index.hnsw.efConstruction = spec["efConstruction"]
+    elif spec["type"] == "ivf":
+        index = faiss.index_factory(dim, f"IVF{spec['nlist']},Flat")
+    else:
+        index = faiss.index_factory(dim, f"IVF{spec['nlist']},PQ{spec['m']}")
+
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    apply_search_params(index, spec)
+    return index
+
+
+def apply_search_params(index, spec):
+    if not spec:
+        return
+    if spec.get("type") == "hnsw":
+        faiss.downcast_index(index).hnsw.efSearch = spec["efSearch"]
+    elif spec.get("type") in ("ivf", "ivfpq"):
+        faiss.extract_index_ivf(index).nprobe = spec["nprobe"]
+
+
+def save_index_params(db_path, spec):
+    with open(os.path.join(db_path, INDEX_PARAMS_FILE), 'w') as f:
+        json.dump(spec, f)
+
+
+def load_index_params(db_path):
+    params_path = os.path.join(db_path, INDEX_PARAMS_FILE)
+    if not os.path.exists(params_path):
+        return {"type": "flat"}
+    with open(params_path, 'r') as f:
+        return json.load(f)
+
+
+def maybe_upgrade_index(db):
+    """
+    Store được dựng dần bằng index phẳng trong lúc ingest; khi lưu, nếu đủ lớn thì dựng lại
+    thành index ANN từ chính các vector đó. Trả về spec đã dùng.
+    """
+    index = db.index
+    spec = choose_index_spec(index.ntotal, index.d)
+    if spec["type"] != "flat" and isinstance(index, faiss.IndexFlat):
+        print(f"Building {spec['type']} index for {index.ntotal} chunks...")
+        db.index = build_faiss_index(index.reconstruct_n(0, index.ntotal), spec)
+    return spec
+
+
+def perturbed_queries(vectors, num_queries, rng, noise=RECALL_QUERY_NOISE):
+    """
+    Câu hỏi giả lập không nằm trong index: chunk ngẫu nhiên cộng nhiễu Gauss có độ lớn noise lần
+    khoảng cách trung bình tới láng giềng gần nhất (dùng chính vector đã index thì câu hỏi luôn tìm thấy chính nó).
+    """
+    sample = rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False)
+    base = vectors[sample]
+    flat = faiss.IndexFlatL2(vectors.shape[1])
+    flat.add(vectors)
+    distances, _ = flat.search(base, min(2, len(vectors)))
+    nearest = float(np.sqrt(np.mean(distances[:, -1]))) if len(vectors) > 1 else 1.0
+    scale = noise * (nearest or 1.0) / np.sqrt(vectors.shape[1])
+    return (base + rng.normal(0.0, scale, size=base.shape)).astype(np.float32)
+
+
+def recall_report(db, embeddings, k=10, num_queries=100, seed=0, questions=None, noise=RECALL_QUERY_NOISE):
+    """
+    Đo recall@k của index hiện tại so với tìm kiếm phẳng chính xác; ground truth dùng vector embed lại từ text.
+    questions: câu hỏi thật (không nằm trong index) -> embed bằng embed_query; không có thì dùng câu hỏi
+    giả lập từ các chunk ngẫu nhiên cộng nhiễu (perturbed_queries).
+    """
+    ids = [db.index_to_docstore_id[i] for i in range(db.index.ntotal)]
+    texts = [db.docstore.search(doc_id).page_content for doc_id in ids]
+    vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+
+    flat = faiss.IndexFlatL2(vectors.shape[1])
+    flat.add(vectors)
+
+    rng = np.random.default_rng(seed)
+    if questions:
+        queries = np.asarray([embeddings.embed_query(q) for q in questions[:num_queries]], dtype=np.float32)
+    else:
+        queries = perturbed_queries(vectors, num_queries, rng, noise=noise)
+    k = min(k, len(texts))
+
+    _, exact = flat.search(queries, k)
+    _, approx = db.index.search(queries, k)
+    recall = np.mean([len(set(e) & set(a)) / k for e, a in zip(exact, approx)])
+
+    return {
+        "index_type": type(db.index).__name__,
+        "num_vectors": int(db.index.ntotal),
+        "num_queries": int(len(queries)),
+        "queries": "questions" if questions else f"perturbed (noise={noise})",
+        f"recall@{k}": float(recall),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    from langchain_community.vectorstores import FAISS
+    from embedding import document_embeddings
+    from mmap_store import is_mmap_store, load_mmap_store
+
+    parser = argparse.ArgumentParser(description="Báo cáo recall@k của index ANN so với index phẳng.")
+    parser.add_argument("db_path", help="Thư mục store, ví dụ vectorstores/<file>")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--questions-file", help="File câu hỏi thật, mỗi dòng một câu (mặc định: câu hỏi giả lập)")
+    parser.add_argument("--noise", type=float, default=RECALL_QUERY_NOISE)
+    args = parser.parse_args()
+
+    questions = None
+    if args.questions_file:
+        with open(args.questions_file, 'r', encoding='utf-8') as f:
+            questions = [line.strip() for line in f if line.strip()]
+
+    if is_mmap_store(args.db_path):
+        store = load_mmap_store(args.db_path, document_embeddings)
+    else:
+        store = FAISS.load_local(args.db_path, document_embeddings, allow_dangerous_deserialization=True)
+    apply_search_params(store.index, load_index_params(args.db_path))
+    report = recall_report(store, document_embeddings, k=args.k, num_queries=args.queries,
+                           questions=questions, noise=args.noise)
+    report["params"] = load_index_params(args.db_path)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,74 @@
+import os
+import uuid
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import database
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+# Job đã xong được giữ lại bao lâu (giây) để frontend còn poll trạng thái
+JOB_RETENTION_SECONDS = 3600
+
+# Kích thước mỗi lần đọc khi ghi file upload xuống đĩa
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Các giai đoạn xử lý của một file
+STAGES = ["queued", "parsing", "chunking", "embedding", "saving", "summarizing", "done"]
+
+
+class IngestionQueue:
+    """
+    Hàng đợi xử lý file nền cho /upload: request chỉ lưu file và nhận job_id,
+    việc parse / chunk / embed / lưu FAISS chạy trên pool worker.
+    Trạng thái job ghi vào SQLite (bảng ingest_jobs) để /upload_status ở worker nào cũng đọc được.
+    """
+    def __init__(self, process_fn, max_workers=INGEST_WORKERS, upload_dir=UPLOAD_DIR):
+        # process_fn(job, set_stage): xử lý một job, raise exception nếu lỗi
+        self.process_fn = process_fn
+        self.upload_dir = upload_dir
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        os.makedirs(self.upload_dir, exist_ok=True)
+
+    def store_upload(self, file_storage):
+        """
+        Lưu file upload vào thư mục riêng của job, tính sha256 ngay trong lúc ghi (không đọc lại file).
+        Trả về (job_id, đường dẫn file, content_id).
+        """
+        job_id = uuid.uuid4().hex
+        job_dir = os.path.join(self.upload_dir, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        file_path = os.path.join(job_dir, os.path.basename(file_storage.filename))
+        hasher = hashlib.sha256()
+        with open(file_path, 'wb') as out:
+            for block in iter(lambda: file_storage.stream.read(UPLOAD_CHUNK_BYTES), b""):
+                hasher.update(block)
+                out.write(block)
+        return job_id, file_path, hasher.hexdigest()
+
+    def submit(self, job_id, session_id, filename, file_path, content_id=None):
+        job = {
+            "job_id": job_id,
+            "session_id": session_id,
+            "filename": filename,
+            "file_path": file_path,
+            "content_id": content_id,
+        }
+        database.prune_ingest_jobs(JOB_RETENTION_SECONDS)
+        database.add_ingest_job(job_id, session_id, filename, "queued")
+        self.executor.submit(self._run, job)
+        return job_id
+
+    def _set_stage(self, job, stage):
+        database.set_ingest_job_stage(job["job_id"], stage)
+
+    def _run(self, job):
+        try:
+            self.process_fn(job, lambda stage: self._set_stage(job, stage))
+            database.set_ingest_job_stage(job["job_id"], "done", finished=True)
+        except Exception as e:
+            print(f"Error processing {job['filename']}: {e}")
+            database.set_ingest_job_stage(job["job_id"], "error", error=str(e), finished=True)
+        finally:
+            # File gốc chỉ cần trong lúc xử lý
+            shutil.rmtree(os.path.dirname(job["file_path"]), ignore_errors=True)
@@ -0,0 +1,135 @@
+import os
+import re
+import json
+import math
+from collections import Counter
+from text_processor import TextProcessor
+
+LEXICAL_INDEX_FILE = "bm25.json"
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Tỉ lệ tối thiểu (theo trọng số idf) các từ của câu hỏi mà chunk phải chứa để được coi là kết quả:
+# chunk chỉ trùng từ phổ biến ("là", "của", "gì") không được đưa vào context
+LEXICAL_MIN_COVERAGE = float(os.getenv("LEXICAL_MIN_COVERAGE", "0.5"))
+# Ước lượng bộ nhớ của index trên heap (dict Python): mỗi posting, mỗi từ, mỗi chunk
+POSTING_BYTES = 100
+TERM_BYTES = 200
+CHUNK_ENTRY_BYTES = 150
+
+text_processor = TextProcessor()
+_token_pattern = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    """Token hóa không phân biệt dấu: 'Hợp đồng số 12' -> ['hop', 'dong', 'so', '12']."""
+    return _token_pattern.findall(text_processor.fold_for_search(text))
+
+
+class BM25Index:
+    """
+    Inverted index BM25 cho các chunk của một store, khóa là docstore id của chunk.
+    Thêm / xóa được từng chunk (incremental), lưu gọn dưới dạng JSON cạnh FAISS index.
+    """
+    def __init__(self):
+        self.postings = {}   # term -> {chunk_id: tf}
+        self.doc_lengths = {}  # chunk_id -> số token
+        self.total_length = 0
+
+    def add(self, chunk_id, text):
+        if chunk_id in self.doc_lengths:
+            self.remove([chunk_id])
+        tokens = tokenize(text)
+        self.doc_lengths[chunk_id] = len(tokens)
+        self.total_length += len(tokens)
+        for term, tf in Counter(tokens).items():
+            self.postings.setdefault(term, {})[chunk_id] = tf
+
+    def remove(self, chunk_ids):
+        """Xóa nhiều chunk trong một lần duyệt posting."""
+        removed = set()
+        for chunk_id in chunk_ids:
+            length = self.doc_lengths.pop(chunk_id, None)
+            if length is not None:
+                self.total_length -= length
+                removed.add(chunk_id)
+        if not removed:
+            return
+        for term in list(self.postings):
+            postings = self.postings[term]
+            for chunk_id in removed.intersection(postings):
+                del postings[chunk_id]
+            if not postings:
+                del self.postings[term]
+
+    def search(self, query, k=20, allowed=None, min_coverage=LEXICAL_MIN_COVERAGE):
+        """
+        Trả về [(chunk_id, điểm BM25)] giảm dần; allowed: tập chunk_id được phép (None = tất cả).
+        Chunk chứa ít hơn min_coverage tổng idf của các từ trong câu hỏi bị loại (từ không có trong
+        index có idf lớn nhất).
+        """
+        num_docs = len(self.doc_lengths)
+        if num_docs == 0:
+            return []
+        avg_length = self.total_length / num_docs
+
+        scores = {}
+        matched_idf = {}
+        total_idf = 0.0
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term) or {}
+            idf = math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            total_idf += idf
+            for chunk_id, tf in postings.items():
+                if allowed is not None and chunk_id not in allowed:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[chunk_id] / avg_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+                matched_idf[chunk_id] = matched_idf.get(chunk_id, 0.0) + idf
+
+        min_idf = min_coverage * total_idf
+        return sorted(((chunk_id, score) for chunk_id, score in scores.items() if matched_idf[chunk_id] >= min_idf),
+                      key=lambda item: item[1], reverse=True)[:k]
+
+    def estimated_bytes(self):
+        """Bộ nhớ ước lượng của posting list + độ dài chunk (nằm trên heap của từng worker)."""
+        num_postings = sum(len(postings) for postings in self.postings.values())
+        return (num_postings * POSTING_BYTES + len(self.postings) * TERM_BYTES
+                + len(self.doc_lengths) * CHUNK_ENTRY_BYTES)
+
+    # --- LƯU / ĐỌC ---
+    def save(self, dir_path):
+        # Đánh số chunk_id để posting chỉ lưu số nguyên -> file nhỏ hơn
+        chunk_ids = list(self.doc_lengths)
+        position = {chunk_id: i for i, chunk_id in enumerate(chunk_ids)}
+        data = {
+            "chunk_ids": chunk_ids,
+            "doc_lengths": [self.doc_lengths[c] for c in chunk_ids],
+            "postings": {term: [[position[c], tf] for c, tf in postings.items()]
+                         for term, postings in self.postings.items()},
+        }
+        os.makedirs(dir_path, exist_ok=True)
+        with open(os.path.join(dir_path, LEXICAL_INDEX_FILE), 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, dir_path):
+        path = os.path.join(dir_path, LEXICAL_INDEX_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        index = cls()
+        chunk_ids = data["chunk_ids"]
+        index.doc_lengths = dict(zip(chunk_ids, data["doc_lengths"]))
+        index.total_length = sum(data["doc_lengths"])
+        index.postings = {term: {chunk_ids[i]: tf for i, tf in postings}
+                          for term, postings in data["postings"].items()}
+        return index
+
+    @classmethod
+    def from_store(cls, db):
+        """Dựng index từ docstore của một FAISS store (dùng cho store mới hoặc store cũ chưa có bm25.json)."""
+        index = cls()
+        for chunk_id in db.index_to_docstore_id.values():
+            index.add(chunk_id, db.docstore.search(chunk_id).page_content)
+        return index
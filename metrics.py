@@ -0,0 +1,260 @@
+import os
+import time
+import random
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Thêm header Server-Timing (thời gian từng giai đoạn) vào mỗi response
+TIMING_HEADERS = os.getenv("TIMING_HEADERS", "0") == "1"
+# Request chậm hơn ngưỡng này (ms) được ghi log chi tiết theo tỉ lệ lấy mẫu
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "3000"))
+SLOW_LOG_SAMPLE_RATE = float(os.getenv("SLOW_LOG_SAMPLE_RATE", "1.0"))
+
+# Bucket (giây) cho histogram độ trễ
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    items = list(key) + list(extra)
+    if not items:
+        return ""
+    escaped = []
+    for name, value in items:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [đếm theo bucket, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (bucket_counts, total, count) in self._series.items():
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append(f"{self.name}_bucket{_format_labels(key, [('le', _format_value(bound))])} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Tập hợp counter / histogram và các cache cần báo hit/miss, xuất ra định dạng text của Prometheus."""
+    def __init__(self):
+        self._metrics = []
+        self._caches = {}  # tên -> object có thuộc tính hits / misses (/ evictions)
+
+    def counter(self, name, help_text):
+        metric = Counter(name, help_text)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_cache(self, name, cache):
+        self._caches[name] = cache
+
+    def _render_caches(self):
+        lines = []
+        for field in ("hits", "misses", "evictions"):
+            samples = [(name, getattr(cache, field)) for name, cache in self._caches.items() if hasattr(cache, field)]
+            if not samples:
+                continue
+            metric_name = f"rag_cache_{field}_total"
+            lines.append(f"# HELP {metric_name} Số lần cache {field} (theo từng cache)")
+            lines.append(f"# TYPE {metric_name} counter")
+            for name, value in samples:
+                lines.append(f'{metric_name}{{cache="{name}"}} {value}')
+        return lines
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        lines.extend(self._render_caches())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+http_requests = registry.counter("rag_http_requests_total", "Số request HTTP theo endpoint, method, status")
+http_request_seconds = registry.histogram("rag_http_request_duration_seconds", "Thời gian xử lý request HTTP (tới khi gửi header)")
+stage_seconds = registry.histogram("rag_stage_duration_seconds", "Thời gian từng giai đoạn của /chat (load_db, embed_query, vector_search, llm...)")
+ingest_stage_seconds = registry.histogram("rag_ingest_stage_duration_seconds", "Thời gian từng giai đoạn ingest (parsing, chunking, embedding, saving)")
+ingest_files = registry.counter("rag_ingest_files_total", "Số file ingest theo kết quả")
+chunks_embedded = registry.counter("rag_chunks_embedded_total", "Số chunk được model encode lúc ingest (không tính chunk lấy từ cache embedding)")
+chunks_reused = registry.counter("rag_chunks_reused_total", "Số chunk giữ lại vector từ phiên bản trước khi cập nhật tài liệu")
+gc_documents = registry.counter("rag_gc_documents_total", "Số tài liệu không còn tham chiếu đã bị GC xóa")
+gc_reclaimed_bytes = registry.counter("rag_gc_reclaimed_bytes_total", "Dung lượng đĩa GC đã thu hồi (byte)")
+llm_requests = registry.counter("rag_llm_requests_total", "Số lời gọi LLM theo loại")
+llm_prompt_tokens = registry.counter("rag_llm_prompt_tokens_total", "Tổng số token prompt gửi tới LLM (ước lượng)")
+llm_completion_tokens = registry.counter("rag_llm_completion_tokens_total", "Tổng số token LLM sinh ra (ước lượng)")
+llm_first_token_seconds = registry.histogram("rag_llm_first_token_seconds", "Thời gian tới token đầu tiên khi stream")
+
+
+# --- TRACE THEO REQUEST ---
+class RequestTrace:
+    """Các span (giai đoạn, thời gian) của một request; có thể được ghi từ nhiều thread."""
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.spans = []
+
+    def add(self, stage, seconds):
+        self.spans.append((stage, seconds))
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def stage_totals(self):
+        totals = {}
+        for stage, seconds in list(self.spans):
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        return totals
+
+    def server_timing(self):
+        parts = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stage_totals().items()]
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_current_trace = contextvars.ContextVar("request_trace", default=None)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def bind_trace(trace):
+    """Gắn trace vào context hiện tại (task asyncio / thread khác với thread của request)."""
+    return _current_trace.set(trace)
+
+
+@contextmanager
+def span(stage):
+    """Đo một giai đoạn: ghi vào histogram chung và vào trace của request hiện tại (nếu có)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(stage, elapsed)
+
+
+class StageTimer:
+    """Đo các giai đoạn nối tiếp nhau (như progress_callback của update_db): mỗi enter() kết thúc giai đoạn trước."""
+    def __init__(self, histogram=ingest_stage_seconds):
+        self.histogram = histogram
+        self.stage = None
+        self.started = None
+
+    def enter(self, stage):
+        self.finish()
+        self.stage = stage
+        self.started = time.perf_counter()
+
+    def finish(self):
+        if self.stage is not None:
+            self.histogram.observe(time.perf_counter() - self.started, stage=self.stage)
+        self.stage = None
+
+
+def log_if_slow(trace):
+    elapsed_ms = trace.elapsed() * 1000
+    if elapsed_ms < SLOW_REQUEST_MS or random.random() >= SLOW_LOG_SAMPLE_RATE:
+        return
+    breakdown = ", ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in trace.stage_totals().items())
+    print(f"🐢 Request chậm {trace.name}: {elapsed_ms:.0f}ms ({breakdown or 'không có span'})")
+
+
+def init_app(app):
+    """Gắn đo thời gian request, header Server-Timing, log request chậm và endpoint /metrics vào Flask app."""
+    from flask import request, g, Response
+
+    @app.before_request
+    def _start_trace():
+        g.metrics_trace = RequestTrace(request.endpoint or request.path)
+        g.metrics_token = bind_trace(g.metrics_trace)
+
+    @app.after_request
+    def _finish_trace(response):
+        trace = g.pop('metrics_trace', None)
+        if trace is None or request.endpoint == 'metrics_endpoint':
+            return response
+        endpoint = request.endpoint or 'unknown'
+        http_requests.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        http_request_seconds.observe(trace.elapsed(), endpoint=endpoint)
+        if TIMING_HEADERS:
+            response.headers['Server-Timing'] = trace.server_timing()
+        if not response.is_streamed:
+            log_if_slow(trace)
+        return response
+
+    @app.teardown_request
+    def _reset_trace(exc):
+        token = g.pop('metrics_token', None)
+        if token is not None:
+            try:
+                _current_trace.reset(token)
+            except ValueError:
+                pass
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
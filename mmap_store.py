@@ -0,0 +1,301 @@
+import os
+import json
+import mmap
+import uuid
+from contextlib import contextmanager
+import numpy as np
+import faiss
+from langchain_core.documents import Document
+
+# Lưu store theo định dạng mmap (vector .npy + docstore dạng cột) thay cho index.pkl
+MMAP_STORE = os.getenv("MMAP_STORE", "1") == "1"
+
+MMAP_FORMAT_VERSION = 1
+# File header, được ghi sau cùng -> có file này nghĩa là store đã ghi xong
+DOCSTORE_HEADER = "docstore.json"
+VECTORS_FILE = "vectors.npy"
+VECTOR_NORMS_FILE = "vector_norms.npy"
+FAISS_INDEX_FILE = "index.faiss"
+TEXT_FILE = "chunk_text.bin"
+TEXT_OFFSETS_FILE = "chunk_offsets.npy"
+CHUNK_IDS_FILE = "chunk_ids.npy"
+LEGACY_PICKLE_FILE = "index.pkl"
+# Khóa chuyển đổi store cũ: nhiều worker cùng load một store index.pkl -> chỉ một worker chuyển
+CONVERT_LOCK_FILE = ".convert.lock"
+
+try:
+    import fcntl
+except ImportError:  # Windows: không có flock, chạy một process (flask run)
+    fcntl = None
+
+# Giá trị trống của cột metadata kiểu số nguyên / mã từ điển
+INT_NULL = np.iinfo(np.int64).min
+CODE_NULL = -1
+
+
+def is_mmap_store(db_path):
+    return os.path.exists(os.path.join(db_path, DOCSTORE_HEADER))
+
+
+def _column_spec(values):
+    """Cột số nguyên lưu thẳng int64, các kiểu khác mã hóa từ điển (source, store_name... gần như hằng)."""
+    present = [v for v in values if v is not None]
+    if present and all(type(v) is int for v in present):
+        return {"type": "int"}, np.array([INT_NULL if v is None else v for v in values], dtype=np.int64)
+
+    dictionary, codes = [], []
+    positions = {}
+    for value in values:
+        if value is None:
+            codes.append(CODE_NULL)
+            continue
+        key = json.dumps(value, sort_keys=True, ensure_ascii=False)
+        if key not in positions:
+            positions[key] = len(dictionary)
+            dictionary.append(value)
+        codes.append(positions[key])
+    return {"type": "dict", "values": dictionary}, np.array(codes, dtype=np.int32)
+
+
+def _tmp_path(path):
+    # Tên file tạm riêng cho từng lần ghi: hai process ghi cùng store không ghi đè file tạm của nhau
+    return f"{path}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp"
+
+
+def _write_file(path, write):
+    # Ghi ra file tạm rồi replace: worker khác đang mmap bản cũ vẫn đọc được inode cũ
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def _write_npy(path, array):
+    _write_file(path, lambda f: np.save(f, array))
+
+
+def write_docstore(db_path, ids, docs):
+    """Ghi text + metadata của các chunk (theo thứ tự vị trí trong index) thành các file cột."""
+    encoded = [doc.page_content.encode('utf-8') for doc in docs]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    _write_file(os.path.join(db_path, TEXT_FILE), lambda f: f.writelines(encoded))
+    _write_npy(os.path.join(db_path, TEXT_OFFSETS_FILE), offsets)
+    _write_npy(os.path.join(db_path, CHUNK_IDS_FILE), np.array([i.encode('utf-8') for i in ids], dtype=bytes))
+
+    keys = []
+    for doc in docs:
+        for key in doc.metadata:
+            if key not in keys:
+                keys.append(key)
+    columns = {}
+    for i, key in enumerate(keys):
+        spec, array = _column_spec([doc.metadata.get(key) for doc in docs])
+        spec["file"] = f"meta_{i}.npy"
+        _write_npy(os.path.join(db_path, spec["file"]), array)
+        columns[key] = spec
+    return columns
+
+
+def save_mmap_store(db, db_path, spec):
+    """
+    Lưu FAISS store (langchain) theo định dạng mmap. Index phẳng -> ma trận vector .npy,
+    index ANN -> index.faiss (đọc lại bằng IO_FLAG_MMAP). Header ghi sau cùng.
+    """
+    os.makedirs(db_path, exist_ok=True)
+    count = db.index.ntotal
+    ids = [db.index_to_docstore_id[i] for i in range(count)]
+    docs = [db.docstore.search(chunk_id) for chunk_id in ids]
+
+    if spec.get("type", "flat") == "flat":
+        vectors = np.ascontiguousarray(db.index.reconstruct_n(0, count), dtype=np.float32)
+        _write_npy(os.path.join(db_path, VECTORS_FILE), vectors)
+        _write_npy(os.path.join(db_path, VECTOR_NORMS_FILE), np.einsum('ij,ij->i', vectors, vectors))
+    else:
+        faiss.write_index(db.index, os.path.join(db_path, FAISS_INDEX_FILE))
+
+    header = {
+        "version": MMAP_FORMAT_VERSION,
+        "count": count,
+        "dim": db.index.d,
+        "index": "flat" if spec.get("type", "flat") == "flat" else "faiss",
+        "index_type": spec.get("type", "flat"),
+        "columns": write_docstore(db_path, ids, docs),
+    }
+    tmp_path = _tmp_path(os.path.join(db_path, DOCSTORE_HEADER))
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(header, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(db_path, DOCSTORE_HEADER))
+
+
+@contextmanager
+def convert_lock(db_path):
+    """Khóa file (chờ) trên thư mục store, dùng khi chuyển store cũ sang định dạng mmap."""
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(db_path, CONVERT_LOCK_FILE), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def convert_legacy_store(db, db_path, spec):
+    """
+    Chuyển store cũ (index.pkl) sang định dạng mmap; index.pkl được đổi tên thành .migrated.
+    Gọi trong convert_lock(db_path). Store phẳng không dùng index.faiss nữa -> xóa.
+    """
+    save_mmap_store(db, db_path, spec)
+    pickle_path = os.path.join(db_path, LEGACY_PICKLE_FILE)
+    if os.path.exists(pickle_path):
+        os.replace(pickle_path, pickle_path + ".migrated")
+    faiss_path = os.path.join(db_path, FAISS_INDEX_FILE)
+    if spec.get("type", "flat") == "flat" and os.path.exists(faiss_path):
+        os.remove(faiss_path)
+    print(f"Converted {db_path} to memory-mapped format.")
+
+
+class MmapFlatIndex:
+    """
+    Tìm kiếm phẳng (L2 bình phương, như IndexFlatL2) trực tiếp trên ma trận vector được mmap:
+    các worker trên cùng máy dùng chung một bản trong page cache, không copy vào heap.
+    """
+    def __init__(self, vectors, norms):
+        self.vectors = vectors
+        self.norms = norms
+        self.ntotal = vectors.shape[0]
+        self.d = vectors.shape[1]
+
+    def search(self, queries, k):
+        queries = np.asarray(queries, dtype=np.float32)
+        k = max(1, k)
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        if self.ntotal == 0:
+            return distances, indices
+
+        # |x - q|^2 = |x|^2 - 2 x.q + |q|^2
+        scores = self.norms[None, :] - 2.0 * (queries @ self.vectors.T) + np.einsum('ij,ij->i', queries, queries)[:, None]
+        top = min(k, self.ntotal)
+        for row, row_scores in enumerate(scores):
+            best = np.argpartition(row_scores, top - 1)[:top] if top < self.ntotal else np.arange(self.ntotal)
+            best = best[np.argsort(row_scores[best])]
+            distances[row, :top] = np.maximum(row_scores[best], 0.0)
+            indices[row, :top] = best
+        return distances, indices
+
+    def reconstruct_n(self, start, count):
+        return np.array(self.vectors[start:start + count])
+
+
+class ChunkIdColumn:
+    """Bảng vị trí -> docstore id (giống index_to_docstore_id của langchain FAISS), đọc từ cột mmap."""
+    def __init__(self, ids):
+        self._ids = ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, position):
+        return self._ids[position].decode('utf-8')
+
+    def values(self):
+        return (self[i] for i in range(len(self)))
+
+    def items(self):
+        return ((i, self[i]) for i in range(len(self)))
+
+
+class ColumnarDocstore:
+    """
+    Text + metadata của chunk lưu theo cột, mở bằng mmap. Document được dựng khi cần
+    (mỗi lần search trả về bản mới, sửa metadata không ảnh hưởng dữ liệu đã lưu).
+    """
+    def __init__(self, db_path, header):
+        self.count = header["count"]
+        self.offsets = np.load(os.path.join(db_path, TEXT_OFFSETS_FILE), mmap_mode='r')
+        self.ids = ChunkIdColumn(np.load(os.path.join(db_path, CHUNK_IDS_FILE), mmap_mode='r'))
+        self.columns = {
+            key: (spec, np.load(os.path.join(db_path, spec["file"]), mmap_mode='r'))
+            for key, spec in header["columns"].items()
+        }
+        self._text = b""
+        if self.offsets[-1] > 0:
+            with open(os.path.join(db_path, TEXT_FILE), 'rb') as f:
+                self._text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._positions = None
+
+    def position(self, chunk_id):
+        # Bảng id -> vị trí dựng lười (chỉ cần cho tìm kiếm BM25)
+        if self._positions is None:
+            self._positions = {chunk_id: i for i, chunk_id in self.ids.items()}
+        return self._positions.get(chunk_id)
+
+    def document(self, position):
+        start, end = int(self.offsets[position]), int(self.offsets[position + 1])
+        metadata = {}
+        for key, (spec, column) in self.columns.items():
+            value = column[position]
+            if spec["type"] == "int":
+                if value != INT_NULL:
+                    metadata[key] = int(value)
+            elif value != CODE_NULL:
+                metadata[key] = spec["values"][value]
+        return Document(page_content=self._text[start:end].decode('utf-8'), metadata=metadata)
+
+    def search(self, chunk_id):
+        position = self.position(chunk_id)
+        if position is None:
+            return f"ID {chunk_id} not found."
+        return self.document(position)
+
+
+class MmapVectorStore:
+    """
+    Store chỉ đọc với cùng giao diện tìm kiếm như langchain FAISS (similarity_search_with_score_by_vector,
+    docstore, index_to_docstore_id, index) để cache, bot_logic và BM25 dùng như store thường.
+    """
+    def __init__(self, index, docstore, embeddings):
+        self.index = index
+        self.docstore = docstore
+        self.index_to_docstore_id = docstore.ids
+        self.embeddings = embeddings
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4):
+        distances, indices = self.index.search(np.array([embedding], dtype=np.float32), k)
+        return [(self.docstore.document(int(position)), float(score))
+                for position, score in zip(indices[0], distances[0]) if position != -1]
+
+    def similarity_search_with_score(self, query, k=4):
+        return self.similarity_search_with_score_by_vector(self.embeddings.embed_query(query), k=k)
+
+    def private_bytes(self):
+        """Bộ nhớ riêng của worker: bảng id -> vị trí và index BM25 (vector, text nằm trong page cache dùng chung)."""
+        size = 0 if self.docstore._positions is None else len(self.docstore._positions) * 100
+        lexical_index = getattr(self, "lexical_index", None)
+        if lexical_index is not None:
+            size += lexical_index.estimated_bytes()
+        return size
+
+
+def load_mmap_store(db_path, embeddings):
+    with open(os.path.join(db_path, DOCSTORE_HEADER), 'r', encoding='utf-8') as f:
+        header = json.load(f)
+    if header.get("version") != MMAP_FORMAT_VERSION:
+        raise ValueError(f"Unsupported store format version: {header.get('version')}")
+
+    if header["index"] == "flat":
+        index = MmapFlatIndex(
+            np.load(os.path.join(db_path, VECTORS_FILE), mmap_mode='r'),
+            np.load(os.path.join(db_path, VECTOR_NORMS_FILE), mmap_mode='r'),
+        )
+    else:
+        # Inverted list của IVF được mmap; faiss bản mới còn mmap được mã vector của HNSW (IO_FLAG_MMAP_IFC).
+        # IO_FLAG_MMAP_IFC chỉ dùng cho HNSW: với IVF / IVF-PQ read_index báo "mmap only supported for File objects"
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        if header.get("index_type") == "hnsw":
+            flags |= getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        index = faiss.read_index(os.path.join(db_path, FAISS_INDEX_FILE), flags)
+    return MmapVectorStore(index, ColumnarDocstore(db_path, header), embeddings)
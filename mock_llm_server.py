@@ -0,0 +1,137 @@
+"""
+Server giả lập API chat completions tương thích OpenAI, dùng để load test offline.
+
+Chạy:
+    python mock_llm_server.py --port 8001 --latency-ms 500 --token-delay-ms 20
+    LLM_BASE_URL=http://127.0.0.1:8001/v1 GROQ_API_KEY=mock python app.py
+"""
+import json
+import time
+import uuid
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_ANSWER = (
+    "Đây là câu trả lời giả lập từ mock server. Nội dung chính của tài liệu gồm phần giới thiệu, "
+    "các điều khoản quan trọng và phần kết luận."
+)
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # giữ kết nối keep-alive như API thật
+
+    # Được gán lại trong create_server()
+    latency_ms = 500
+    token_delay_ms = 20
+    answer = DEFAULT_ANSWER
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "mock-model", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "Not found"}})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        model = request.get("model", "mock-model")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        tokens = self.answer.split(" ")
+        prompt_chars = sum(len(str(m.get("content", ""))) for m in request.get("messages", []))
+
+        # Thời gian chờ tới token đầu tiên
+        time.sleep(self.latency_ms / 1000)
+
+        if not request.get("stream"):
+            time.sleep(self.token_delay_ms * len(tokens) / 1000)
+            self._send_json(200, {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": self.answer},
+                    "finish_reason": "stop",
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_chars // 3,
+                    "completion_tokens": len(tokens),
+                    "total_tokens": prompt_chars // 3 + len(tokens),
+                },
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send_chunk(data):
+            payload = f"data: {data}\n\n".encode('utf-8')
+            self.wfile.write(f"{len(payload):X}\r\n".encode() + payload + b"\r\n")
+            self.wfile.flush()
+
+        for i, token in enumerate(tokens):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "delta": {"role": "assistant", "content": token if i == 0 else " " + token},
+                    "finish_reason": None,
+                }],
+            }
+            send_chunk(json.dumps(chunk, ensure_ascii=False))
+            time.sleep(self.token_delay_ms / 1000)
+
+        send_chunk(json.dumps({
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        }))
+        send_chunk("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def create_server(host="127.0.0.1", port=8001, latency_ms=500, token_delay_ms=20, answer=DEFAULT_ANSWER):
+    handler = type("ConfiguredMockLLMHandler", (MockLLMHandler,), {
+        "latency_ms": latency_ms,
+        "token_delay_ms": token_delay_ms,
+        "answer": answer,
+    })
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock server tương thích OpenAI chat completions.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-ms", type=float, default=500, help="Độ trễ trước token đầu tiên")
+    parser.add_argument("--token-delay-ms", type=float, default=20, help="Độ trễ giữa các token")
+    args = parser.parse_args()
+
+    server = create_server(args.host, args.port, args.latency_ms, args.token_delay_ms)
+    print(f"Mock LLM server đang chạy tại http://{args.host}:{args.port}/v1")
+    server.serve_forever()
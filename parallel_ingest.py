@@ -0,0 +1,83 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from pypdf import PdfReader
+
+# PDF từ số trang này trở lên sẽ được đọc + chia đoạn song song trên nhiều process
+PARALLEL_MIN_PAGES = int(os.getenv("PARALLEL_MIN_PAGES", "50"))
+PAGES_PER_SHARD = int(os.getenv("PAGES_PER_SHARD", "25"))
+INGEST_PROCESSES = int(os.getenv("INGEST_PROCESSES", str(os.cpu_count() or 1)))
+# Số chunk tối thiểu cho một lần gọi embedding khi các shard hoàn thành dần
+EMBED_BATCH_CHUNKS = int(os.getenv("EMBED_BATCH_CHUNKS", "256"))
+
+
+def build_text_splitter():
+    """Cấu hình chia đoạn dùng chung cho cả luồng tuần tự và song song."""
+    return RecursiveCharacterTextSplitter(
+        separators=["\n\n", "\n", " ", ".", "!", "?", ""],
+        chunk_size=512,
+        chunk_overlap=128,
+        length_function=len,
+        # Ghi vị trí chunk trong trang -> tính được offset trong original_text khi mở rộng context
+        add_start_index=True
+    )
+
+
+def add_char_offsets(chunks, page_offset):
+    """
+    Đổi 'start_index' (vị trí trong trang) thành 'char_start'/'char_end' trong toàn văn bản
+    original_text/<file>.txt (các trang nối với nhau bằng '\\n').
+    """
+    for chunk in chunks:
+        start_index = chunk.metadata.pop('start_index', -1)
+        if start_index is None or start_index < 0:
+            continue
+        chunk.metadata['char_start'] = page_offset + start_index
+        chunk.metadata['char_end'] = page_offset + start_index + len(chunk.page_content)
+    return chunks
+
+
+def count_pdf_pages(file_path):
+    return len(PdfReader(file_path).pages)
+
+
+def extract_shard(file_path, start, end):
+    """
+    Chạy trong process con: đọc text các trang [start, end) và chia đoạn từng trang.
+    Metadata giống PyPDFLoader: 'source' = đường dẫn file, 'page' = số trang (bắt đầu từ 0).
+    """
+    reader = PdfReader(file_path)
+    splitter = build_text_splitter()
+    page_texts = []
+    chunks = []
+    for page_number in range(start, end):
+        text = reader.pages[page_number].extract_text() or ""
+        page_texts.append(text)
+        page_doc = Document(page_content=text, metadata={'source': file_path, 'page': page_number})
+        chunks.extend(splitter.split_documents([page_doc]))
+    return start, page_texts, chunks
+
+
+def iter_pdf_shards(file_path, max_workers=INGEST_PROCESSES, pages_per_shard=PAGES_PER_SHARD):
+    """
+    Chia file thành các khoảng trang, xử lý song song và yield (page_texts, chunks)
+    theo đúng thứ tự trang ngay khi shard liền kề tiếp theo hoàn thành.
+    """
+    total_pages = count_pdf_pages(file_path)
+    starts = list(range(0, total_pages, pages_per_shard))
+    if not starts:
+        return
+
+    with ProcessPoolExecutor(max_workers=max(1, min(max_workers, len(starts)))) as pool:
+        futures = [pool.submit(extract_shard, file_path, start, min(start + pages_per_shard, total_pages))
+                   for start in starts]
+        finished = {}
+        next_index = 0
+        for future in as_completed(futures):
+            start, page_texts, chunks = future.result()
+            finished[start] = (page_texts, chunks)
+            # Shard xong sớm được giữ lại cho tới khi các shard phía trước hoàn thành
+            while next_index < len(starts) and starts[next_index] in finished:
+                yield finished.pop(starts[next_index])
+                next_index += 1
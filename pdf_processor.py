@@ -1,22 +1,78 @@
 import hashlib
 import os
+import uuid
 import json
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import threading
+from collections import OrderedDict
 from langchain_community.vectorstores import FAISS
 from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader
-from embedding import custom_embeddings
+from embedding import custom_embeddings, document_embeddings
+from embedding_cache import text_hash, CachedEmbeddings
 from text_processor import TextProcessor
+import metrics
+import database
+from unified_index import UnifiedVectorIndex, UNIFIED_INDEX, UNIFIED_INDEX_DIR
+from lexical_index import BM25Index
+from answer_cache import answer_cache
+from doc_summary import DocumentSummarizer, DOCUMENT_SUMMARIES, load_summary, save_summary, remove_summary
+from mmap_store import MMAP_STORE, is_mmap_store, load_mmap_store, save_mmap_store, convert_legacy_store, convert_lock
+from index_builder import maybe_upgrade_index, save_index_params, load_index_params, apply_search_params
+from parallel_ingest import build_text_splitter, add_char_offsets, count_pdf_pages, iter_pdf_shards, PARALLEL_MIN_PAGES, EMBED_BATCH_CHUNKS
 
 text_processor = TextProcessor()
 
+# Tổng số ký tự original_text được giữ trong bộ nhớ để mở rộng context
+CONTEXT_TEXT_CACHE_CHARS = int(os.getenv("CONTEXT_TEXT_CACHE_CHARS", str(50 * 1024 * 1024)))
+# Số lock dùng để tránh hai worker ingest cùng một nội dung (chọn lock theo content_id)
+INGEST_LOCK_STRIPES = 64
+
+def count_uncached_chunks(count):
+    # Có cache embedding thì CachedEmbeddings chỉ đếm chunk thật sự được encode; không có cache -> mọi chunk đều encode
+    if not isinstance(document_embeddings, CachedEmbeddings):
+        metrics.chunks_embedded.inc(count)
+
+def diff_chunks(base_chunks, chunks):
+    """
+    So khớp chunk của phiên bản mới với phiên bản trước theo nội dung (sha256 text).
+    base_chunks: [(docstore id, text, vector)], chunks: Document của phiên bản mới.
+    Trả về (kept {vị trí mới: (id cũ, vector)}, added [vị trí mới], removed [id cũ]).
+    """
+    by_hash = {}
+    for chunk_id, text, vector in base_chunks:
+        by_hash.setdefault(text_hash(text), []).append((chunk_id, vector))
+
+    kept, added = {}, []
+    for i, chunk in enumerate(chunks):
+        matches = by_hash.get(text_hash(chunk.page_content))
+        if matches:
+            kept[i] = matches.pop(0)
+        else:
+            added.append(i)
+    removed = [chunk_id for matches in by_hash.values() for chunk_id, _ in matches]
+    return kept, added, removed
+
+
 # [QUAN TRỌNG] Đổi tên class thành DocumentDatabaseManager để khớp với app.py
 class DocumentDatabaseManager:
-    def __init__(self, data_path, vector_db_path, hash_store_path):
+    def __init__(self, data_path, vector_db_path, hash_store_path, unified=UNIFIED_INDEX, summaries=DOCUMENT_SUMMARIES):
         self.data_path = data_path
         self.vector_db_path = vector_db_path
+        # hashes.json cũ, chỉ dùng để chuyển sang registry trong SQLite (bảng documents)
         self.hash_store_path = hash_store_path
         if not os.path.exists(self.vector_db_path):
             os.makedirs(self.vector_db_path)
+        # Hai upload cùng nội dung chạy song song -> chỉ một worker index, worker kia dùng lại kết quả
+        self._ingest_locks = [threading.Lock() for _ in range(INGEST_LOCK_STRIPES)]
+        # Chế độ index hợp nhất (tùy chọn): mọi tài liệu dùng chung một FAISS index
+        self.unified_index = None
+        if unified:
+            self.unified_index = UnifiedVectorIndex(os.path.join(self.vector_db_path, UNIFIED_INDEX_DIR), document_embeddings)
+        # Bước tóm tắt map-reduce lúc ingest (tùy chọn), dùng để trả lời câu hỏi kiểu "tóm tắt"
+        self.summarizer = None
+        if summaries:
+            from RAG_chatbot import rag_bot
+            self.summarizer = DocumentSummarizer(rag_bot.summarize_document_part)
+        self.import_legacy_hashes()
 
     def calculate_file_hash(self, file_path):
         if not os.path.exists(file_path):
@@ -27,21 +83,67 @@ class DocumentDatabaseManager:
                 hasher.update(block)
         return hasher.hexdigest()
 
-    def load_existing_hashes(self):
+    def import_legacy_hashes(self):
+        """
+        Chuyển hashes.json (hash -> đường dẫn upload) sang registry SQLite, chỉ chạy một lần.
+        Store cũ giữ nguyên tên thư mục (tên file bỏ dấu), session cũ được gắn content_id theo tên file.
+        """
+        if not os.path.exists(self.hash_store_path):
+            return
         try:
-            if os.path.exists(self.hash_store_path):
-                with open(self.hash_store_path, 'r') as f:
-                    return json.load(f)
-        except json.JSONDecodeError:
-            pass
-        return {}
-
-    def save_hashes(self, hashes):
-        try:
-            with open(self.hash_store_path, 'w') as f:
-                json.dump(hashes, f)
-        except IOError as e:
-            print(f"Error saving hashes: {e}")
+            with open(self.hash_store_path, 'r') as f:
+                hashes = json.load(f)
+        except (IOError, json.JSONDecodeError) as e:
+            print(f"Error reading {self.hash_store_path}: {e}")
+            return
+
+        for content_id, path in hashes.items():
+            original_name = os.path.basename(path)
+            store_name = text_processor.remove_accents(os.path.splitext(original_name)[0])
+            if self.unified_index is not None:
+                # Index hợp nhất cũ dùng tên file upload làm doc_id
+                self.unified_index.rename_document(original_name, store_name)
+            database.add_document(content_id, store_name, original_name)
+            database.link_session_files_by_name(original_name, content_id)
+        if self.unified_index is not None:
+            self.unified_index.save()
+        os.replace(self.hash_store_path, self.hash_store_path + ".migrated")
+        print(f"Imported {len(hashes)} documents from {self.hash_store_path} into the document registry.")
+
+    def resolve_session_file(self, session_id, filename, file_path):
+        """
+        Tìm content_id cho dòng session_files cũ mà link_session_files_by_name không khớp được:
+        theo hash của file upload (nếu còn trên đĩa), sau đó theo tên store cũ (tên file bỏ dấu).
+        Tìm được thì ghi lại vào session_files. Trả về content_id hoặc None.
+        """
+        content_id = None
+        if file_path and os.path.isfile(file_path):
+            file_hash = self.calculate_file_hash(file_path)
+            if self.has_document(file_hash):
+                content_id = file_hash
+        if content_id is None:
+            store_name = text_processor.remove_accents(os.path.splitext(os.path.basename(filename))[0])
+            document = database.get_document_by_store_name(store_name)
+            if document is not None:
+                content_id = document['content_id']
+        if content_id is not None:
+            database.set_session_file_content(session_id, filename, content_id)
+            print(f"Linked legacy session file {filename} to document {content_id}.")
+        return content_id
+
+    def resolve_legacy_session_files(self):
+        """Gắn content_id cho mọi dòng session_files cũ còn thiếu. Trả về danh sách file không tìm được tài liệu."""
+        unresolved = []
+        for row in database.get_unlinked_session_files():
+            if self.resolve_session_file(row['session_id'], row['filename'], row['file_path']) is None:
+                unresolved.append(row)
+        return unresolved
+
+    def has_document(self, content_id):
+        return database.get_document(content_id) is not None
+
+    def _ingest_lock(self, content_id):
+        return self._ingest_locks[int(content_id[:8], 16) % INGEST_LOCK_STRIPES]
 
     def get_loader(self, file_path):
         ext = os.path.splitext(file_path)[1].lower()
@@ -56,119 +158,472 @@ class DocumentDatabaseManager:
             return None
 
     def process_document(self, document):
-        text_splitter = RecursiveCharacterTextSplitter(
-            separators=["\n\n", "\n", " ", ".", "!", "?", ""],
-            chunk_size=512,
-            chunk_overlap=128,
-            length_function=len
-        )
+        text_splitter = build_text_splitter()
         chunks = text_splitter.split_documents([document])
         return chunks
 
-    def load_existing_db(self, file_name):
-        file_name_clean = text_processor.remove_accents(os.path.splitext(file_name)[0])
-        db_path = os.path.join(self.vector_db_path, file_name_clean)
+    def load_existing_db(self, content_id):
+        document = database.get_document(content_id)
+        if document is None:
+            return None
+        store_name = document['store_name']
+
+        if self.unified_index is not None:
+            if self.unified_index.has_document(store_name):
+                return self.unified_index.view(store_name)
+            return None
+
+        db_path = os.path.join(self.vector_db_path, store_name)
         
         if os.path.exists(db_path):
             try:
-                return FAISS.load_local(db_path, custom_embeddings, allow_dangerous_deserialization=True)
+                db = self.load_store(db_path)
+                # Tham số tìm kiếm (nprobe / efSearch) được lưu kèm index
+                apply_search_params(db.index, load_index_params(db_path))
+                db.lexical_index = BM25Index.load(db_path)
+                if db.lexical_index is None:
+                    # Store cũ chưa có index BM25 -> dựng một lần từ docstore
+                    db.lexical_index = BM25Index.from_store(db)
+                    db.lexical_index.save(db_path)
+                return db
             except Exception as e:
-                print(f"Error loading database for {file_name}: {e}")
+                print(f"Error loading database for {document['original_name']}: {e}")
         return None
 
+    def load_store(self, db_path):
+        """
+        Mở store từ đĩa: định dạng mmap (chỉ đọc, dùng chung page cache giữa các worker) nếu có,
+        nếu không thì load pickle cũ rồi chuyển sang định dạng mmap (khi MMAP_STORE bật).
+        """
+        if is_mmap_store(db_path):
+            return load_mmap_store(db_path, custom_embeddings)
+        if not MMAP_STORE:
+            return FAISS.load_local(db_path, custom_embeddings, allow_dangerous_deserialization=True)
+        with convert_lock(db_path):
+            # Worker khác có thể vừa chuyển xong trong lúc chờ khóa
+            if not is_mmap_store(db_path):
+                db = FAISS.load_local(db_path, custom_embeddings, allow_dangerous_deserialization=True)
+                convert_legacy_store(db, db_path, load_index_params(db_path))
+        return load_mmap_store(db_path, custom_embeddings)
+
+    def migrate_to_unified_index(self):
+        """Chuyển các store riêng lẻ (vectorstores/<file>) vào index hợp nhất, chỉ chạy một lần."""
+        if self.unified_index is None or self.unified_index.is_migrated():
+            return []
+
+        def legacy_stores():
+            for document in database.get_all_documents():
+                db_path = os.path.join(self.vector_db_path, document['store_name'])
+                if not os.path.exists(db_path):
+                    continue
+                try:
+                    yield document['store_name'], self.load_store(db_path)
+                except Exception as e:
+                    print(f"Error loading database for {document['original_name']}: {e}")
+
+        return self.unified_index.migrate_from_stores(legacy_stores())
+
     def is_file_exists(self, file_path):
         if not os.path.exists(file_path): return False
-        file_hash = self.calculate_file_hash(file_path)
-        existing_hashes = self.load_existing_hashes()
-        return file_hash in existing_hashes
+        return self.has_document(self.calculate_file_hash(file_path))
 
-    def update_db(self, file_path):
+    def update_db(self, file_path, progress_callback=None, content_id=None, original_name=None, base_content_id=None):
+        """
+        Index một file theo nội dung: content_id (sha256) thường đã được tính khi nhận upload, nếu không thì tính ở đây.
+        Nội dung đã có trong registry -> trả về store sẵn có, không index lại.
+        base_content_id: phiên bản trước của cùng tài liệu -> cập nhật tăng dần (chỉ embed các chunk thay đổi).
+        progress_callback(stage) được gọi khi chuyển giai đoạn: parsing, chunking, embedding, saving, summarizing.
+        """
         if not os.path.exists(file_path): return None
+        if content_id is None:
+            content_id = self.calculate_file_hash(file_path)
 
-        file_hash = self.calculate_file_hash(file_path)
-        existing_hashes = self.load_existing_hashes()
+        with self._ingest_lock(content_id):
+            if self.has_document(content_id):
+                print(f"File {file_path} already exists.")
+                if self.summarizer is not None and load_summary(content_id) is None:
+                    # Tài liệu index trước khi bật tóm tắt -> bổ sung từ original_text
+                    self.build_summary(content_id, self.read_original_text(content_id), progress_callback)
+                return self.load_existing_db(content_id)
+            file_name = original_name or os.path.basename(file_path)
+            if base_content_id is not None and self.has_document(base_content_id):
+                return self._update_file(file_path, content_id, file_name, base_content_id, progress_callback)
+            return self._index_file(file_path, content_id, file_name, progress_callback)
 
-        if file_hash in existing_hashes:
-            print(f"File {file_path} already exists.")
-            return None
+    def load_and_chunk(self, file_path, report):
+        """Đọc + chia đoạn một file (không embed). Trả về (page_texts, chunks) hoặc None nếu không đọc được."""
+        if self.should_extract_in_parallel(file_path):
+            report("parsing")
+            page_texts = []
+            chunks = [chunk for batch in self.iter_pdf_chunk_batches(file_path, page_texts, report) for chunk in batch]
+            return page_texts, chunks
 
         loader = self.get_loader(file_path)
         if not loader: return None
-            
+
+        report("parsing")
+        documents = loader.load()
+        page_texts = [doc.page_content for doc in documents]
+
+        report("chunking")
+        chunks = []
+        page_offset = 0
+        for doc in documents:
+            page_chunks = self.process_document(doc)
+            chunks.extend(add_char_offsets(page_chunks, page_offset))
+            page_offset += len(doc.page_content) + 1
+        return page_texts, chunks
+
+    def _index_file(self, file_path, content_id, file_name, progress_callback):
+        def report(stage):
+            if progress_callback:
+                progress_callback(stage)
+
+        # Tên store / original_text / doc_id trong index hợp nhất = content_id -> không trùng giữa các file cùng tên
+        store_name = content_id
+
+        if self.should_extract_in_parallel(file_path):
+            try:
+                page_texts, db = self.ingest_pdf_parallel(file_path, store_name, report)
+            except Exception as e:
+                print(f"Error loading file {file_path}: {e}")
+                if self.unified_index is not None:
+                    # Các lô đã thêm vào index hợp nhất (save=False) trước khi lỗi -> bỏ đi
+                    self.unified_index.remove_document(store_name)
+                return None
+        else:
+            try:
+                extracted = self.load_and_chunk(file_path, report)
+            except Exception as e:
+                print(f"Error loading file {file_path}: {e}")
+                return None
+            if extracted is None: return None
+            page_texts, chunks = extracted
+
+            db = None
+            if chunks:
+                report("embedding")
+                db = self.add_chunks(db, store_name, chunks)
+
+        return self._publish(db, content_id, store_name, file_name, file_path, page_texts, report)
+
+    def stored_chunks(self, content_id):
+        """
+        Các chunk đã lưu của một phiên bản: [(docstore id, text, vector)].
+        None nếu không lấy lại được vector chính xác (index IVF / IVF-PQ) -> embed lại (qua cache embedding).
+        """
+        document = database.get_document(content_id)
+        if document is None:
+            return None
+        store_name = document['store_name']
+        if self.unified_index is not None:
+            return self.unified_index.document_chunks(store_name)
+
+        db_path = os.path.join(self.vector_db_path, store_name)
+        if load_index_params(db_path).get("type", "flat") not in ("flat", "hnsw"):
+            return None
+        db = self.load_existing_db(content_id)
+        if db is None:
+            return None
+        vectors = db.index.reconstruct_n(0, db.index.ntotal)
+        chunks = []
+        for position in range(db.index.ntotal):
+            chunk_id = db.index_to_docstore_id[position]
+            chunks.append((chunk_id, db.docstore.search(chunk_id).page_content, vectors[position]))
+        return chunks
+
+    def _update_file(self, file_path, content_id, file_name, base_content_id, progress_callback):
+        """
+        Cập nhật tăng dần: chia đoạn phiên bản mới, so khớp với các chunk của phiên bản trước theo nội dung,
+        giữ nguyên id + vector của chunk không đổi, chỉ embed chunk mới, bỏ chunk đã bị xóa.
+        Phiên bản mới được dựng ở store riêng (copy-on-write) và chỉ được công bố khi ghi registry,
+        các request đang đọc phiên bản cũ không bị ảnh hưởng.
+        """
+        def report(stage):
+            if progress_callback:
+                progress_callback(stage)
+
+        store_name = content_id
+        base = database.get_document(base_content_id)
         try:
-            documents = loader.load()
+            extracted = self.load_and_chunk(file_path, report)
+            if extracted is None: return None
+            page_texts, chunks = extracted
+            base_chunks = self.stored_chunks(base_content_id)
         except Exception as e:
             print(f"Error loading file {file_path}: {e}")
             return None
+        if not chunks:
+            return None
+        # Không lấy lại được chunk cũ -> không biết chunk nào bị xóa, BM25 phải dựng lại từ store mới
+        reuse_lexical = base_chunks is not None
+        if base_chunks is None:
+            print(f"Cannot reuse vectors of {base['original_name']}, re-indexing {file_name}.")
+            base_chunks = []
+
+        report("embedding")
+        kept, added, removed_ids = diff_chunks(base_chunks, chunks)
+        for chunk in chunks:
+            chunk.metadata['store_name'] = store_name
+
+        vectors = {}
+        if added:
+            count_uncached_chunks(len(added))
+            embedded = document_embeddings.embed_documents([chunks[i].page_content for i in added])
+            vectors.update(zip(added, embedded))
+        ids = {}
+        for i, (chunk_id, vector) in kept.items():
+            ids[i] = chunk_id
+            vectors[i] = vector
+        metrics.chunks_reused.inc(len(kept))
 
+        texts = [chunk.page_content for chunk in chunks]
+        ordered_vectors = [vectors[i] for i in range(len(chunks))]
+        metadatas = [dict(chunk.metadata) for chunk in chunks]
+
+        lexical_index = None
+        if self.unified_index is not None:
+            # Index hợp nhất vẫn giữ phiên bản cũ -> chunk của phiên bản mới nhận id mới
+            self.unified_index.add_embeddings(store_name, texts, ordered_vectors, metadatas)
+            db = self.unified_index.view(store_name)
+        else:
+            chunk_ids = [ids.get(i) or uuid.uuid4().hex for i in range(len(chunks))]
+            db = FAISS.from_embeddings(list(zip(texts, ordered_vectors)), document_embeddings,
+                                       metadatas=metadatas, ids=chunk_ids)
+            # BM25 của phiên bản trước: chỉ xóa / thêm các chunk thay đổi
+            if reuse_lexical:
+                lexical_index = BM25Index.load(os.path.join(self.vector_db_path, base['store_name']))
+            if lexical_index is not None:
+                lexical_index.remove(removed_ids)
+                for i in added:
+                    lexical_index.add(chunk_ids[i], texts[i])
+
+        print(f"Updated {file_name}: {len(kept)} chunks reused, {len(added)} embedded, {len(removed_ids)} removed.")
+        return self._publish(db, content_id, store_name, file_name, file_path, page_texts, report,
+                             lexical_index=lexical_index, base=base)
+
+    def _publish(self, db, content_id, store_name, file_name, file_path, page_texts, report, lexical_index=None, base=None):
+        """Lưu original_text + store rồi ghi registry (từ lúc này tài liệu / phiên bản mới mới được dùng)."""
         output_dir = 'original_text'
         os.makedirs(output_dir, exist_ok=True)
-        file_name = os.path.basename(file_path)
-        file_name_without_ext = text_processor.remove_accents(os.path.splitext(file_name)[0])
-        output_file_name = f"{file_name_without_ext}.txt"
+        output_file_name = f"{store_name}.txt"
         output_file_path = os.path.join(output_dir, output_file_name)
 
-        all_text = "\n".join(doc.page_content for doc in documents)
+        all_text = "\n".join(page_texts)
         with open(output_file_path, 'w', encoding='utf-8') as file:
             file.write(all_text)
 
-        chunks = []
-        for doc in documents:
-            page_chunks = self.process_document(doc)
-            chunks.extend(page_chunks)
-
-        if chunks:
-            db = FAISS.from_documents(chunks, custom_embeddings)
-            db_path = os.path.join(self.vector_db_path, file_name_without_ext)
-            db.save_local(db_path)
-            
-            existing_hashes[file_hash] = file_path
-            self.save_hashes(existing_hashes)
-            return db
-        return None
+        if db is None:
+            return None
 
-    def delete_file_data(self, file_name):
-        existing_hashes = self.load_existing_hashes()
-        hash_to_remove = None
-        for h, path in existing_hashes.items():
-            if os.path.basename(path) == file_name:
-                hash_to_remove = h
-                break
-        
-        if hash_to_remove:
-            del existing_hashes[hash_to_remove]
-            self.save_hashes(existing_hashes)
+        report("saving")
+        if self.unified_index is not None:
+            self.unified_index.save()
+        else:
+            # Store lớn được dựng lại thành index ANN (HNSW / IVF / IVF-PQ) trước khi lưu
+            spec = maybe_upgrade_index(db)
+            db_path = os.path.join(self.vector_db_path, store_name)
+            if MMAP_STORE:
+                # Vector .npy / index.faiss + docstore dạng cột, các worker khác mở bằng mmap
+                save_mmap_store(db, db_path, spec)
+            else:
+                db.save_local(db_path)
+            save_index_params(db_path, spec)
+            # Index từ khóa (BM25, không dấu) lưu cạnh FAISS store
+            db.lexical_index = lexical_index or BM25Index.from_store(db)
+            db.lexical_index.save(db_path)
+
+        if base is None:
+            database.add_document(content_id, store_name, file_name, os.path.getsize(file_path))
+        else:
+            database.add_document(content_id, store_name, file_name, os.path.getsize(file_path),
+                                  parent_content_id=base['content_id'], version=base['version'] + 1)
+        # Nội dung được index lại -> câu trả lời cũ dựa trên tài liệu này không còn đúng
+        answer_cache.invalidate_document(content_id)
+
+        if self.summarizer is not None:
+            self.build_summary(content_id, page_texts, report)
+        return db
+
+    def read_original_text(self, content_id):
+        """Văn bản gốc đã lưu của tài liệu, dạng [text] (không còn ranh giới trang)."""
+        document = database.get_document(content_id)
+        if document is None:
+            return []
+        path = os.path.join("original_text", f"{document['store_name']}.txt")
+        if not os.path.exists(path):
+            return []
+        with open(path, 'r', encoding='utf-8') as f:
+            return [f.read()]
 
-        file_name_clean = text_processor.remove_accents(os.path.splitext(file_name)[0])
-        db_path = os.path.join(self.vector_db_path, file_name_clean)
-        txt_path = os.path.join("original_text", f"{file_name_clean}.txt")
+    def build_summary(self, content_id, page_texts, progress_callback=None):
+        """Dựng và lưu cây tóm tắt (phần -> tài liệu). Lỗi không làm hỏng việc ingest, chỉ bỏ qua bước này."""
+        if progress_callback:
+            progress_callback("summarizing")
+        try:
+            tree = self.summarizer.build(page_texts)
+        except Exception as e:
+            print(f"Error summarizing document {content_id}: {e}")
+            return None
+        if tree is not None:
+            save_summary(content_id, tree)
+        return tree
+
+    def add_chunks(self, db, store_name, chunks):
+        """Embed và thêm một lô chunk vào store của file (tạo store mới nếu db là None)."""
+        count_uncached_chunks(len(chunks))
+        for chunk in chunks:
+            # ContextRetriever đọc original_text/<store_name>.txt theo metadata này
+            chunk.metadata['store_name'] = store_name
+        if self.unified_index is not None:
+            self.unified_index.add_document(store_name, chunks, save=False)
+            return self.unified_index.view(store_name)
+        if db is None:
+            return FAISS.from_documents(chunks, document_embeddings)
+        db.add_documents(chunks)
+        return db
+
+    def should_extract_in_parallel(self, file_path):
+        if os.path.splitext(file_path)[1].lower() != '.pdf':
+            return False
+        try:
+            return count_pdf_pages(file_path) >= PARALLEL_MIN_PAGES
+        except Exception:
+            return False
+
+    def iter_pdf_chunk_batches(self, file_path, page_texts, report=None):
+        """
+        Đọc + chia đoạn PDF lớn trên nhiều process (theo khoảng trang), yield chunk của từng shard theo đúng
+        thứ tự trang (đã gắn char offset); text các trang được nối dần vào page_texts.
+        report("chunking") được gọi khi shard đầu tiên đã parse xong.
+        """
+        page_offsets = {}
+        text_length = 0
+        for shard, (shard_texts, shard_chunks) in enumerate(iter_pdf_shards(file_path)):
+            if report and shard == 0:
+                report("chunking")
+            for text in shard_texts:
+                page_offsets[len(page_texts)] = text_length
+                page_texts.append(text)
+                text_length += len(text) + 1
+            for chunk in shard_chunks:
+                add_char_offsets([chunk], page_offsets[chunk.metadata['page']])
+            yield shard_chunks
+
+    def ingest_pdf_parallel(self, file_path, store_name, report):
+        """Embed theo lô lớn ngay khi các shard hoàn thành thay vì đợi parse xong cả file."""
+        report("parsing")
+        page_texts = []
+        db = None
+        batch = []
+        for shard_chunks in self.iter_pdf_chunk_batches(file_path, page_texts, report):
+            batch.extend(shard_chunks)
+            if len(batch) >= EMBED_BATCH_CHUNKS:
+                report("embedding")
+                db = self.add_chunks(db, store_name, batch)
+                batch = []
+        if batch:
+            report("embedding")
+            db = self.add_chunks(db, store_name, batch)
+        return page_texts, db
+
+    def delete_document(self, content_id):
+        """Xóa tài liệu khỏi registry cùng vector store và original_text của nó."""
+        document = database.get_document(content_id)
+        if document is None:
+            return False
+        database.remove_document(content_id)
+        self._remove_document_files(document)
+        return True
+
+    def _remove_document_files(self, document):
+        """Xóa dữ liệu của tài liệu đã bỏ khỏi registry: store, original_text, bản tóm tắt, câu trả lời cache."""
+        content_id = document['content_id']
+        store_name = document['store_name']
+        answer_cache.invalidate_document(content_id)
+        remove_summary(content_id)
+
+        if self.unified_index is not None:
+            self.unified_index.remove_document(store_name)
+
+        db_path = os.path.join(self.vector_db_path, store_name)
+        txt_path = os.path.join("original_text", f"{store_name}.txt")
         
         import shutil
         if os.path.exists(db_path):
             shutil.rmtree(db_path)
         if os.path.exists(txt_path):
             os.remove(txt_path)
-        return True
+
+    def delete_unreferenced(self, content_id):
+        """
+        Xóa tài liệu nếu không còn session nào tham chiếu. Kiểm tra + xóa khỏi registry trong một câu lệnh SQL
+        (an toàn với worker khác đang gắn file vào session), file trên đĩa chỉ bị xóa khi registry đã xóa xong.
+        """
+        with self._ingest_lock(content_id):
+            document = database.get_document(content_id)
+            if document is None or not database.remove_unreferenced_document(content_id):
+                return False
+            self._remove_document_files(document)
+            return True
 
 class ContextRetriever:
-    def __init__(self, context_dir='original_text'):
+    def __init__(self, context_dir='original_text', max_cached_chars=CONTEXT_TEXT_CACHE_CHARS):
         self.context_dir = context_dir
+        # Cache LRU nội dung original_text/<file>.txt, kiểm tra mtime để không dùng bản cũ
+        self.max_cached_chars = max_cached_chars
+        self._text_cache = OrderedDict()  # file_path -> (mtime, text)
+        self._cached_chars = 0
+        self._cache_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
     def read_text_file(self, file_name):
         if not file_name.endswith('.txt'):
             file_name += '.txt'
         file_path = os.path.join(self.context_dir, file_name)
         try:
-            if os.path.exists(file_path):
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    return file.read()
-        except IOError: pass
-        return ""
+            mtime = os.path.getmtime(file_path)
+        except OSError:
+            return ""
+
+        with self._cache_lock:
+            cached = self._text_cache.get(file_path)
+            if cached and cached[0] == mtime:
+                self._text_cache.move_to_end(file_path)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        try:
+            with metrics.span("read_text"), open(file_path, 'r', encoding='utf-8') as file:
+                text = file.read()
+        except IOError:
+            return ""
+
+        with self._cache_lock:
+            if file_path in self._text_cache:
+                self._cached_chars -= len(self._text_cache.pop(file_path)[1])
+            self._text_cache[file_path] = (mtime, text)
+            self._cached_chars += len(text)
+            while len(self._text_cache) > 1 and self._cached_chars > self.max_cached_chars:
+                _, (_, evicted) = self._text_cache.popitem(last=False)
+                self._cached_chars -= len(evicted)
+        return text
 
-    def expand_context(self, file_name_clean, context, num_words=150):
+    def locate_chunk(self, file_name_clean, context, char_start=None, char_end=None):
+        """Trả về (toàn văn bản, vị trí chunk trong văn bản hoặc -1)."""
         all_text = self.read_text_file(file_name_clean)
-        if not all_text: return context
-        idx = all_text.find(context)
+        if not all_text: return "", -1
+
+        # Index mới có offset của chunk -> lấy trực tiếp, không phải tìm trong cả văn bản
+        if char_start is not None and char_end is not None and all_text[char_start:char_end] == context:
+            return all_text, char_start
+        # Index cũ (chưa có offset) hoặc offset không khớp
+        return all_text, all_text.find(context)
+
+    def expand_context(self, file_name_clean, context, num_words=150, char_start=None, char_end=None):
+        all_text, idx = self.locate_chunk(file_name_clean, context, char_start, char_end)
         if idx != -1:
             start = max(0, idx - num_words * 5)
             end = min(len(all_text), idx + len(context) + num_words * 5)
@@ -176,6 +631,9 @@ class ContextRetriever:
         return context
 
     def get_file_name(self, metadata):
+        # Chunk mới ghi sẵn tên store; chunk cũ suy ra từ tên file upload
+        if metadata.get('store_name'):
+            return metadata['store_name']
         source = metadata.get('source', '')
         file_name = os.path.basename(source)
         return TextProcessor().remove_accents(os.path.splitext(file_name)[0])
\ No newline at end of file
@@ -0,0 +1,103 @@
+import os
+import time
+import threading
+
+# Bước rerank (tùy chọn): lấy dư ứng viên rồi chấm lại bằng cross-encoder nhỏ trên CPU
+RERANK_ENABLED = os.getenv("RERANK", "0") == "1"
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "30"))
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "4"))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "16"))
+# Ngân sách thời gian cho bước rerank trong mỗi request (mili giây)
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "300"))
+
+
+class CrossEncoderReranker:
+    """
+    Chấm điểm (câu hỏi, đoạn văn) theo lô bằng cross-encoder. Theo dõi chi phí trung bình mỗi cặp
+    để chỉ chấm số ứng viên vừa ngân sách, dừng sớm hoặc bỏ qua rerank nếu sẽ vượt ngân sách.
+    """
+    def __init__(self, model_name=RERANK_MODEL, batch_size=RERANK_BATCH_SIZE, budget_ms=RERANK_BUDGET_MS):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.budget_ms = budget_ms
+        self._model = None
+        self._lock = threading.Lock()
+        self.ms_per_pair = None  # trung bình trượt (EMA) thời gian chấm một cặp
+        self.skipped = 0
+        self._warmup_thread = None
+
+    @property
+    def model(self):
+        with self._lock:
+            if self._model is None:
+                from sentence_transformers import CrossEncoder
+                self._model = CrossEncoder(self.model_name, device='cpu')
+            return self._model
+
+    def warmup(self):
+        """Load model và đo chi phí ban đầu, tránh request đầu tiên phải trả giá này."""
+        pairs = [("khởi động", "đoạn văn mẫu")] * self.batch_size
+        # Lần chạy đầu còn khởi tạo (cấp phát, JIT của torch) -> không tính vào chi phí mỗi cặp
+        self.model.predict(pairs, batch_size=self.batch_size, convert_to_numpy=True)
+        self._score(pairs)
+
+    def warmup_async(self):
+        """Chạy warmup() trên thread nền (một lần; chạy lại nếu lần trước lỗi)."""
+        with self._lock:
+            if self.ms_per_pair is not None or (self._warmup_thread is not None and self._warmup_thread.is_alive()):
+                return
+            self._warmup_thread = threading.Thread(target=self._warmup_in_background, name="rerank-warmup", daemon=True)
+            self._warmup_thread.start()
+
+    def _warmup_in_background(self):
+        try:
+            self.warmup()
+        except Exception as e:
+            print(f"⚠️ Warmup reranker thất bại: {e}")
+
+    def _score(self, pairs):
+        model = self.model  # load model (nếu chưa) ngoài phần đo thời gian
+        start = time.perf_counter()
+        scores = model.predict(pairs, batch_size=self.batch_size, convert_to_numpy=True)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        per_pair = elapsed_ms / len(pairs)
+        self.ms_per_pair = per_pair if self.ms_per_pair is None else 0.8 * self.ms_per_pair + 0.2 * per_pair
+        return scores
+
+    def rerank(self, query, candidates, top_n=RERANK_TOP_N, budget_ms=None):
+        """
+        candidates: [(doc, score, db_name)] đã xếp hạng. Trả về top_n theo điểm cross-encoder;
+        ứng viên chưa kịp chấm giữ thứ tự cũ và đứng sau các ứng viên đã chấm.
+        Chưa đo được chi phí (model chưa load / chưa warmup xong) -> bỏ qua rerank, warmup chạy nền.
+        """
+        if not candidates:
+            return []
+        if self.ms_per_pair is None:
+            self.warmup_async()
+            self.skipped += 1
+            return candidates[:top_n]
+        budget_ms = self.budget_ms if budget_ms is None else budget_ms
+        start = time.perf_counter()
+
+        limit = min(len(candidates), int(budget_ms / self.ms_per_pair)) if self.ms_per_pair else len(candidates)
+        if limit < min(self.batch_size, len(candidates)):
+            # Không đủ ngân sách cho một lô -> bỏ qua rerank
+            self.skipped += 1
+            return candidates[:top_n]
+
+        scored = []
+        for i in range(0, limit, self.batch_size):
+            batch = candidates[i:min(i + self.batch_size, limit)]
+            scores = self._score([(query, doc.page_content) for doc, _, _ in batch])
+            scored.extend((doc, float(score), db_name) for (doc, _, db_name), score in zip(batch, scores))
+
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if elapsed_ms + self.ms_per_pair * self.batch_size > budget_ms:
+                break
+
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return (scored + candidates[len(scored):])[:top_n]
+
+
+reranker = CrossEncoderReranker()
@@ -119,9 +119,17 @@ document.addEventListener("DOMContentLoaded", () => {
             const response = await fetch('/upload', { method: 'POST', body: formData });
             const data = await response.json();
             if (data.errors && data.errors.length > 0) alert("Lỗi:\n" + data.errors.join("\n"));
-            
-            updatePDFList(data.processed_files);
-            uploadStatus.textContent = `Đã thêm ${data.processed_files.length} file.`;
+
+            // Server xử lý file ở nền -> poll trạng thái cho tới khi tất cả job xong
+            const jobIds = (data.jobs || []).map(job => job.job_id);
+            const uploadSessionId = currentSessionId;
+            const finalJobs = await pollUploadStatus(jobIds, uploadSessionId);
+
+            const failed = finalJobs.filter(job => job.stage === "error");
+            if (failed.length > 0) alert("Lỗi:\n" + failed.map(job => `${job.filename}: ${job.error}`).join("\n"));
+
+            if (uploadSessionId === currentSessionId) loadUploadedFiles(currentSessionId);
+            uploadStatus.textContent = `Đã thêm ${finalJobs.length - failed.length} file.`;
             uploadStatus.style.color = "green";
         } catch (e) { 
             console.error(e); 
@@ -133,6 +141,34 @@ document.addEventListener("DOMContentLoaded", () => {
         }
     }
 
+    const STAGE_LABELS = {
+        queued: "đang chờ", parsing: "đọc file", chunking: "chia đoạn",
+        embedding: "tạo embedding", saving: "lưu index", summarizing: "tóm tắt",
+        done: "xong", error: "lỗi"
+    };
+
+    async function pollUploadStatus(jobIds, sessionId) {
+        if (jobIds.length === 0) return [];
+        let knownFileCount = -1;
+        while (true) {
+            const res = await fetch(`/upload_status?session_id=${sessionId}&job_ids=${jobIds.join(",")}`);
+            const data = await res.json();
+            const jobs = data.jobs || [];
+
+            uploadStatus.style.color = "";
+            uploadStatus.textContent = jobs.map(job => `${job.filename}: ${STAGE_LABELS[job.stage] || job.stage}`).join(" | ");
+            // File chỉ xuất hiện trong session khi index đã sẵn sàng
+            const files = data.processed_files || [];
+            if (sessionId === currentSessionId && files.length !== knownFileCount) {
+                knownFileCount = files.length;
+                updatePDFList(files);
+            }
+
+            if (jobs.every(job => job.stage === "done" || job.stage === "error")) return jobs;
+            await new Promise(resolve => setTimeout(resolve, 1000));
+        }
+    }
+
     // === CHAT ===
     async function sendMessage() {
         const question = userInput.value.trim();
@@ -150,7 +186,7 @@ document.addEventListener("DOMContentLoaded", () => {
         thinkingIndicator.style.display = "block";
         
         try {
-            const response = await fetch('/chat', {
+            const response = await fetch('/chat_stream', {
                 method: 'POST', headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({
                     question: question,
@@ -158,9 +194,41 @@ document.addEventListener("DOMContentLoaded", () => {
                     selected_pdfs: Array.from(selectedPDFs) // Gửi danh sách đã chọn
                 })
             });
-            const data = await response.json();
-            chatHistory.push(`Bot: ${data.response}`);
-            addMessageToChat(data.response.replace(/\n/g, '<br>'), "bot");
+
+            // Đọc stream SSE: hiện token ngay khi server gửi về
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = "";
+            let streamedText = "";
+            let botBubble = null;
+
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+
+                let boundary;
+                while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+                    const rawEvent = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+                    const { event, data } = parseSSE(rawEvent);
+                    if (!data) continue;
+
+                    if (!botBubble) {
+                        thinkingIndicator.style.display = "none";
+                        botBubble = addMessageToChat("", "bot");
+                    }
+                    if (event === "token") {
+                        streamedText += data.text;
+                        botBubble.innerHTML = streamedText.replace(/\n/g, '<br>');
+                    } else if (event === "end") {
+                        // Câu trả lời cuối cùng (kèm nguồn tham khảo)
+                        botBubble.innerHTML = data.response.replace(/\n/g, '<br>');
+                        chatHistory.push(`Bot: ${data.response}`);
+                    }
+                    chatMessages.scrollTop = chatMessages.scrollHeight;
+                }
+            }
             loadSidebarSessions();
         } catch (error) { 
             addMessageToChat("Lỗi hệ thống.", "bot"); 
@@ -168,11 +236,24 @@ document.addEventListener("DOMContentLoaded", () => {
             thinkingIndicator.style.display = "none"; 
         }
     }
+
+    function parseSSE(rawEvent) {
+        let event = "message";
+        const dataLines = [];
+        rawEvent.split("\n").forEach(line => {
+            if (line.startsWith("event:")) event = line.slice(6).trim();
+            else if (line.startsWith("data:")) dataLines.push(line.slice(5).trim());
+        });
+        if (dataLines.length === 0) return { event, data: null };
+        try { return { event, data: JSON.parse(dataLines.join("\n")) }; }
+        catch (e) { return { event, data: null }; }
+    }
     
     function addMessageToChat(message, sender) {
         const div = document.createElement("div"); div.className = `message-bubble ${sender}`;
         div.innerHTML = message; chatMessages.appendChild(div);
         chatMessages.scrollTop = chatMessages.scrollHeight;
+        return div;
     }
 
     // === SESSION MANAGEMENT ===
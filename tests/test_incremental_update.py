@@ -0,0 +1,85 @@
+"""
+Cập nhật tăng dần trên store IVF: không lấy lại được vector cũ nên BM25 phải dựng lại từ store mới,
+tìm kiếm lai không được trả về id chunk của phiên bản trước.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("langchain_community")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+# Cấu hình phải có trước khi import các module đọc biến môi trường lúc import
+os.environ.update({
+    "ANN_MIN_CHUNKS": "40",
+    "ANN_INDEX_TYPE": "ivf",
+    "UNIFIED_INDEX": "0",
+    "EMBEDDING_CACHE": "0",
+    "DOCUMENT_SUMMARIES": "0",
+    "ANSWER_CACHE": "0",
+    "RERANK": "0",
+    "GROQ_API_KEY": "test",
+})
+
+
+def make_document(version, sections=400):
+    paragraphs = []
+    for i in range(sections):
+        if version == 2 and i % 4 == 0:
+            paragraphs.append(f"Điều {i}. Nội dung sửa đổi: bên thuê thanh toán phí dịch vụ bảo trì mã BT{i} hằng quý.")
+        else:
+            paragraphs.append(f"Điều {i}. Bên cho thuê bàn giao tài sản số TS{i} cho bên thuê vào ngày {i % 28 + 1}.")
+    return "\n\n".join(paragraphs)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # database / original_text / summaries dùng đường dẫn tương đối
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_update_ivf_store_then_hybrid_search(workdir):
+    if "embedding" not in sys.modules:
+        from benchmarks.stubs import install_stub_embedder
+        install_stub_embedder()
+    import database
+    from pdf_processor import DocumentDatabaseManager
+    from bot_logic import chatBotMode
+    from index_builder import load_index_params
+
+    database.init_db()
+    manager = DocumentDatabaseManager("uploads", "vectorstores", "hashes.json", unified=False, summaries=False)
+
+    first = workdir / "hop_dong_v1.txt"
+    first.write_text(make_document(1), encoding="utf-8")
+    base_id = manager.calculate_file_hash(str(first))
+    base_db = manager.update_db(str(first), content_id=base_id, original_name="hop_dong.txt")
+    assert base_db is not None
+    # Tài liệu phải vượt ANN_MIN_CHUNKS, nếu không store vẫn phẳng và không kiểm tra được nhánh IVF
+    assert load_index_params(str(workdir / "vectorstores" / base_id))["type"] == "ivf"
+    assert manager.stored_chunks(base_id) is None  # IVF -> không dùng lại vector được
+
+    second = workdir / "hop_dong_v2.txt"
+    second.write_text(make_document(2), encoding="utf-8")
+    content_id = manager.calculate_file_hash(str(second))
+    manager.update_db(str(second), content_id=content_id, original_name="hop_dong.txt", base_content_id=base_id)
+
+    db = manager.load_existing_db(content_id)
+    store_ids = set(db.index_to_docstore_id.values())
+    assert set(db.lexical_index.doc_lengths) == store_ids
+
+    bot = chatBotMode({content_id: db})
+    results = bot.hybrid_search({"hop_dong.txt": db}, "phí dịch vụ bảo trì BT8", k=6)
+    assert results
+    for doc, _, _ in results:
+        assert doc.page_content
+        assert doc.metadata["store_name"] == content_id
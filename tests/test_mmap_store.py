@@ -0,0 +1,61 @@
+"""
+Lưu store theo định dạng mmap rồi đọc lại, với từng loại index (phẳng, HNSW, IVF, IVF-PQ).
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("langchain_community")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+import index_builder
+import mmap_store
+
+DIM = 32
+NUM_CHUNKS = 800
+
+
+def build_store(index_type):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(NUM_CHUNKS, DIM)).astype(np.float32)
+    if index_type == "flat":
+        spec = {"type": "flat"}
+    else:
+        spec = index_builder.choose_index_spec(NUM_CHUNKS, DIM, index_type=index_type, min_chunks=1)
+    index = index_builder.build_faiss_index(vectors, spec)
+    ids = [f"chunk-{i}" for i in range(NUM_CHUNKS)]
+    docs = {chunk_id: Document(page_content=f"Điều {i}.", metadata={"page": i, "source": "a.pdf"})
+            for i, chunk_id in enumerate(ids)}
+    db = FAISS(None, index, InMemoryDocstore(docs), dict(enumerate(ids)))
+    return db, spec, vectors
+
+
+@pytest.mark.parametrize("index_type", ["flat", "hnsw", "ivf", "ivfpq"])
+def test_save_and_reload(tmp_path, index_type):
+    db, spec, vectors = build_store(index_type)
+    db_path = str(tmp_path / "store")
+    mmap_store.save_mmap_store(db, db_path, spec)
+
+    loaded = mmap_store.load_mmap_store(db_path, embeddings=None)
+    index_builder.apply_search_params(loaded.index, spec)
+    assert loaded.index.ntotal == NUM_CHUNKS
+    assert loaded.index_to_docstore_id[5] == "chunk-5"
+
+    results = loaded.similarity_search_with_score_by_vector(vectors[5], k=3)
+    assert results
+    doc, _ = results[0]
+    if index_type != "ivfpq":  # PQ nén vector -> khoảng cách xấp xỉ, không chắc chunk đúng đứng đầu
+        assert doc.page_content == "Điều 5."
+        assert doc.metadata == {"page": 5, "source": "a.pdf"}
@@ -0,0 +1,55 @@
+"""
+Index hợp nhất dùng chung giữa nhiều worker: mỗi instance UnifiedVectorIndex trên cùng thư mục đóng vai một worker.
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("langchain_community")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from langchain_core.documents import Document
+
+from benchmarks.stubs import HashEmbeddings
+from unified_index import UnifiedVectorIndex
+
+
+def chunks(name, count=5):
+    return [Document(page_content=f"{name} điều {i}: bên thuê thanh toán tiền thuê kỳ {i}.", metadata={"page": i})
+            for i in range(count)]
+
+
+def test_document_added_by_one_worker_is_visible_to_another(tmp_path):
+    path = str(tmp_path / "_unified")
+    first = UnifiedVectorIndex(path, HashEmbeddings(dim=64))
+    second = UnifiedVectorIndex(path, HashEmbeddings(dim=64))
+
+    first.add_document("a", chunks("a"))
+    assert second.has_document("a")
+    assert second.lexical_search("thanh toán tiền thuê", ["a"], k=3)
+
+
+def test_save_keeps_documents_written_by_other_workers(tmp_path):
+    path = str(tmp_path / "_unified")
+    first = UnifiedVectorIndex(path, HashEmbeddings(dim=64))
+    second = UnifiedVectorIndex(path, HashEmbeddings(dim=64))
+
+    # Worker 2 đang ingest (chưa lưu) trong lúc worker 1 thêm và lưu tài liệu khác
+    second.add_document("b", chunks("b"), save=False)
+    first.add_document("a", chunks("a"))
+    second.save()
+    first.remove_document("a")
+
+    reloaded = UnifiedVectorIndex(path, HashEmbeddings(dim=64))
+    assert not reloaded.has_document("a")
+    assert reloaded.has_document("b")
+    assert len(reloaded.document_chunks("b")) == 5
+    assert reloaded.db.index.ntotal == 5
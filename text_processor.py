@@ -49,6 +49,15 @@ class TextProcessor:
         nfkd_form = unicodedata.normalize('NFKD', input_str)
         return ''.join([c for c in nfkd_form if not unicodedata.combining(c)])
 
+    def fold_for_search(self, input_str):
+        '''
+        :param input_str:
+        :return: chữ thường, bỏ dấu (kể cả đ -> d)
+        mục đích: người dùng gõ không dấu vẫn khớp được với văn bản có dấu
+        '''
+        folded = self.remove_accents(input_str.lower())
+        return folded.replace('đ', 'd')
+
     def format_context(self, context):
         parts = context.split("SEPARATED")
         if len(parts) != 2:
@@ -0,0 +1,315 @@
+import os
+import json
+import uuid
+import threading
+from contextlib import contextmanager
+import numpy as np
+import faiss
+from langchain_community.vectorstores import FAISS
+from lexical_index import BM25Index
+
+try:
+    import fcntl
+except ImportError:  # Windows: không có flock, chạy một process (flask run)
+    fcntl = None
+
+# Bật chế độ index hợp nhất: tất cả chunk của mọi tài liệu nằm chung một FAISS index
+UNIFIED_INDEX = os.getenv("UNIFIED_INDEX", "0") == "1"
+UNIFIED_INDEX_DIR = "_unified"
+MIGRATION_MARKER = "migrated.json"
+# Khóa file giữa các worker: ghi giữ khóa độc quyền, đọc file index giữ khóa chia sẻ
+INDEX_LOCK_FILE = ".index.lock"
+# Mã thế hệ, đổi sau mỗi lần ghi -> worker khác biết index trên đĩa đã thay đổi và đọc lại
+GENERATION_FILE = "generation"
+
+
+class UnifiedVectorIndex:
+    """
+    Một FAISS index dùng chung cho toàn bộ corpus. Mỗi chunk được gắn metadata 'doc_id',
+    khi tìm kiếm chỉ cần một lần search với allow-list các vị trí thuộc các tài liệu của session.
+
+    Nhiều worker dùng chung file index: mỗi thay đổi (thêm / xóa / đổi tên tài liệu) được ghi nhận vào
+    _pending cho tới lần save(). save() giữ khóa file độc quyền, nếu worker khác đã ghi trước thì đọc lại
+    bản trên đĩa và áp lại các thay đổi chưa lưu rồi mới ghi đè. Khi đọc, index được load lại nếu mã thế hệ
+    trên đĩa khác bản đang giữ.
+    """
+    def __init__(self, index_path, embeddings):
+        self.index_path = index_path
+        self.embeddings = embeddings
+        self.db = None
+        self.doc_positions = {}  # doc_id -> [vị trí trong faiss index]
+        self.lexical = BM25Index()
+        self.generation = None
+        self._pending = []  # các thay đổi chưa ghi xuống đĩa, theo thứ tự
+        self._lock = threading.RLock()
+        self.load()
+
+    @contextmanager
+    def _file_lock(self, exclusive):
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(self.index_path, exist_ok=True)
+        with open(os.path.join(self.index_path, INDEX_LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _disk_generation(self):
+        try:
+            with open(os.path.join(self.index_path, GENERATION_FILE), 'r') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def _read_disk(self):
+        """Đọc index trên đĩa (gọi khi đang giữ khóa file)."""
+        self.db = None
+        if os.path.exists(os.path.join(self.index_path, "index.faiss")):
+            try:
+                self.db = FAISS.load_local(self.index_path, self.embeddings, allow_dangerous_deserialization=True)
+            except Exception as e:
+                print(f"Error loading unified index: {e}")
+        self._rebuild_positions()
+        self.lexical = BM25Index()
+        if self.db is not None:
+            self.lexical = BM25Index.load(self.index_path) or BM25Index.from_store(self.db)
+        self.generation = self._disk_generation()
+
+    def _sync(self):
+        """Worker khác đã ghi -> đọc lại bản trên đĩa rồi áp lại các thay đổi chưa lưu của worker này."""
+        if self._disk_generation() == self.generation:
+            return
+        self._read_disk()
+        for change in self._pending:
+            self._apply(change)
+
+    def load(self):
+        """Đọc lại index từ đĩa, bỏ các thay đổi chưa lưu."""
+        with self._lock, self._file_lock(exclusive=False):
+            self._pending = []
+            self._read_disk()
+
+    def refresh(self):
+        """Load lại nếu worker khác đã ghi index kể từ lần đọc trước."""
+        if self._disk_generation() == self.generation:
+            return
+        with self._lock, self._file_lock(exclusive=False):
+            self._sync()
+
+    def save(self):
+        with self._lock, self._file_lock(exclusive=True):
+            self._sync()
+            if self._pending:
+                self._write()
+
+    def _write(self):
+        """Ghi index + BM25 và đổi mã thế hệ (gọi khi đang giữ khóa file độc quyền)."""
+        os.makedirs(self.index_path, exist_ok=True)
+        if self.db is not None:
+            self.db.save_local(self.index_path)
+            self.lexical.save(self.index_path)
+        generation = uuid.uuid4().hex
+        tmp_path = os.path.join(self.index_path, f"{GENERATION_FILE}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as f:
+            f.write(generation)
+        os.replace(tmp_path, os.path.join(self.index_path, GENERATION_FILE))
+        self.generation = generation
+        self._pending = []
+
+    def _apply(self, change):
+        kind = change[0]
+        if kind == "add":
+            self._add(*change[1:])
+        elif kind == "remove":
+            self._remove(change[1])
+        elif kind == "rename":
+            self._rename(change[1], change[2])
+
+    def _rebuild_positions(self):
+        self.doc_positions = {}
+        if self.db is None:
+            return
+        for position, docstore_id in self.db.index_to_docstore_id.items():
+            doc = self.db.docstore.search(docstore_id)
+            doc_id = getattr(doc, "metadata", {}).get("doc_id")
+            if doc_id is not None:
+                self.doc_positions.setdefault(doc_id, []).append(position)
+
+    def has_document(self, doc_id):
+        self.refresh()
+        return doc_id in self.doc_positions
+
+    def add_document(self, doc_id, chunks, save=True):
+        """Thêm các chunk (đã có page_content) của một tài liệu vào index chung."""
+        texts = [chunk.page_content for chunk in chunks]
+        # Embed ngoài lock để không chặn các truy vấn đang chạy
+        vectors = self.embeddings.embed_documents(texts)
+        self.add_embeddings(doc_id, texts, vectors, [dict(chunk.metadata) for chunk in chunks])
+        if save:
+            self.save()
+
+    def add_embeddings(self, doc_id, texts, vectors, metadatas):
+        """Thêm chunk kèm vector có sẵn (dùng khi migrate, không cần encode lại). Không lưu xuống đĩa, gọi save() sau đó."""
+        for meta in metadatas:
+            meta['doc_id'] = doc_id
+        change = ("add", doc_id, list(texts), list(vectors), metadatas)
+        with self._lock:
+            self._pending.append(change)
+            self._apply(change)
+
+    def _add(self, doc_id, texts, vectors, metadatas):
+        start = self.db.index.ntotal if self.db is not None else 0
+        pairs = list(zip(texts, vectors))
+        # Bản sao metadata: thay đổi được áp lại sau khi load lại index không dùng chung dict với lần trước
+        metadatas = [dict(meta) for meta in metadatas]
+        if self.db is None:
+            self.db = FAISS.from_embeddings(pairs, self.embeddings, metadatas=metadatas)
+        else:
+            self.db.add_embeddings(pairs, metadatas=metadatas)
+        new_positions = range(start, self.db.index.ntotal)
+        self.doc_positions.setdefault(doc_id, []).extend(new_positions)
+        for position, text in zip(new_positions, texts):
+            self.lexical.add(self.db.index_to_docstore_id[position], text)
+
+    def document_chunks(self, doc_id):
+        """Các chunk của một tài liệu: [(docstore id, text, vector)] (dùng khi cập nhật tài liệu, không embed lại)."""
+        self.refresh()
+        with self._lock:
+            chunks = []
+            for position in self.doc_positions.get(doc_id, []):
+                chunk_id = self.db.index_to_docstore_id[position]
+                text = self.db.docstore.search(chunk_id).page_content
+                chunks.append((chunk_id, text, self.db.index.reconstruct(int(position))))
+            return chunks
+
+    def remove_document(self, doc_id):
+        self.refresh()
+        with self._lock:
+            if not self._remove(doc_id):
+                return False
+            self._pending.append(("remove", doc_id))
+            self.save()
+            return True
+
+    def _remove(self, doc_id):
+        positions = self.doc_positions.get(doc_id)
+        if self.db is None or not positions:
+            return False
+        ids = [self.db.index_to_docstore_id[p] for p in positions]
+        self.db.delete(ids)
+        self.lexical.remove(ids)
+        # FAISS.delete đánh lại vị trí các vector còn lại -> tính lại bảng vị trí
+        self._rebuild_positions()
+        return True
+
+    def rename_document(self, old_doc_id, new_doc_id):
+        """Đổi doc_id của các chunk (không cần embed lại). Không lưu xuống đĩa, gọi save() sau đó."""
+        self.refresh()
+        with self._lock:
+            if not self._rename(old_doc_id, new_doc_id):
+                return False
+            self._pending.append(("rename", old_doc_id, new_doc_id))
+            return True
+
+    def _rename(self, old_doc_id, new_doc_id):
+        positions = self.doc_positions.get(old_doc_id)
+        if self.db is None or not positions or new_doc_id in self.doc_positions:
+            return False
+        for position in positions:
+            self.db.docstore.search(self.db.index_to_docstore_id[position]).metadata['doc_id'] = new_doc_id
+        self.doc_positions[new_doc_id] = self.doc_positions.pop(old_doc_id)
+        return True
+
+    def search_by_vector(self, query_vector, doc_ids, k=6):
+        """Tìm top-k toàn cục, chỉ trong các tài liệu thuộc doc_ids. Trả về [(doc, score, doc_id)]."""
+        self.refresh()
+        with self._lock:
+            if self.db is None:
+                return []
+            allowed = [p for doc_id in doc_ids for p in self.doc_positions.get(doc_id, [])]
+            if not allowed:
+                return []
+
+            selector = faiss.IDSelectorBatch(np.array(allowed, dtype=np.int64))
+            params = faiss.SearchParameters(sel=selector)
+            vector = np.array([query_vector], dtype=np.float32)
+            scores, indices = self.db.index.search(vector, min(k, len(allowed)), params=params)
+
+            results = []
+            for position, score in zip(indices[0], scores[0]):
+                if position == -1:
+                    continue
+                doc = self.db.docstore.search(self.db.index_to_docstore_id[position])
+                results.append((doc, float(score), doc.metadata.get('doc_id')))
+            return results
+
+    def lexical_search(self, query, doc_ids, k=20):
+        """Tìm BM25 trong các tài liệu thuộc doc_ids. Trả về [(doc, điểm BM25, doc_id)]."""
+        self.refresh()
+        with self._lock:
+            if self.db is None:
+                return []
+            allowed = {self.db.index_to_docstore_id[p]
+                       for doc_id in doc_ids for p in self.doc_positions.get(doc_id, [])}
+            results = []
+            for chunk_id, score in self.lexical.search(query, k=k, allowed=allowed):
+                doc = self.db.docstore.search(chunk_id)
+                results.append((doc, score, doc.metadata.get('doc_id')))
+            return results
+
+    def view(self, doc_id):
+        return UnifiedDocumentView(self, doc_id)
+
+    # --- MIGRATION TỪ CÁC STORE RIÊNG LẺ ---
+    def is_migrated(self):
+        return os.path.exists(os.path.join(self.index_path, MIGRATION_MARKER))
+
+    def migrate_from_stores(self, stores):
+        """
+        stores: iterable (doc_id, FAISS) của các store cũ. Chỉ chạy một lần,
+        dùng lại vector đã lưu trong store cũ thay vì embed lại.
+        """
+        if self.is_migrated():
+            return []
+        migrated = []
+        # Giữ khóa độc quyền suốt quá trình: worker khởi động cùng lúc chờ rồi thấy marker, không migrate lần hai
+        with self._lock, self._file_lock(exclusive=True):
+            if self.is_migrated():
+                return []
+            self._sync()
+            for doc_id, store in stores:
+                if store is None or doc_id in self.doc_positions:
+                    continue
+                vectors = store.index.reconstruct_n(0, store.index.ntotal)
+                texts, metadatas = [], []
+                for position in range(store.index.ntotal):
+                    doc = store.docstore.search(store.index_to_docstore_id[position])
+                    texts.append(doc.page_content)
+                    metadatas.append(dict(doc.metadata))
+                self.add_embeddings(doc_id, texts, vectors, metadatas)
+                migrated.append(doc_id)
+                print(f"Migrated {doc_id} into unified index.")
+            self._write()
+            with open(os.path.join(self.index_path, MIGRATION_MARKER), 'w') as f:
+                json.dump(migrated, f)
+        return migrated
+
+
+class UnifiedDocumentView:
+    """
+    Đại diện cho một tài liệu bên trong index hợp nhất, có cùng giao diện tìm kiếm với FAISS
+    để cache và bot_logic dùng như một store riêng.
+    """
+    def __init__(self, unified_index, doc_id):
+        self.unified_index = unified_index
+        self.doc_id = doc_id
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4):
+        return [(doc, score) for doc, score, _ in
+                self.unified_index.search_by_vector(embedding, [self.doc_id], k=k)]
+
+    def similarity_search_with_score(self, query, k=4):
+        return self.similarity_search_with_score_by_vector(self.unified_index.embeddings.embed_query(query), k=k)
@@ -0,0 +1,114 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Giới hạn cache vector store (0 = không giới hạn)
+VECTOR_CACHE_MAX_ENTRIES = int(os.getenv("VECTOR_CACHE_MAX_ENTRIES", "64"))
+VECTOR_CACHE_MAX_MB = float(os.getenv("VECTOR_CACHE_MAX_MB", "0"))
+
+
+def estimate_store_bytes(db):
+    """Ước lượng bộ nhớ của một FAISS store: vector float32 + text của các chunk + index BM25."""
+    if hasattr(db, "private_bytes"):
+        # Store mmap: vector và text nằm trong page cache dùng chung giữa các worker
+        return db.private_bytes()
+    index = getattr(db, "index", None)
+    if index is None:
+        # Ví dụ UnifiedDocumentView: dữ liệu nằm ở index dùng chung, không tính riêng
+        return 0
+    size = index.ntotal * index.d * 4
+    docs = getattr(getattr(db, "docstore", None), "_dict", {})
+    for doc in docs.values():
+        size += len(doc.page_content.encode('utf-8'))
+    lexical_index = getattr(db, "lexical_index", None)
+    if lexical_index is not None:
+        size += lexical_index.estimated_bytes()
+    return size
+
+
+class VectorStoreCache:
+    """
+    Cache LRU cho các vector store, load lười khi session cần lần đầu.
+    Giới hạn theo số entry và/hoặc dung lượng ước lượng, có đếm hit/miss/eviction.
+    """
+    def __init__(self, loader, max_entries=VECTOR_CACHE_MAX_ENTRIES, max_bytes=int(VECTOR_CACHE_MAX_MB * 1024 * 1024)):
+        self.loader = loader
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # name -> (db, size)
+        self._total_bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name):
+        """Trả về store đã cache, hoặc load từ đĩa nếu chưa có. None nếu không tồn tại."""
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+                self.hits += 1
+                return self._entries[name][0]
+            self.misses += 1
+
+        db = self.loader(name)
+        if db is not None:
+            self.put(name, db)
+        return db
+
+    def put(self, name, db):
+        size = estimate_store_bytes(db)
+        with self._lock:
+            if name in self._entries:
+                self._total_bytes -= self._entries.pop(name)[1]
+            self._entries[name] = (db, size)
+            self._total_bytes += size
+            self._evict()
+
+    def _evict(self):
+        # Luôn giữ lại entry mới nhất, kể cả khi một mình nó vượt ngân sách
+        while len(self._entries) > 1 and (
+            (self.max_entries and len(self._entries) > self.max_entries)
+            or (self.max_bytes and self._total_bytes > self.max_bytes)
+        ):
+            name, (_, size) = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+            print(f"Evicted vector store {name} from cache.")
+
+    def pop(self, name, default=None):
+        with self._lock:
+            if name not in self._entries:
+                return default
+            db, size = self._entries.pop(name)
+            self._total_bytes -= size
+            return db
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def items(self):
+        with self._lock:
+            return [(name, db) for name, (db, _) in self._entries.items()]
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }